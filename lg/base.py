@@ -22,23 +22,31 @@ import ipaddress
 import logging
 import os
 import pickle
+import threading
 from collections import namedtuple
 from enum import Enum
-from typing import Tuple, Any, Dict, List
+from typing import Tuple, Any, Dict, List, Optional, Union, TYPE_CHECKING
 
-import asyncpg
 import attr
 import pika
+import pika.exceptions
 import redis
 import json
 from dotenv import load_dotenv
-from flask import Flask
-from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
 from getenv import env
 from pika.adapters.blocking_connection import BlockingChannel
 from privex.loghelper import LogHelper
-from privex.helpers import env_bool, empty, settings as hlp_settings, Git, AttribDictable, env_int
+from privex.helpers import env_bool, empty, settings as hlp_settings, AttribDictable, env_int
+
+from lg.exceptions import QueueError, QueueFull
+
+# Flask, SQLAlchemy and asyncpg are only imported when they're actually used (see :func:`.get_app` / :func:`.get_pg`),
+# so that processes which never touch them (e.g. the queue runners) start faster and use less memory.
+if TYPE_CHECKING:
+    import asyncpg
+    from flask import Flask
+    from flask_migrate import Migrate
+    from flask_sqlalchemy import SQLAlchemy
 
 load_dotenv()
 
@@ -104,6 +112,102 @@ RMQ_HOST = cf['RMQ_HOST'] = env('RMQ_HOST', 'localhost')
 RMQ_PORT = cf['RMQ_PORT'] = env('RMQ_PORT', pika.ConnectionParameters._DEFAULT)
 RMQ_QUEUE = cf['RMQ_QUEUE'] = env('RMQ_QUEUE', 'privexlg')
 
+QUEUE_BACKEND = env('QUEUE_BACKEND', 'rabbitmq').lower()
+"""
+Which broker is used to queue ping / trace requests for the runners:
+
+ - ``rabbitmq`` (default) - RabbitMQ queues (see ``RMQ_HOST`` / ``RMQ_QUEUE``)
+ - ``redis`` - Redis Streams (requires Redis 5.0+, one stream per queue - ``lg_queue:<queue name>``), using
+   the same Redis server as the request results - so RabbitMQ isn't required at all.
+
+The web app and the runners must use the same backend. Jobs already in the old backend's queues aren't moved over.
+"""
+
+QUEUE_MAX_LENGTH = env_int('QUEUE_MAX_LENGTH', 1000)
+"""
+(Redis backend only) Once a queue holds this many jobs which haven't finished yet (waiting + running), new ping /
+trace requests for that queue are refused with ``QUEUE_FULL``, instead of queueing hours of work.
+Set to ``0`` for no limit.
+"""
+
+QUEUE_RETRY_AFTER = env_int('QUEUE_RETRY_AFTER', 30)
+"""Amount of seconds that clients are asked to wait (``Retry-After``) before retrying, when a queue is full"""
+
+QUEUE_GROUP = env('QUEUE_GROUP', 'lg_runners')
+"""(Redis backend only) The consumer group which all runners join, so that each job is only ran by one runner"""
+
+QUEUE_CLAIM_IDLE = env_int('QUEUE_CLAIM_IDLE', 60)
+"""
+(Redis backend only) Runners refresh the jobs they're running every few seconds. If a job taken by a runner hasn't
+been refreshed for this many seconds (i.e. the runner crashed / was killed), another runner takes it over.
+"""
+
+QUEUE_MAX_DELIVERIES = env_int('QUEUE_MAX_DELIVERIES', 3)
+"""
+(Redis backend only) Jobs which have been taken over this many times (e.g. because they crash the runner) are
+dropped, rather than being retried forever.
+"""
+
+STREAM_QUEUE_KEY = 'lg_queue:{}'
+"""Redis key of the stream for a queue when ``QUEUE_BACKEND`` is ``redis``, formatted with the queue name"""
+
+RUNNER_ASYNC = env_bool('RUNNER_ASYNC', False)
+"""
+If true, ``./manage.py queue`` runs several pings / traces at the same time using asyncio, instead of
+handling one queued request at a time. Can also be enabled with ``./manage.py queue --async``
+"""
+
+RMQ_QUEUE_PING = cf['RMQ_QUEUE_PING'] = env('RMQ_QUEUE_PING', RMQ_QUEUE)
+"""RabbitMQ queue for ping requests. Defaults to :py:attr:`.RMQ_QUEUE`, so requests queued before upgrading still run"""
+
+RMQ_QUEUE_TRACE = cf['RMQ_QUEUE_TRACE'] = env('RMQ_QUEUE_TRACE', f'{RMQ_QUEUE}_trace')
+"""
+RabbitMQ queue for trace (mtr) requests. Traces take much longer than pings, so they have their own queue
+(and their own runner slots), to avoid a burst of traces delaying every ping queued behind them.
+"""
+
+RMQ_QUEUES = {'ping': RMQ_QUEUE_PING, 'trace': RMQ_QUEUE_TRACE}
+"""Maps each action to the RabbitMQ queue that it's published to"""
+
+LG_LOCATION = env('LG_LOCATION', '')
+"""
+The location ID of the runners on this server (e.g. ``se1``), when running the looking glass across several PoPs.
+Runners with a location consume that location's own queues (see :func:`.location_queue`), and register themselves
+in Redis, so that the web app can send ``location=se1`` / ``location=all`` requests to them.
+Leave empty for the runners to consume the global queues. Can also be set with ``./manage.py queue --location``.
+"""
+
+LG_LOCATION_NAME = env('LG_LOCATION_NAME', LG_LOCATION)
+"""Human readable name of this runner's location (e.g. ``Stockholm, SE``), as listed by ``/api/v1/locations``"""
+
+DEFAULT_LOCATION = env('DEFAULT_LOCATION', '')
+"""
+(Web app) The location that requests without a ``location`` are sent to. Leave empty to send them to the global
+queues (i.e. runners without a location) - if all of your runners have a location, this must be set.
+"""
+
+RUNNER_CONCURRENCY = env_int('RUNNER_CONCURRENCY', 4)
+"""
+Base concurrency of an async queue runner, used for the defaults of :py:attr:`.RUNNER_CONCURRENCY_TRACE` (the same)
+and :py:attr:`.RUNNER_CONCURRENCY_PING` (double)
+"""
+
+RUNNER_CONCURRENCY_TRACE = env_int('RUNNER_CONCURRENCY_TRACE', RUNNER_CONCURRENCY)
+"""Maximum amount of traces that an async queue runner will run at the same time (default: RUNNER_CONCURRENCY)"""
+
+RUNNER_CONCURRENCY_PING = env_int('RUNNER_CONCURRENCY_PING', RUNNER_CONCURRENCY * 2)
+"""
+Maximum amount of pings that an async queue runner will run at the same time - these are separate from the
+trace slots, so pings keep running while the runner is busy with traces. (default: RUNNER_CONCURRENCY * 2)
+"""
+
+RUNNER_PREFETCH = env_int('RUNNER_PREFETCH', 0)
+"""
+Amount of unacknowledged messages that an async queue runner may take from each RabbitMQ queue at once.
+
+Default: ``0`` = same as the concurrency of that queue
+"""
+
 hlp_settings.REDIS_HOST = REDIS_HOST = env('REDIS_HOST', 'localhost')
 hlp_settings.REDIS_PORT = REDIS_PORT = int(env('REDIS_PORT', 6379))
 hlp_settings.REDIS_DB = REDIS_DB = int(env('REDIS_DB', 0))
@@ -137,21 +241,39 @@ DEFAULT_ERR: AppError = ERRORS['UNKNOWN_ERROR']
 
 SHOW_VERSION = env_bool('SHOW_VERSION', True)
 
-GIT_COMMIT, GIT_TAG, GIT_BRANCH = '', '', ''
+GIT_ATTRS = ('GIT_COMMIT', 'GIT_TAG', 'GIT_BRANCH')
+"""
+``GIT_COMMIT`` / ``GIT_TAG`` / ``GIT_BRANCH`` are looked up (by running ``git``) the first time they're accessed,
+rather than when this module is imported - see :func:`.get_git_info`
+"""
+
 
-if SHOW_VERSION:
+@functools.lru_cache(maxsize=None)
+def get_git_info() -> Dict[str, str]:
+    """Returns the current Git commit / tag / branch of this installation (empty if ``SHOW_VERSION`` is false)"""
+    info = dict(GIT_COMMIT='', GIT_TAG='', GIT_BRANCH='')
+    if not SHOW_VERSION:
+        return info
+    from privex.helpers import Git
     try:
-        GIT_COMMIT = Git(BASE_DIR).get_current_commit()
+        info['GIT_COMMIT'] = Git(BASE_DIR).get_current_commit()
     except Exception:
         log.warning("Failed to get current Git commit")
     try:
-        GIT_TAG = Git(BASE_DIR).get_current_tag()
+        info['GIT_TAG'] = Git(BASE_DIR).get_current_tag()
     except Exception:
         log.warning("Failed to get current Git tag")
     try:
-        GIT_BRANCH = Git(BASE_DIR).get_current_branch()
+        info['GIT_BRANCH'] = Git(BASE_DIR).get_current_branch()
     except Exception:
         log.warning("Failed to get current Git branch")
+    return info
+
+
+def __getattr__(name: str) -> Any:
+    if name in GIT_ATTRS:
+        return get_git_info()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @attr.s
@@ -200,14 +322,16 @@ PG_CONF = pg = dict(
 )
 
 
-async def get_pg_pool(loop=None) -> asyncpg.pool.Pool:
+async def get_pg_pool(loop=None) -> 'asyncpg.pool.Pool':
+    import asyncpg
     return await asyncpg.create_pool(
         host=PG_CONF['host'], port=PG_CONF['port'], user=PG_CONF['user'], password=PG_CONF['password'],
         database=PG_CONF['dbname'], loop=loop
     )
 
 
-async def get_pg() -> asyncpg.connection.Connection:
+async def get_pg() -> 'asyncpg.connection.Connection':
+    import asyncpg
     return await asyncpg.connect(
         host=PG_CONF['host'], port=PG_CONF['port'], user=PG_CONF['user'], password=PG_CONF['password'],
         database=PG_CONF['dbname']
@@ -241,6 +365,158 @@ def get_rmq() -> pika.BlockingConnection:
     return __STORE['rmq']
 
 
+def location_queue(queue: str, location: Optional[str] = None) -> str:
+    """Returns the name of the queue ``queue`` for the location ``location`` - e.g. ``privexlg@se1``"""
+    return f'{queue}@{location}' if location else queue
+
+
+class RMQPublisher:
+    """
+    A RabbitMQ publisher for the web workers, which is safe to share between threads, and safe to create before
+    Gunicorn forks its workers.
+
+     - The connection is opened lazily on first publish, and re-opened if the process has forked since then
+       (each worker process gets its own connection)
+     - One channel is re-used for all messages, with publisher confirms enabled - :meth:`.publish` only returns
+       once RabbitMQ has accepted the message
+     - Each queue is only declared once per connection
+     - If the connection / channel was lost (e.g. RabbitMQ restarted, or the idle connection was closed), it's
+       re-opened and the message re-sent, up to ``retries`` times
+
+    Basic usage::
+
+        >>> get_publisher().publish(RMQ_QUEUE, json.dumps(dict(req_id='abcd', action='ping', host='8.8.4.4')))
+
+    """
+    def __init__(self, host: str = RMQ_HOST, confirm: bool = True, retries: int = 2):
+        self.host, self.confirm, self.retries = host, confirm, retries
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None   # type: Optional[pika.BlockingConnection]
+        self._chan = None   # type: Optional[BlockingChannel]
+        self._declared = set()
+
+    def _reset(self):
+        conn, self._conn, self._chan, self._declared = self._conn, None, None, set()
+        # Never close a connection inherited from our parent process, as it's still in use by the parent
+        if conn is not None and self._pid == os.getpid():
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _channel(self, queue: Optional[str] = None) -> BlockingChannel:
+        """Returns the (re-)opened publisher channel - declaring ``queue`` on it first, unless it's ``None``"""
+        if self._pid != os.getpid():
+            self._conn, self._chan, self._declared = None, None, set()
+            self._pid = os.getpid()
+        if self._conn is None or self._conn.is_closed:
+            self._reset()
+            log.debug('Opening RabbitMQ publisher connection to %s (pid %d)', self.host, self._pid)
+            self._conn = pika.BlockingConnection(pika.ConnectionParameters(self.host))
+        if self._chan is None or self._chan.is_closed:
+            self._chan = self._conn.channel()
+            if self.confirm:
+                self._chan.confirm_delivery()
+        if queue is not None and queue not in self._declared:
+            self._chan.queue_declare(queue=queue)
+            self._declared.add(queue)
+        return self._chan
+
+    def publish(self, queue: str, body: str):
+        """
+        Publish ``body`` to the queue ``queue`` (using the default exchange).
+
+        :raises QueueError: When the message could not be published / was rejected by RabbitMQ,
+                            even after reconnecting ``retries`` times.
+        """
+        with self._lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    chan = self._channel(queue)
+                    chan.basic_publish(exchange='', routing_key=queue, body=body, mandatory=self.confirm)
+                    return
+                except pika.exceptions.AMQPError as e:
+                    log.warning('Error publishing to RabbitMQ queue %s (attempt %d) - %s %s',
+                                queue, attempt + 1, type(e), str(e))
+                    self._reset()
+                    if attempt >= self.retries:
+                        raise QueueError(f'Could not publish to RabbitMQ queue {queue}: {type(e)} {e}') from e
+
+    def queue_depth(self, queue: str) -> int:
+        """
+        Returns the amount of messages in ``queue`` which are waiting to be picked up by a runner - or ``0`` if the
+        queue doesn't exist yet. Only checks the queue (passive declare), so it never creates queues.
+        """
+        with self._lock:
+            try:
+                return self._channel().queue_declare(queue=queue, passive=True).method.message_count
+            except pika.exceptions.ChannelClosedByBroker as e:
+                # RabbitMQ closes the channel when a passively declared queue doesn't exist - it's re-opened on next use
+                self._chan = None
+                if e.reply_code == 404:
+                    return 0
+                raise QueueError(f'Could not check RabbitMQ queue {queue}: {type(e)} {e}') from e
+            except pika.exceptions.AMQPError as e:
+                self._reset()
+                raise QueueError(f'Could not check RabbitMQ queue {queue}: {type(e)} {e}') from e
+
+
+class RedisStreamPublisher:
+    """
+    Adds jobs to the Redis stream of a queue (``lg_queue:<queue>``), for runners using the ``redis`` queue backend.
+
+    Runners delete each job from the stream once they've finished it, so the length of the stream is the amount
+    of jobs which are waiting / running. If it's already ``max_length`` or more, the job is refused with
+    :class:`.QueueFull` - this is a soft limit, as concurrent publishers may each add one more job.
+
+        >>> get_publisher().publish(RMQ_QUEUE, json.dumps(dict(req_id='abcd', action='ping', host='8.8.4.4')))
+
+    """
+    def __init__(self, redis_conn: redis.Redis = None, max_length: int = QUEUE_MAX_LENGTH):
+        self._redis, self.max_length = redis_conn, max_length
+
+    @property
+    def redis(self) -> redis.Redis:
+        return self._redis if self._redis is not None else get_redis()
+
+    def publish(self, queue: str, body: str):
+        """
+        Add ``body`` to the end of the queue ``queue``.
+
+        :raises QueueFull: When the queue already contains ``max_length`` unfinished jobs
+        :raises QueueError: When the job could not be added, e.g. because Redis is down
+        """
+        key = STREAM_QUEUE_KEY.format(queue)
+        try:
+            if self.max_length > 0 and self.redis.xlen(key) >= self.max_length:
+                raise QueueFull(f'Queue {queue} already contains {self.max_length} or more jobs')
+            self.redis.xadd(key, {'body': body})
+        except redis.RedisError as e:
+            raise QueueError(f'Could not add job to Redis queue {queue}: {type(e)} {e}') from e
+
+    def queue_depth(self, queue: str) -> int:
+        """Returns the amount of jobs in ``queue`` which are waiting to be picked up by a runner"""
+        key = STREAM_QUEUE_KEY.format(queue)
+        try:
+            length = self.redis.xlen(key)
+            try:
+                running = self.redis.xpending(key, QUEUE_GROUP)['pending']
+            except redis.ResponseError:
+                # No runner has created the consumer group yet, so nothing is running
+                running = 0
+            return max(length - running, 0)
+        except redis.RedisError as e:
+            raise QueueError(f'Could not check Redis queue {queue}: {type(e)} {e}') from e
+
+
+def get_publisher() -> Union[RMQPublisher, RedisStreamPublisher]:
+    """Get the job publisher for this process (depending on ``QUEUE_BACKEND``). Create one if it doesn't exist."""
+    if 'publisher' not in __STORE:
+        __STORE['publisher'] = RedisStreamPublisher() if QUEUE_BACKEND == 'redis' else RMQPublisher()
+    return __STORE['publisher']
+
+
 def get_rmq_chan() -> BlockingChannel:
     """Get a RabbitMQ channel object. Create one if it doesn't exist."""
     # if 'rmq_chan' not in __STORE:
@@ -249,13 +525,17 @@ def get_rmq_chan() -> BlockingChannel:
     return chan
 
 
-def get_app() -> Tuple[Flask, SQLAlchemy, Migrate]:
+def get_app() -> Tuple['Flask', 'SQLAlchemy', 'Migrate']:
     """
     Initialise Flask, SQLAlchemy and Flask-Migrate, and/or return their instances from :py:attr:`__STORE`
 
     >>> from lg.base import get_app
     >>> app, db, migrate = get_app()
     """
+    from flask import Flask
+    from flask_migrate import Migrate
+    from flask_sqlalchemy import SQLAlchemy
+
     if 'flask' not in __STORE:
         flask = __STORE['flask'] = Flask(__name__)
         log.debug('Configuring SQLAlchemy for app: %s', flask.name)
@@ -25,3 +25,13 @@ class DatabaseConnectionFail(PrivexException):
 class GoBGPException(PrivexException):
     """Raised to wrap certain GoBGP / grpc library exceptions"""
     pass
+
+
+class QueueError(PrivexException):
+    """Raised when a ping / trace job could not be added to the job queue (RabbitMQ / Redis)"""
+    pass
+
+
+class QueueFull(QueueError):
+    """Raised when a job queue already holds ``QUEUE_MAX_LENGTH`` jobs which haven't finished yet"""
+    pass
@@ -0,0 +1,102 @@
+"""
+
+Measure the import time and memory usage of each entry point (``./manage.py import_times``), to catch heavy
+imports creeping into processes which don't need them - e.g. Flask / SQLAlchemy / gRPC in the queue runners.
+
+Each entry point is imported in a fresh interpreter with ``python -X importtime``, then its total import time,
+peak RSS, and the packages which took the longest to import are reported::
+
+    $ ./manage.py import_times runner web
+    runner      import:  312.4 ms   max rss:   38.1 MB
+        redis                                      92.7 ms
+        asyncio                                    41.3 ms
+        ...
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import os
+import re
+import subprocess
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {
+    'runner': 'import lg.lookingglass.runner, lg.lookingglass.consumers, lg.lookingglass.locations',
+    'manage': "import runpy, sys; sys.argv = ['manage.py']; runpy.run_path('manage.py', run_name='__main__')",
+    'scheduler': 'import lg.lookingglass.scheduler, lg.base; lg.base.get_app()',
+    'web': 'import wsgi',
+    'peerapp': 'import lg.peerapp.import_prefixes, lg.peerapp.cache',
+}
+"""Maps each entry point to the code which imports everything it imports before it starts working"""
+
+_RSS_CODE = (
+    "\nimport resource, sys"
+    "\nsys.stderr.write('max_rss: %d\\n' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+)
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| +(\S+)$')
+
+
+@dataclass
+class ImportTimes:
+    entry: str
+    ok: bool = True
+    total: float = 0.0
+    """Total import time in seconds"""
+    max_rss: int = 0
+    """Peak resident memory in KB"""
+    packages: List[Tuple[str, float]] = field(default_factory=list)
+    """Time spent importing each top-level package (``(package, seconds)``), slowest first"""
+    error: str = ''
+
+
+def measure(entry: str, code: str = None, python: str = sys.executable) -> ImportTimes:
+    """Import the entry point ``entry`` (see :attr:`.ENTRY_POINTS`) in a new interpreter, and measure its imports"""
+    code = ENTRY_POINTS[entry] if code is None else code
+    proc = subprocess.run(
+        [python, '-X', 'importtime', '-c', code + _RSS_CODE], cwd=BASE_DIR,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True
+    )
+    res, packages = ImportTimes(entry=entry), {}    # type: ImportTimes, Dict[str, float]
+    for line in proc.stderr.splitlines():
+        if line.startswith('max_rss: '):
+            res.max_rss = int(line.split()[1])
+            continue
+        m = _LINE.match(line)
+        if m is None:
+            continue
+        # Attribute the time spent importing each module itself to its top-level package, e.g. flask.json -> flask
+        pkg = m.group(3).split('.')[0]
+        packages[pkg] = packages.get(pkg, 0.0) + int(m.group(1)) / 1000000
+    if proc.returncode != 0:
+        res.ok, res.error = False, (proc.stderr.strip().splitlines() or ['unknown error'])[-1]
+    res.total = sum(packages.values())
+    res.packages = sorted(packages.items(), key=lambda p: p[1], reverse=True)
+    return res
+
+
+def format_report(results: List[ImportTimes], top: int = 10) -> str:
+    out = []
+    for r in results:
+        out.append(f'{r.entry:<11} import: {r.total * 1000:7.1f} ms   max rss: {r.max_rss / 1024:6.1f} MB')
+        if not r.ok:
+            out.append(f'    (failed to import: {r.error})')
+        for name, secs in r.packages[:top]:
+            out.append(f'    {name:<40} {secs * 1000:7.1f} ms')
+        out.append('')
+    return '\n'.join(out)
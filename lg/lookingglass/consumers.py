@@ -0,0 +1,296 @@
+"""
+
+Queue consumers for the ping / trace runners - one per queue backend (``QUEUE_BACKEND`` in :mod:`lg.base`).
+
+Both consumers hand each job to the runner as a :class:`.Delivery`, which the runner must :meth:`~.Delivery.ack`
+once the job is finished, or :meth:`~.Delivery.reject` if it couldn't be ran.
+
+ - :class:`.RMQConsumer` - consumes RabbitMQ queues using pika
+ - :class:`.RedisStreamConsumer` - consumes Redis Streams via a consumer group (``XREADGROUP``). Jobs taken by a
+   runner which died are taken over by the other runners (``XCLAIM``), and finished jobs are deleted from the
+   stream, so that its length can be used for backpressure (see :class:`lg.base.RedisStreamPublisher`).
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import logging
+import os
+import socket
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Union
+
+from pika import spec
+from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
+from redis import Redis, ResponseError
+
+from lg.base import QUEUE_BACKEND, QUEUE_GROUP, QUEUE_CLAIM_IDLE, QUEUE_MAX_DELIVERIES, STREAM_QUEUE_KEY
+
+log = logging.getLogger(__name__)
+
+Prefetch = Union[int, Dict[str, int]]
+"""
+Maximum amount of unfinished jobs that a consumer may hold - either an ``int`` shared between all of its queues,
+or a ``dict`` mapping each queue name to its own limit.
+"""
+
+
+class Delivery(ABC):
+    """A single job taken from the queue ``queue``, whose message body is ``body``"""
+    def __init__(self, queue: str, body: bytes):
+        self.queue, self.body = queue, body
+
+    @abstractmethod
+    def ack(self):
+        """Mark the job as done, removing it from the queue"""
+
+    @abstractmethod
+    def reject(self, requeue: bool = True):
+        """Give up on the job - if ``requeue`` is True, it will be ran again later (possibly by another runner)"""
+
+
+class RMQDelivery(Delivery):
+    def __init__(self, chan: BlockingChannel, method: spec.Basic.Deliver, body: bytes):
+        # Messages are published via the default exchange, so the routing key is the name of the queue
+        super().__init__(method.routing_key, body)
+        self.chan, self.delivery_tag = chan, method.delivery_tag
+
+    def ack(self):
+        self.chan.basic_ack(delivery_tag=self.delivery_tag)
+
+    def reject(self, requeue: bool = True):
+        self.chan.basic_nack(delivery_tag=self.delivery_tag, requeue=requeue)
+
+
+class RMQConsumer:
+    """Consumes jobs from one or more RabbitMQ queues"""
+    def __init__(self, mq_conn: BlockingConnection, queues: List[str]):
+        self.mq_conn, self.queues = mq_conn, queues
+        self.chan = mq_conn.channel()   # type: BlockingChannel
+        for q in self.queues:
+            self.chan.queue_declare(queue=q)
+
+    def consume(self, on_message: Callable[[Delivery], None], prefetch: Prefetch = 1):
+        """Call ``on_message`` with each job received, forever. Jobs must be acked / rejected from this thread."""
+        def callback(ch: BlockingChannel, method: spec.Basic.Deliver, properties: spec.BasicProperties, body: bytes):
+            log.debug(' -> Received ch: %s meth: %s props: %s body: %s', ch, method, properties, body)
+            on_message(RMQDelivery(ch, method, body))
+
+        if not isinstance(prefetch, dict):
+            # Limit the amount of unacknowledged messages across all of our queues, not per queue
+            self.chan.basic_qos(prefetch_count=prefetch, global_qos=True)
+        for q in self.queues:
+            if isinstance(prefetch, dict):
+                # basic_qos without global_qos applies to consumers started after it, giving each queue its own prefetch
+                self.chan.basic_qos(prefetch_count=prefetch[q])
+            self.chan.basic_consume(queue=q, on_message_callback=callback, auto_ack=False)
+        log.debug('Starting consuming for queues %s', self.queues)
+        self.chan.start_consuming()
+
+    def threadsafe(self, func: Callable):
+        """Run ``func`` on the consumer's thread - pika connections aren't thread safe"""
+        self.mq_conn.add_callback_threadsafe(func)
+
+
+class StreamDelivery(Delivery):
+    def __init__(self, consumer: 'RedisStreamConsumer', queue: str, msg_id: bytes, body: bytes):
+        super().__init__(queue, body)
+        self.consumer, self.msg_id = consumer, msg_id
+
+    def ack(self):
+        self.consumer.finish(self, remove=True)
+
+    def reject(self, requeue: bool = True):
+        # A requeued job is simply left pending in the consumer group - once it's no longer being refreshed,
+        # it's taken over by a runner after QUEUE_CLAIM_IDLE seconds, which counts towards QUEUE_MAX_DELIVERIES.
+        self.consumer.finish(self, remove=not requeue)
+
+
+class RedisStreamConsumer:
+    """
+    Consumes jobs from the Redis streams of one or more queues, as a member of the consumer group ``group``.
+
+    A background thread refreshes the jobs held by this consumer every few seconds (so that other runners
+    know it's still alive), and takes over jobs from consumers which haven't refreshed theirs for ``claim_idle``
+    seconds - unless they've already been taken over ``max_deliveries`` times, in which case they're dropped.
+
+        >>> c = RedisStreamConsumer(base.get_redis(), [base.RMQ_QUEUE_PING, base.RMQ_QUEUE_TRACE])
+        >>> c.consume(lambda d: print(d.queue, d.body) or d.ack())
+
+    """
+    def __init__(self, redis: Redis, queues: List[str], group: str = QUEUE_GROUP, name: str = None,
+                 claim_idle: int = QUEUE_CLAIM_IDLE, max_deliveries: int = QUEUE_MAX_DELIVERIES, block: float = 1.0):
+        self.redis, self.queues, self.group = redis, queues, group
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self.claim_idle, self.max_deliveries, self.block = claim_idle, max_deliveries, block
+        self.prefetch = 1   # type: Prefetch
+        self.running = False
+        self._inflight = {q: set() for q in queues}   # type: Dict[str, set]
+        self._backlog = deque()   # type: Deque[StreamDelivery]
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+
+    @staticmethod
+    def key(queue: str) -> str:
+        return STREAM_QUEUE_KEY.format(queue)
+
+    def setup(self):
+        """Create the consumer group for each queue (and the stream itself) if it doesn't exist yet"""
+        for q in self.queues:
+            try:
+                # Start from the beginning of the stream, so jobs added before the group existed are still ran
+                self.redis.xgroup_create(self.key(q), self.group, id='0', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    def free(self) -> Dict[str, int]:
+        """The amount of additional jobs this consumer may take from each queue right now"""
+        with self._lock:
+            if isinstance(self.prefetch, dict):
+                return {q: self.prefetch[q] - len(self._inflight[q]) for q in self.queues}
+            free = self.prefetch - sum(len(ids) for ids in self._inflight.values())
+            return {q: free for q in self.queues}
+
+    def _take(self, queue: str, msg_id: bytes, fields: Optional[dict]) -> Optional[StreamDelivery]:
+        if not fields or b'body' not in fields:
+            # The job was deleted from the stream after it was delivered - just remove it from the group
+            self.redis.xack(self.key(queue), self.group, msg_id)
+            return None
+        with self._lock:
+            self._inflight[queue].add(msg_id)
+        return StreamDelivery(self, queue, msg_id, fields[b'body'])
+
+    def finish(self, delivery: StreamDelivery, remove: bool = True):
+        """Stop refreshing ``delivery`` - and if ``remove`` is True, acknowledge it and delete it from the stream"""
+        with self._lock:
+            self._inflight[delivery.queue].discard(delivery.msg_id)
+        if remove:
+            key = self.key(delivery.queue)
+            p = self.redis.pipeline(transaction=True)
+            p.xack(key, self.group, delivery.msg_id)
+            p.xdel(key, delivery.msg_id)
+            p.execute()
+        self._wake.set()
+
+    def _read(self) -> List[StreamDelivery]:
+        free = self.free()
+        streams = {self.key(q): '>' for q in self.queues if free[q] > 0}
+        if len(streams) == 0:
+            self._wake.wait(self.block)
+            self._wake.clear()
+            return []
+        res = self.redis.xreadgroup(
+            self.group, self.name, streams, count=max(min(free[q] for q in self.queues if free[q] > 0), 1),
+            block=int(self.block * 1000)
+        )
+        deliveries = []
+        for key, messages in res or []:
+            queue = (key.decode() if isinstance(key, bytes) else key)[len(STREAM_QUEUE_KEY.format('')):]
+            for msg_id, fields in messages:
+                d = self._take(queue, msg_id, fields)
+                if d is not None:
+                    deliveries.append(d)
+        return deliveries
+
+    def refresh(self):
+        """Reset the idle time of the jobs held by this consumer, so that other runners don't take them over"""
+        with self._lock:
+            inflight = {q: list(ids) for q, ids in self._inflight.items() if len(ids) > 0}
+        for q, ids in inflight.items():
+            # JUSTID doesn't increase the delivery counter of the messages
+            self.redis.xclaim(self.key(q), self.group, self.name, 0, ids, justid=True)
+
+    def reclaim(self):
+        """Take over jobs from runners which haven't refreshed them for ``claim_idle`` seconds (i.e. they died)"""
+        if not self.running:
+            return
+        free, idle_ms = self.free(), self.claim_idle * 1000
+        for q in self.queues:
+            if free[q] <= 0:
+                continue
+            key, stale = self.key(q), []
+            with self._lock:
+                ours = set(self._inflight[q])
+            for p in self.redis.xpending_range(key, self.group, '-', '+', 100):
+                if p['time_since_delivered'] < idle_ms or p['message_id'] in ours:
+                    continue
+                # The first delivery counts as one, so a job which was taken over N times was delivered N + 1 times
+                if p['times_delivered'] > self.max_deliveries:
+                    log.error('Dropping job %s from queue %s - it was already taken over %d times',
+                              p['message_id'], q, p['times_delivered'] - 1)
+                    self.redis.xack(key, self.group, p['message_id'])
+                    self.redis.xdel(key, p['message_id'])
+                    continue
+                stale.append(p['message_id'])
+            if len(stale) == 0:
+                continue
+            for msg_id, fields in self.redis.xclaim(key, self.group, self.name, idle_ms, stale[:free[q]]):
+                if msg_id is None:
+                    continue
+                log.warning('Took over job %s from queue %s, which was idle for over %ds', msg_id, q, self.claim_idle)
+                d = self._take(q, msg_id, fields)
+                if d is not None:
+                    self._backlog.append(d)
+                    self._wake.set()
+
+    def _maintain(self):
+        # Keeps running until the consume loop has returned, so that the jobs being finished are still refreshed
+        while not self._closed.wait(max(self.claim_idle / 4, 0.5)):
+            try:
+                self.refresh()
+                self.reclaim()
+            except Exception:
+                log.exception('Error while refreshing / reclaiming jobs in Redis queues %s', self.queues)
+
+    def consume(self, on_message: Callable[[Delivery], None], prefetch: Prefetch = 1):
+        """Call ``on_message`` with each job received, until :meth:`.stop` is called"""
+        self.prefetch, self.running = prefetch, True
+        self.setup()
+        self._closed.clear()
+        threading.Thread(target=self._maintain, name='lg-queue-maintain', daemon=True).start()
+        log.debug('Starting consuming for Redis queues %s as %s (group %s)', self.queues, self.name, self.group)
+        try:
+            while self.running:
+                deliveries = []
+                while len(self._backlog) > 0:
+                    deliveries.append(self._backlog.popleft())
+                deliveries += self._read()
+                for d in deliveries:
+                    log.debug(' -> Received job %s from queue %s body: %s', d.msg_id, d.queue, d.body)
+                    on_message(d)
+        finally:
+            self._closed.set()
+
+    def stop(self):
+        self.running = False
+        self._wake.set()
+
+    def threadsafe(self, func: Callable):
+        """Redis connections are thread safe, so ``func`` is simply called from the current thread"""
+        func()
+
+
+def get_consumer(queues: List[str], redis: Redis, mq_conn: BlockingConnection = None,
+                 backend: str = QUEUE_BACKEND) -> Union[RMQConsumer, RedisStreamConsumer]:
+    """Create a consumer for ``queues``, using the queue backend ``backend`` (``rabbitmq`` or ``redis``)"""
+    if backend == 'redis':
+        return RedisStreamConsumer(redis, queues)
+    if mq_conn is None:
+        from lg.base import get_rmq
+        mq_conn = get_rmq()
+    return RMQConsumer(mq_conn, queues)
@@ -0,0 +1,185 @@
+"""
+
+Annotates the hops of a trace with their origin ASN, AS name and matched prefix from our own BGP table (the
+``prefix`` table maintained by ``./manage.py prefixes``), as well as the IXP (from ``IX_RANGES``) if the hop is
+on an exchange LAN.
+
+This replaces ``mtr -z``, which looks up the ASN of each hop live over DNS - adding seconds to every trace, and
+depending on outside resolvers. All hops of a trace are looked up with a single longest-prefix-match query, which
+is answered using the GiST ``inet_ops`` index on ``prefix.prefix``.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from lg.exceptions import IPNotFound
+from lg.lookingglass.settings import ENRICH_CACHE_SIZE, ENRICH_CACHE_TTL, TRACE_ENRICH
+from lg.peerapp.settings import PREFIX_TIMEOUT, find_ixp
+
+log = logging.getLogger(__name__)
+
+LPM_QUERY = """
+WITH newest AS (SELECT max(last_seen) AS last_seen FROM prefix)
+SELECT host(t.ip), p.prefix::text, p.asn_id, a.as_name
+FROM newest CROSS JOIN unnest(%(ips)s::inet[]) AS t(ip)
+JOIN LATERAL (
+    SELECT prefix, asn_id FROM prefix
+    WHERE prefix >>= t.ip
+      AND (newest.last_seen IS NULL OR last_seen >= newest.last_seen - %(timeout)s * interval '1 second')
+    ORDER BY masklen(prefix) DESC LIMIT 1
+) p ON true
+LEFT JOIN asn a ON a.asn = p.asn_id
+"""
+"""
+Longest-prefix-match for an array of IPs in one round trip. Prefixes which are stale (not seen in the last
+``PREFIX_TIMEOUT`` seconds before the newest import) are ignored, the same as on the ASN / prefix pages.
+"""
+
+EMPTY = dict(asn=None, as_name=None, prefix=None)
+
+
+class HopEnricher:
+    """
+    Looks up the origin ASN / AS name / prefix of IP addresses in the ``prefix`` table, keeping recent answers
+    in memory (``ENRICH_CACHE_SIZE`` IPs for ``ENRICH_CACHE_TTL`` seconds), since most traces share their first hops.
+
+    Basic usage::
+
+        >>> enricher = HopEnricher()
+        >>> enricher.lookup(['185.130.44.1'])
+        {'185.130.44.1': {'asn': 210083, 'as_name': 'Privex Inc.', 'prefix': '185.130.44.0/22'}}
+        >>> enricher.enrich(result['hops'])   # Adds asn / as_name / prefix / ixp to each hop in-place
+
+    The database connection is opened lazily, and shared between threads (queries are serialised using a lock).
+    """
+    def __init__(self, max_entries: int = ENRICH_CACHE_SIZE, ttl: int = ENRICH_CACHE_TTL):
+        self.max_entries, self.ttl = max_entries, ttl
+        self._cache = OrderedDict()   # type: OrderedDict[str, tuple]
+        self._conn = None
+        self._lock = threading.Lock()
+        # Hops are enriched from several threads at once (async runner executor / batch pool) - the cache has its
+        # own lock, so that cache hits don't have to wait for another thread's database query
+        self._cache_lock = threading.Lock()
+
+    def _connect(self):
+        import psycopg2
+        from lg.base import PG_CONF
+        conn = psycopg2.connect(connect_timeout=5, **PG_CONF)
+        conn.autocommit = True
+        return conn
+
+    def _query(self, ips: List[str]) -> Dict[str, dict]:
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None or self._conn.closed:
+                        self._conn = self._connect()
+                    with self._conn.cursor() as cur:
+                        cur.execute(LPM_QUERY, dict(ips=ips, timeout=PREFIX_TIMEOUT))
+                        rows = cur.fetchall()
+                    return {ip: dict(asn=asn, as_name=as_name, prefix=prefix) for ip, prefix, asn, as_name in rows}
+                except Exception:
+                    # The connection may have been dropped by the server since the last trace - reconnect once.
+                    if self._conn is not None:
+                        self._conn.close()
+                    self._conn = None
+                    if attempt > 0:
+                        raise
+
+    def _cache_get(self, ip: str) -> Optional[dict]:
+        with self._cache_lock:
+            entry = self._cache.get(ip)
+            if entry is None:
+                return None
+            expires, info = entry
+            if expires < time.time():
+                self._cache.pop(ip, None)
+                return None
+            self._cache.move_to_end(ip)
+            return info
+
+    def _cache_set(self, ip: str, info: dict):
+        if self.max_entries <= 0:
+            return
+        with self._cache_lock:
+            self._cache[ip] = (time.time() + self.ttl, info)
+            self._cache.move_to_end(ip)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def lookup(self, ips: Iterable[str]) -> Dict[str, dict]:
+        """
+        Find the origin ASN, AS name and most specific prefix for each IP in ``ips``.
+
+        :param ips: An iterable of IPv4 / IPv6 addresses as strings
+        :raises Exception: Any database error (e.g. if the database is unreachable)
+        :return dict info: A dict mapping each IP to ``{asn, as_name, prefix}`` (all ``None`` if it isn't routed)
+        """
+        res, missing = {}, []
+        for ip in set(ips):
+            info = self._cache_get(ip)
+            if info is None:
+                missing.append(ip)
+            else:
+                res[ip] = info
+        if len(missing) > 0:
+            found = self._query(sorted(missing))
+            for ip in missing:
+                res[ip] = found.get(ip, EMPTY)
+                self._cache_set(ip, res[ip])
+        return res
+
+    @staticmethod
+    def find_ixp(ip: str) -> Optional[str]:
+        """Returns the name of the IXP whose peering LAN ``ip`` is on, or ``None``"""
+        try:
+            return find_ixp(ip)[0]
+        except (IPNotFound, ValueError):
+            return None
+
+    def enrich(self, hops: List[dict]) -> List[dict]:
+        """
+        Set ``asn``, ``as_name``, ``prefix`` and ``ixp`` on each hop (as returned by :class:`.MtrRawParser`) in-place.
+        If the lookup fails, the hops are returned as-is - a trace should never fail because of its annotations.
+        """
+        ips = [h['ip'] for h in hops if h.get('ip')]
+        try:
+            info = self.lookup(ips) if len(ips) > 0 else {}
+        except Exception:
+            log.exception('Failed to look up the ASNs of trace hops %s', ips)
+            info = {}
+        for h in hops:
+            if not h.get('ip'):
+                continue
+            h.update(info.get(h['ip'], EMPTY))
+            h['ixp'] = self.find_ixp(h['ip'])
+        return hops
+
+
+__STORE = {}
+
+
+def get_enricher() -> Optional[HopEnricher]:
+    """Returns the shared :class:`.HopEnricher` for this process, or ``None`` if ``TRACE_ENRICH`` is disabled"""
+    if not TRACE_ENRICH:
+        return None
+    if 'enricher' not in __STORE:
+        __STORE['enricher'] = HopEnricher()
+    return __STORE['enricher']
@@ -1,10 +1,10 @@
-import ipaddress
 import re
-import dns.resolver
 import logging
+from dns.exception import DNSException
 from ipaddress import ip_address, IPv6Address, IPv4Address
-from typing import Union
-from lg.lookingglass.settings import DISALLOW_SUBNETS
+from typing import Union, Optional
+from lg.lookingglass.resolver import get_resolver
+from lg.lookingglass.settings import DISALLOW_MATCHER
 
 log = logging.getLogger(__name__)
 
@@ -106,26 +106,30 @@ def proto_check(ip: Union[str, IPv4Address, IPv6Address], proto=None):
     raise AttributeError('`proto` is not valid')
 
 
-def get_host_ip(host: str, proto='ipv4'):
+def get_host_ip(host: str, proto='ipv4') -> Optional[str]:
+    """
+    Resolve ``host`` into a single IPv4 (``proto='ipv4'``) or IPv6 (``proto='ipv6'``) address, using the
+    cached resolver from :py:mod:`lg.lookingglass.resolver`. Returns ``None`` if there's no such record.
+
+    :raises dns.exception.DNSException: When the nameservers timed out / failed to answer
+    """
     try:
-        dnsq = list(dns.resolver.query(host, recs[proto]))
-        return dnsq[0]
-    except (dns.resolver.NoAnswer, AttributeError, KeyError):
+        addrs = get_resolver().resolve(host, recs[proto])
+        return addrs[0] if len(addrs) > 0 else None
+    except (AttributeError, KeyError):
         return None
 
 
-def validate_host(host: str, proto: str = None) -> bool:
+def resolve_host(host: str, proto: str = None) -> Optional[str]:
     """
-    Returns True if a given host (hostname/ipv4/ipv6) is a valid hostname or IP address, and is not blacklisted
-    ( blacklisted means part of ``DISALLOW_SUBNETS`` )
+    Validate a given host (hostname/ipv4/ipv6) in the same way as :func:`.validate_host`, and return the
+    IP address which should be pinged / traced.
 
     ``proto`` is optional, can be one of: "ipv4", "ipv6", "v4", "v6", 4, 6, "IPv4" or "IPv6"
 
-    If proto is one of the above values,
-
     :param str host: A string network host, as a hostname, IPv4 address, or IPv6 address.
-    :param bool proto: If set, then this will return False if ``host`` is an IP, and does not match the passed version
-    :return bool is_valid: True if a host is valid, False if it's not.
+    :param bool proto: If set, then this will return None if ``host`` is an IP, and does not match the passed version
+    :return str|None ip: The IP address of ``host`` if it's valid and allowed, otherwise ``None``
     """
     if proto == 'any' or not proto:
         proto = None
@@ -133,26 +137,49 @@ def validate_host(host: str, proto: str = None) -> bool:
     # First check if it's an IP address
     log.debug('Checking if host "%s" is an IP address', host)
     if is_ip(host):
-        return proto_check(host, proto) and ip_allowed(host)
+        return host if proto_check(host, proto) and ip_allowed(host) else None
 
     # If it's not an IP, check if it's a hostname, look up it's IP, and compare to our disallowed subnets to be safe.
     log.debug('Checking if host "%s" is a valid hostname', host)
     if is_valid_hostname(host):
         log.debug('Looking up IP for host "%s"', host)
-
-        # Protocol is specified, if protocol is v4, check for an A record, and AAAA for IPv6 etc.
-        if proto is not None:
-            if proto not in recs: raise Exception('Invalid `proto` "{}"'.format(proto))
-            ip = get_host_ip(host, proto)
-            return False if ip is None else ip_allowed(ip)
-        # Protocol is not specified, try getting the AAAA record first, then fallback to A
-        v6_ip = get_host_ip(host, 'ipv6')
-        if v6_ip is not None: return ip_allowed(v6_ip)
-        v4_ip = get_host_ip(host, 'ipv4')
-        if v4_ip is not None: return ip_allowed(v4_ip)
+        try:
+            # Protocol is specified, if protocol is v4, check for an A record, and AAAA for IPv6 etc.
+            if proto is not None:
+                if proto not in recs: raise Exception('Invalid `proto` "{}"'.format(proto))
+                ip = get_host_ip(host, proto)
+            else:
+                # Protocol is not specified, try getting the AAAA record first, then fallback to A - also if the
+                # AAAA lookup failed (e.g. timed out), as the host may still have a perfectly good A record
+                try:
+                    ip = get_host_ip(host, 'ipv6')
+                except DNSException as e:
+                    log.info('AAAA lookup for host "%s" failed, trying A - %s %s', host, type(e), str(e))
+                    ip = None
+                ip = ip or get_host_ip(host, 'ipv4')
+        except DNSException as e:
+            log.warning('Failed to resolve host "%s" - %s %s', host, type(e), str(e))
+            return None
+        return ip if ip is not None and ip_allowed(ip) else None
 
     log.warning('Host "%s" is neither an IP nor a valid hostname.', host)
-    return False
+    return None
+
+
+def validate_host(host: str, proto: str = None) -> bool:
+    """
+    Returns True if a given host (hostname/ipv4/ipv6) is a valid hostname or IP address, and is not blacklisted
+    ( blacklisted means part of ``DISALLOW_SUBNETS`` )
+
+    ``proto`` is optional, can be one of: "ipv4", "ipv6", "v4", "v6", 4, 6, "IPv4" or "IPv6"
+
+    If proto is one of the above values,
+
+    :param str host: A string network host, as a hostname, IPv4 address, or IPv6 address.
+    :param bool proto: If set, then this will return False if ``host`` is an IP, and does not match the passed version
+    :return bool is_valid: True if a host is valid, False if it's not.
+    """
+    return resolve_host(host, proto) is not None
 
 
 def ip_allowed(ip: Union[str, IPv6Address, IPv4Address]) -> bool:
@@ -165,8 +192,4 @@ def ip_allowed(ip: Union[str, IPv6Address, IPv4Address]) -> bool:
     :param ip: An IPv4 / IPv6 address to check. Can be in string form, or IPv4Address/IPv6Address object.
     :return bool is_allowed: True if an IP is safe to use, False if it's part of the blacklisted subnets.
     """
-    ip = ipaddress.ip_address(ip)
-    for net in DISALLOW_SUBNETS:
-        if ip in net:
-            return False
-    return True
+    return ip not in DISALLOW_MATCHER
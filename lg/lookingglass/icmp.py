@@ -0,0 +1,209 @@
+"""
+
+In-process ICMP echo ("ping") engine, used by :class:`lg.lookingglass.runner.AsyncRunner` instead of spawning
+a ``ping`` process per request.
+
+Uses unprivileged ICMP datagram sockets (``SOCK_DGRAM`` + ``IPPROTO_ICMP`` / ``IPPROTO_ICMPV6``), which don't
+require root, as long as the runner's group is within the ``net.ipv4.ping_group_range`` sysctl::
+
+    # Allow all groups to create ICMP datagram sockets (the default on most modern distros)
+    sudo sysctl -w net.ipv4.ping_group_range="0 2147483647"
+
+All pings within a runner share a single socket per address family - replies are matched to their probe by their
+sequence number and source address. The output of each ping is generated in the same format as ``ping -n``,
+so that it can be parsed by :class:`lg.lookingglass.parsers.PingParser` exactly like the output of the binary.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import asyncio
+import ipaddress
+import logging
+import os
+import socket
+import struct
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from lg.lookingglass.settings import PING_COUNT, PING_INTERVAL, PING_WAIT
+
+log = logging.getLogger(__name__)
+
+PROTOS = {socket.AF_INET: socket.IPPROTO_ICMP, socket.AF_INET6: socket.IPPROTO_ICMPV6}
+ECHO_REQUEST = {socket.AF_INET: 8, socket.AF_INET6: 128}
+ECHO_REPLY = {socket.AF_INET: 0, socket.AF_INET6: 129}
+
+IP_RECVTTL = getattr(socket, 'IP_RECVTTL', 12)
+"""Python doesn't expose ``IP_RECVTTL`` - 12 is its value on Linux"""
+
+PAYLOAD_SIZE = 56
+"""Same payload size as ``ping`` - 64 byte ICMP packets"""
+
+_AVAILABLE = {}   # type: Dict[int, bool]
+
+
+def icmp_available(family: int = socket.AF_INET) -> bool:
+    """Returns ``True`` if this process may create unprivileged ICMP datagram sockets for ``family`` (cached)"""
+    if family not in _AVAILABLE:
+        try:
+            socket.socket(family, socket.SOCK_DGRAM, PROTOS[family]).close()
+            _AVAILABLE[family] = True
+        except OSError as e:
+            log.warning('Cannot create ICMP datagram socket (family %s): %s - falling back to ping binary', family, e)
+            _AVAILABLE[family] = False
+    return _AVAILABLE[family]
+
+
+class IcmpProber:
+    """
+    Sends ICMP echo requests and matches up the replies, for any amount of concurrent pings. Must be used from
+    within a running asyncio event loop - the sockets are opened lazily on the loop of the first ping.
+
+    Basic usage::
+
+        >>> prober = IcmpProber()
+        >>> async for line in prober.ping('185.130.44.1', count=3):
+        ...     print(line)
+        PING 185.130.44.1 (185.130.44.1) 56(84) bytes of data.
+        64 bytes from 185.130.44.1: icmp_seq=1 ttl=64 time=0.512 ms
+        ...
+        3 packets transmitted, 3 received, 0% packet loss
+
+    """
+    def __init__(self):
+        self._socks = {}   # type: Dict[int, socket.socket]
+        self._seq = {socket.AF_INET: 0, socket.AF_INET6: 0}
+        # (family, icmp seq) -> (future, target ip, time sent)
+        self._pending = {}   # type: Dict[Tuple[int, int], Tuple[asyncio.Future, str, float]]
+
+    def _socket(self, family: int) -> socket.socket:
+        if family not in self._socks:
+            sock = socket.socket(family, socket.SOCK_DGRAM, PROTOS[family])
+            sock.setblocking(False)
+            # Ask the kernel to pass along the TTL / hop limit of each reply
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_IP, IP_RECVTTL, 1)
+            else:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_RECVHOPLIMIT, 1)
+            asyncio.get_event_loop().add_reader(sock.fileno(), self._on_readable, family, sock)
+            self._socks[family] = sock
+        return self._socks[family]
+
+    def close(self):
+        loop = asyncio.get_event_loop()
+        for sock in self._socks.values():
+            loop.remove_reader(sock.fileno())
+            sock.close()
+        self._socks = {}
+
+    def _next_seq(self, family: int) -> int:
+        for _ in range(0x10000):
+            self._seq[family] = seq = (self._seq[family] + 1) & 0xffff
+            if (family, seq) not in self._pending:
+                return seq
+        raise OSError('No free ICMP sequence numbers - too many pings in progress')
+
+    def _on_readable(self, family: int, sock: socket.socket):
+        while True:
+            try:
+                data, anc, _, addr = sock.recvmsg(2048, socket.CMSG_SPACE(4))
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.debug('Error reading from ICMP socket: %s', e)
+                return
+            recv_at = time.time()
+            # With datagram sockets, the kernel strips the IP header (and rewrites the identifier to our own),
+            # so the data starts with the ICMP header: type, code, checksum, identifier, sequence
+            if len(data) < 8 or data[0] != ECHO_REPLY[family]:
+                continue
+            seq = struct.unpack('!H', data[6:8])[0]
+            probe = self._pending.get((family, seq))
+            if probe is None or probe[0].done() or addr[0] != probe[1]:
+                continue
+            ttl = None
+            for level, ctype, cdata in anc:
+                if len(cdata) >= 4:
+                    ttl = struct.unpack('i', cdata[:4])[0]
+                elif len(cdata) == 1:
+                    ttl = cdata[0]
+            probe[0].set_result((len(data), ttl, (recv_at - probe[2]) * 1000))
+
+    async def probe(self, ip: str, timeout: float = PING_WAIT) -> Optional[Tuple[int, Optional[int], float]]:
+        """
+        Send a single echo request to ``ip``, and wait up to ``timeout`` seconds for the reply.
+
+        :raises OSError: If the echo request could not be sent (e.g. ``Network is unreachable``)
+        :return tuple reply: ``(size, ttl, rtt_ms)`` - or ``None`` if no reply arrived in time
+        """
+        family = socket.AF_INET6 if ipaddress.ip_address(ip).version == 6 else socket.AF_INET
+        sock, seq = self._socket(family), self._next_seq(family)
+        fut = asyncio.get_event_loop().create_future()
+        payload = os.urandom(PAYLOAD_SIZE)
+        # The kernel fills in the identifier and checksum of datagram ICMP sockets
+        packet = struct.pack('!BBHHH', ECHO_REQUEST[family], 0, 0, 0, seq) + payload
+        self._pending[(family, seq)] = (fut, ip, time.time())
+        try:
+            sock.sendto(packet, (ip, 0))
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._pending.pop((family, seq), None)
+
+    async def ping(self, ip: str, count: int = PING_COUNT, interval: float = PING_INTERVAL,
+                   timeout: float = PING_WAIT) -> AsyncIterator[str]:
+        """
+        Ping ``ip`` ``count`` times (one echo request every ``interval`` seconds), yielding the output lines
+        in the same format as ``ping -n`` as the replies arrive, followed by the summary.
+
+        If the iteration is cancelled, any outstanding probes are cancelled with it.
+        """
+        ip = str(ipaddress.ip_address(ip))
+        results = asyncio.Queue()
+
+        async def send(icmp_seq: int):
+            try:
+                await results.put((icmp_seq, await self.probe(ip, timeout), None))
+            except OSError as e:
+                await results.put((icmp_seq, None, e))
+
+        async def send_all():
+            for i in range(1, count + 1):
+                probes.append(asyncio.ensure_future(send(i)))
+                if i < count:
+                    await asyncio.sleep(interval)
+
+        probes, recv, start = [], 0, time.time()
+        sender = asyncio.ensure_future(send_all())
+        yield f'PING {ip} ({ip}) {PAYLOAD_SIZE}({PAYLOAD_SIZE + 28}) bytes of data.'
+        try:
+            for _ in range(count):
+                icmp_seq, reply, err = await results.get()
+                if err is not None:
+                    yield f'ping: sendto {ip}: {err.strerror}'
+                elif reply is not None:
+                    size, ttl, rtt = reply
+                    recv += 1
+                    yield f'{size} bytes from {ip}: icmp_seq={icmp_seq} ttl={ttl or 0} time={rtt:.3f} ms'
+        finally:
+            sender.cancel()
+            for p in probes:
+                p.cancel()
+        loss = round((count - recv) / count * 100) if count > 0 else 0
+        yield ''
+        yield f'--- {ip} ping statistics ---'
+        yield f'{count} packets transmitted, {recv} received, {loss}% packet loss, ' \
+              f'time {int((time.time() - start) * 1000)}ms'
@@ -0,0 +1,392 @@
+"""
+
+Helpers for publishing / reading the live output of ping / trace requests, which is stored in a Redis stream
+per request (``lg_stream:<req_id>``).
+
+The runner publishes each line of ``ping`` output as a ``line`` event as soon as it's printed (and the partial,
+parsed ``mtr`` results as ``update`` events), followed by a single ``done`` event containing the final result once
+the command has finished.
+
+Once a request has finished, a token is also pushed onto the list ``lg_done:<req_id>``, allowing any number of
+clients to wait for the result using a blocking ``BLPOP`` (see :func:`.wait_done`).
+
+Running / queued requests can be cancelled by setting ``lg_cancel:<req_id>`` (see :func:`.cancel`), which the
+runners check while the request is running.
+
+Identical requests are de-duplicated using ``lg_inflight:<action>:<proto>:<host>`` keys, which point to the request
+ID of the measurement that duplicate requests are attached to (see :func:`.claim_job`). Every request sharing a
+measurement is listed in ``lg_shared:<req_id>``, so it's only cancelled once nobody else is waiting for it.
+
+Requests sent to several locations (``location=all``) are ran as one child request per location
+(``<req_id>@<location>``). As each child finishes, its result is collected under ``lg_fanout:<req_id>``, and
+published as a ``location`` event - once every location has finished, the combined result is saved as the result
+of the parent request (see :func:`.collect_location`).
+
+Requests and their results are stored under ``lg_request:<req_id>`` / ``lg_result:<req_id>``, and expire after
+:py:attr:`.RESULT_TTL` seconds.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import json
+import logging
+from typing import List, Optional, Tuple, Union
+
+from redis import Redis
+
+from lg.lookingglass.settings import STREAM_MAXLEN, STREAM_EXPIRE, DEDUP_WINDOW, DEDUP_MAX_RUNTIME, RESULT_TTL, \
+    BATCH_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+REQUEST_KEY = 'lg_request:{}'
+RESULT_KEY = 'lg_result:{}'
+STREAM_KEY = 'lg_stream:{}'
+DONE_KEY = 'lg_done:{}'
+INFLIGHT_KEY = 'lg_inflight:{}:{}:{}'
+CANCEL_KEY = 'lg_cancel:{}'
+FANOUT_KEY = 'lg_fanout:{}'
+SHARED_KEY = 'lg_shared:{}'
+
+_EXPIRE_IF_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+"""Set the TTL of ``KEYS[1]`` to ``ARGV[2]`` - only if it still holds ``ARGV[1]``"""
+
+StreamEvent = Tuple[str, str, Union[dict, str]]
+"""A decoded stream event: ``(event_id, event_type, data)``"""
+
+
+def request_key(req_id: str) -> str:
+    return REQUEST_KEY.format(req_id)
+
+
+def result_key(req_id: str) -> str:
+    return RESULT_KEY.format(req_id)
+
+
+def save_request(redis: Redis, req_id: str, data: dict):
+    """Store the details of the request ``req_id`` (expires after :py:attr:`.RESULT_TTL` seconds)"""
+    redis.set(request_key(req_id), json.dumps(data), ex=RESULT_TTL)
+
+
+def get_request(redis: Redis, req_id: str) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Load the details and results of the request ``req_id``. If the request is attached to an identical
+    request (``alias_of``), the results of that request are returned.
+
+    :return tuple req_res: ``(request, result)`` - either may be ``None`` if it doesn't exist (yet)
+    """
+    req, res = redis.pipeline(transaction=False).get(request_key(req_id)).get(result_key(req_id)).execute()
+    if req is None:
+        return None, None
+    req = json.loads(req)
+    if req.get('detached'):
+        # Cancelled while the measurement it shared kept running for other requests (see :func:`.cancel`)
+        return req, dict(status='cancelled', result=None)
+    if job_id(req) != req_id:
+        res = redis.get(result_key(job_id(req)))
+    return req, (None if res is None else json.loads(res))
+
+
+def get_result(redis: Redis, req_id: str) -> Optional[dict]:
+    res = redis.get(result_key(req_id))
+    return None if res is None else json.loads(res)
+
+
+def stream_key(req_id: str) -> str:
+    return STREAM_KEY.format(req_id)
+
+
+def done_key(req_id: str) -> str:
+    return DONE_KEY.format(req_id)
+
+
+def inflight_key(action: str, proto: str, host: str, location: str = None) -> str:
+    key = INFLIGHT_KEY.format(action, proto, host.strip().lower())
+    # Measurements from different locations are never shared
+    return f'{key}@{location}' if location else key
+
+
+def child_id(req_id: str, location: str) -> str:
+    """Returns the request ID of the part of the multi-location request ``req_id`` which runs in ``location``"""
+    return f'{req_id}@{location}'
+
+
+def job_id(req: dict) -> str:
+    """Returns the request ID whose results / stream should be used for the (decoded) request ``req``"""
+    return req.get('alias_of') or req['req_id']
+
+
+def claim_job(redis: Redis, action: str, proto: str, host: str, req_id: str, location: str = None) -> Optional[str]:
+    """
+    Attempt to register ``req_id`` as the measurement for ``(action, proto, host)``.
+
+        >>> leader = claim_job(get_redis(), 'trace', 'any', '8.8.4.4', req_id)
+        >>> if leader is None:
+        ...     # No identical measurement is running, or finished recently - queue this request for the runner
+        ... else:
+        ...     # Attach this request to ``leader`` instead of queueing it
+
+    :return str|None leader: ``None`` if ``req_id`` should be ran, otherwise the request ID of an identical
+                             in-flight / recently finished measurement which ``req_id`` should share results with.
+    """
+    if DEDUP_WINDOW <= 0:
+        return None
+    key = inflight_key(action, proto, host, location)
+    for _ in range(3):
+        if redis.set(key, req_id, nx=True, ex=DEDUP_WINDOW + DEDUP_MAX_RUNTIME):
+            return None
+        leader = redis.get(key)
+        # The key may have expired in-between SET and GET - if so, try to claim it again
+        if leader is not None:
+            return leader.decode() if isinstance(leader, bytes) else leader
+    return None
+
+
+def shared_key(req_id: str) -> str:
+    return SHARED_KEY.format(req_id)
+
+
+def share_job(redis: Redis, req_id: str, job: str):
+    """Record that the request ``req_id`` shares the results of the measurement ``job`` (which may be itself)"""
+    if DEDUP_WINDOW <= 0:
+        return
+    key = shared_key(job)
+    redis.pipeline(transaction=False).sadd(key, req_id).expire(key, RESULT_TTL).execute()
+
+
+def cancel(redis: Redis, req: dict) -> bool:
+    """
+    Ask the runners to cancel the (decoded) request ``req``. If it's queued, it will be skipped, and if it's running,
+    the ping / trace is killed, and any output so far is saved with the status ``cancelled``.
+
+    If other requests share the same measurement (see :func:`.claim_job`), it keeps running for them - only ``req``
+    is detached from it, and its status becomes ``cancelled``.
+
+    :return bool cancelled: ``False`` if the request has already finished, otherwise ``True``
+    """
+    req_id = job_id(req)
+    if req.get('detached') or redis.exists(result_key(req_id)):
+        return False
+    if 'locations' in req:
+        # Cancel the part of the request running in each location - the parent finishes once they've all stopped
+        p = redis.pipeline(transaction=False)
+        for loc in req['locations']:
+            p.set(CANCEL_KEY.format(child_id(req_id, loc)), 1, ex=DEDUP_MAX_RUNTIME)
+        p.execute()
+        return True
+    if 'host' not in req:
+        # Batch requests are never de-duplicated, so there's no in-flight key to clear
+        redis.set(CANCEL_KEY.format(req_id), 1, ex=max(DEDUP_MAX_RUNTIME, BATCH_TIMEOUT))
+        return True
+    # Atomically, so that when the last requests sharing a measurement are cancelled at once, one of them stops it
+    _, sharing = redis.pipeline().srem(shared_key(req_id), req['req_id']).scard(shared_key(req_id)).execute()
+    if sharing > 0:
+        save_request(redis, req['req_id'], {**req, 'detached': True})
+        return True
+    key = inflight_key(req['action'], req.get('proto', 'any'), req['host'], req.get('location'))
+    p = redis.pipeline(transaction=False)
+    p.set(CANCEL_KEY.format(req_id), 1, ex=DEDUP_MAX_RUNTIME)
+    p.get(key)
+    _, leader = p.execute()
+    # Stop new identical requests being attached to the cancelled request
+    if leader is not None and (leader.decode() if isinstance(leader, bytes) else leader) == req_id:
+        redis.delete(key)
+    return True
+
+
+def is_cancelled(redis: Redis, req_id: str) -> bool:
+    return bool(redis.exists(CANCEL_KEY.format(req_id)))
+
+
+def _publish(redis: Redis, req_id: str, kind: str, data: str, pipe=None):
+    key = stream_key(req_id)
+    p = redis.pipeline(transaction=False) if pipe is None else pipe
+    p.xadd(key, {'type': kind, 'data': data}, maxlen=STREAM_MAXLEN, approximate=True)
+    p.expire(key, STREAM_EXPIRE)
+    if pipe is None:
+        p.execute()
+
+
+def publish_line(redis: Redis, req_id: str, line: Union[bytes, str]):
+    """Publish a single line of ping / trace output for the request ``req_id``"""
+    line = line.decode(errors='replace') if isinstance(line, bytes) else line
+    _publish(redis, req_id, 'line', line.rstrip('\r\n'))
+
+
+def publish_event(redis: Redis, req_id: str, kind: str, data: Union[bytes, str, dict]):
+    """
+    Publish an event for the request ``req_id`` - either a ``line`` of output, or an ``update`` containing the
+    partial (structured) result so far
+    """
+    if kind == 'line':
+        return publish_line(redis, req_id, data)
+    _publish(redis, req_id, kind, json.dumps(data))
+
+
+def save_result(redis: Redis, req_id: str, data: dict, dedup_key: str = None):
+    """
+    Store the final result ``data`` of the request ``req_id``, publish it as the ``done`` event of the request's
+    stream, and wake up any clients waiting on :func:`.wait_done` - all in one round trip.
+
+    If ``dedup_key`` is given, identical requests will only be attached to this one for another
+    :py:attr:`.DEDUP_WINDOW` seconds - unless the key was cleared (e.g. by :func:`.cancel`), and has since been
+    claimed by another request.
+
+    If the request is part of a multi-location request (``data`` contains ``parent``), the result is also
+    collected into the parent request (see :func:`.collect_location`).
+    """
+    encoded = json.dumps(data)
+    p = redis.pipeline(transaction=False)
+    if dedup_key and DEDUP_WINDOW > 0:
+        p.eval(_EXPIRE_IF_LUA, 1, dedup_key, req_id, DEDUP_WINDOW)
+    p.set(result_key(req_id), encoded, ex=RESULT_TTL)
+    _publish(redis, req_id, 'done', encoded, pipe=p)
+    p.rpush(done_key(req_id), 1)
+    p.expire(done_key(req_id), STREAM_EXPIRE)
+    p.execute()
+    if data.get('parent'):
+        collect_location(redis, data['parent'], data['location'], data)
+
+
+def fanout_status(results: dict) -> str:
+    """The overall status of a multi-location request - ``cancelled`` / ``timeout`` / ``failed`` if any location was"""
+    statuses = {r.get('status') for r in results.values()}
+    for status in ('cancelled', 'timeout', 'failed'):
+        if status in statuses:
+            return status
+    return 'finished'
+
+
+def collect_location(redis: Redis, parent_id: str, location: str, data: dict) -> bool:
+    """
+    Collect the result ``data`` of the location ``location`` for the multi-location request ``parent_id``, and publish
+    it to the parent's stream as a ``location`` event. Once every location of the parent has a result, the combined
+    result is saved as the parent's own result::
+
+        {"result": {"se1": {"location": "se1", "status": "finished", "result": {...}}, "nl1": {...}},
+         "status": "finished"}
+
+    :return bool finished: ``True`` if this was the last location, and the parent's result was saved
+    """
+    key = FANOUT_KEY.format(parent_id)
+    entry = {k: v for k, v in data.items() if k != 'parent'}
+    p = redis.pipeline(transaction=True)
+    p.hset(key, location, json.dumps(entry))
+    p.expire(key, RESULT_TTL)
+    p.hgetall(key)
+    p.get(request_key(parent_id))
+    _, _, collected, parent = p.execute()
+    publish_event(redis, parent_id, 'location', entry)
+    if parent is None:
+        log.warning('Parent request %s of location %s has expired - not collecting result', parent_id, location)
+        return False
+    parent = json.loads(parent)
+    results = {(k.decode() if isinstance(k, bytes) else k): v for k, v in collected.items()}
+    results = {k: json.loads(v) for k, v in results.items() if k != '_done'}
+    if any(loc not in results for loc in parent['locations']):
+        return False
+    # Two locations may finish at the same time - only the first one to get here saves the combined result
+    if not redis.hsetnx(key, '_done', 1):
+        return False
+    combined = {loc: results[loc] for loc in parent['locations']}
+    res = dict(action=parent['action'], host=parent['host'], result=combined, status=fanout_status(combined))
+    save_result(redis, parent_id, res)
+    return True
+
+
+def wait_done(redis: Redis, req_id: str, timeout: int) -> bool:
+    """
+    Block for up to ``timeout`` seconds until the request ``req_id`` has finished.
+
+    The token popped from ``lg_done:<req_id>`` is pushed back straight away, so that other clients waiting on
+    the same request are woken up too.
+
+    :return bool finished: ``True`` if the request has finished, ``False`` if we timed out waiting
+    """
+    key = done_key(req_id)
+    if not redis.blpop([key], timeout=max(int(timeout), 1)):
+        return False
+    p = redis.pipeline(transaction=False)
+    p.rpush(key, 1)
+    p.expire(key, STREAM_EXPIRE)
+    p.execute()
+    return True
+
+
+def read_stream(redis: Redis, req_id: str, last_id: str = '0', block: int = None) -> List[StreamEvent]:
+    """
+    Read any events for the request ``req_id`` which were published after the event ID ``last_id``.
+
+        >>> for ev_id, kind, data in read_stream(get_redis(), req_id, block=15000):
+        ...     print(kind, data)
+
+    :param Redis redis: A Redis connection
+    :param str req_id: The request ID to read events for
+    :param str last_id: Only return events after this stream ID (``0`` = from the start)
+    :param int block: If there are no new events, wait up to this many milliseconds for one to arrive
+    :return List[StreamEvent] events: A list of ``(event_id, event_type, data)`` tuples. ``data`` is a ``str``
+                                      for ``line`` events, and a ``dict`` for ``update`` / ``done`` events.
+    """
+    res = redis.xread({stream_key(req_id): last_id}, block=block)
+    events = []
+    for _, entries in res:
+        for ev_id, fields in entries:
+            ev_id = ev_id.decode() if isinstance(ev_id, bytes) else ev_id
+            fields = {
+                (k.decode() if isinstance(k, bytes) else k): (v.decode() if isinstance(v, bytes) else v)
+                for k, v in fields.items()
+            }
+            kind, data = fields.get('type', 'line'), fields.get('data', '')
+            events.append((ev_id, kind, data if kind == 'line' else json.loads(data)))
+    return events
+
+
+def migrate_legacy(redis: Redis, batch: int = 500) -> Tuple[int, int]:
+    """
+    Move any requests / results from the legacy, never expiring ``lg_requests`` / ``lg_results`` hashes into
+    expiring per-request keys, then delete the hashes. Safe to run while the app is in use, and safe to re-run.
+
+    :param Redis redis: A Redis connection
+    :param int batch: Amount of hash entries to move per round trip
+    :return tuple counts: ``(requests_moved, results_moved)``
+    """
+    counts = []
+    for legacy, key_fmt in (('lg_requests', REQUEST_KEY), ('lg_results', RESULT_KEY)):
+        moved = 0
+        # HSCAN may return empty pages before the end of a large hash, so follow each scan until the cursor
+        # returns to 0 - and re-scan while anything is left (e.g. entries added by old web workers meanwhile)
+        while redis.hlen(legacy) > 0:
+            cursor = 0
+            while True:
+                cursor, entries = redis.hscan(legacy, cursor, count=batch)
+                if entries:
+                    p = redis.pipeline(transaction=False)
+                    for req_id, data in entries.items():
+                        req_id = req_id.decode() if isinstance(req_id, bytes) else req_id
+                        # Don't overwrite a key which was written since the upgrade
+                        p.set(key_fmt.format(req_id), data, ex=RESULT_TTL, nx=True)
+                    p.hdel(legacy, *entries.keys())
+                    p.execute()
+                    moved += len(entries)
+                    log.info('Moved %d entries from %s', moved, legacy)
+                if int(cursor) == 0:
+                    break
+        counts.append(moved)
+    return counts[0], counts[1]
@@ -0,0 +1,113 @@
+"""
+
+Registry of the locations (PoPs) which have runners online, used to route ``location=<id>`` / ``location=all``
+ping / trace requests to the queues of each location.
+
+Each runner started with a location (``LG_LOCATION`` / ``./manage.py queue --location``) registers itself under
+the hash ``lg_locations`` every ``LOCATION_HEARTBEAT`` seconds (see :class:`.LocationHeartbeat`), with the field
+``<location>|<runner>`` - and removes itself when it stops. Entries which haven't been refreshed for
+``LOCATION_TIMEOUT`` seconds (i.e. the runner was killed) are ignored, and removed by :func:`.active_locations`.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Dict, List
+
+from redis import Redis
+
+from lg.lookingglass.settings import LOCATION_HEARTBEAT, LOCATION_TIMEOUT
+
+log = logging.getLogger(__name__)
+
+LOCATIONS_KEY = 'lg_locations'
+
+
+def runner_name() -> str:
+    """A unique name for this runner process - ``<hostname>-<pid>``"""
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def register(redis: Redis, location: str, name: str, actions: List[str], runner: str = None):
+    """Register (or refresh) the runner ``runner`` as serving ``actions`` for the location ``location``"""
+    entry = dict(location=location, name=name or location, actions=list(actions), seen=int(time.time()))
+    redis.hset(LOCATIONS_KEY, f'{location}|{runner or runner_name()}', json.dumps(entry))
+
+
+def unregister(redis: Redis, location: str, runner: str = None):
+    redis.hdel(LOCATIONS_KEY, f'{location}|{runner or runner_name()}')
+
+
+def active_locations(redis: Redis, action: str = None) -> Dict[str, dict]:
+    """
+    Returns the locations which currently have runners online (optionally, only those serving ``action``)::
+
+        >>> active_locations(get_redis(), 'trace')
+        {'se1': {'name': 'Stockholm, SE', 'actions': ['ping', 'trace'], 'runners': 2}}
+
+    """
+    locations, stale, now = {}, [], time.time()
+    for field, value in redis.hgetall(LOCATIONS_KEY).items():
+        entry = json.loads(value)
+        if now - entry['seen'] > LOCATION_TIMEOUT:
+            stale.append(field)
+            continue
+        if action is not None and action not in entry['actions']:
+            continue
+        loc = locations.setdefault(entry['location'], dict(name=entry['name'], actions=[], runners=0))
+        loc['actions'] = sorted(set(loc['actions']) | set(entry['actions']))
+        loc['runners'] += 1
+    if len(stale) > 0:
+        redis.hdel(LOCATIONS_KEY, *stale)
+    return locations
+
+
+class LocationHeartbeat(threading.Thread):
+    """
+    Keeps a runner registered for its location while it's running::
+
+        >>> hb = LocationHeartbeat(get_redis(), 'se1', 'Stockholm, SE', ['ping', 'trace'])
+        >>> hb.start()
+        >>> try:
+        ...     runner.run()
+        ... finally:
+        ...     hb.stop()
+
+    """
+    def __init__(self, redis: Redis, location: str, name: str, actions: List[str], interval: int = LOCATION_HEARTBEAT):
+        super().__init__(name='lg-location-heartbeat', daemon=True)
+        self.redis, self.location, self.loc_name, self.actions = redis, location, name, actions
+        self.interval, self.runner = interval, runner_name()
+        self._stop_ev = threading.Event()
+
+    def run(self):
+        while not self._stop_ev.is_set():
+            try:
+                register(self.redis, self.location, self.loc_name, self.actions, self.runner)
+            except Exception:
+                log.exception('Failed to register runner %s for location %s', self.runner, self.location)
+            self._stop_ev.wait(self.interval)
+
+    def stop(self):
+        self._stop_ev.set()
+        try:
+            unregister(self.redis, self.location, self.runner)
+        except Exception:
+            log.exception('Failed to unregister runner %s from location %s', self.runner, self.location)
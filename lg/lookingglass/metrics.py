@@ -0,0 +1,189 @@
+"""
+
+Runner + web app instrumentation. As there are many web workers and runners (possibly on different servers), all
+metrics are recorded in Redis, and rendered in the Prometheus text format by the ``/metrics`` endpoint:
+
+ - ``lg_requests_total{action,outcome}`` - ping / trace / batch submissions to the API, and what happened to them
+   (``queued``, ``deduplicated``, ``invalid``, ``rate_limited``, ``queue_full``, ``queue_error``)
+ - ``lg_job_wait_seconds{action}`` - histogram of the time between a job being queued, and a runner starting it
+ - ``lg_job_duration_seconds{action}`` - histogram of the time taken to run each job
+ - ``lg_jobs_total{action,status}`` - jobs ran, by their final status (``finished``, ``timeout``, ``cancelled``,
+   ``invalid``, ``error``)
+ - ``lg_jobs_in_flight{action}`` - jobs currently being ran, across all runners
+ - ``lg_queue_depth{queue}`` - jobs waiting in each queue
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from redis import Redis
+
+from lg.lookingglass.settings import ACTION_TIMEOUTS, BATCH_TIMEOUT, METRICS_ENABLED
+
+log = logging.getLogger(__name__)
+
+METRICS_KEY = 'lg_metrics'
+"""Redis hash holding all counters / histogram buckets"""
+
+INFLIGHT_KEY = 'lg_metrics_inflight'
+"""Redis hash mapping ``<runner>|<action>`` to ``<jobs in flight>|<unix time of last change>``"""
+
+WAIT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+DURATION_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+HISTOGRAMS = {'wait': WAIT_BUCKETS, 'duration': DURATION_BUCKETS}
+
+INFLIGHT_STALE = max(list(ACTION_TIMEOUTS.values()) + [BATCH_TIMEOUT]) + 60
+"""
+In-flight counts of a runner which haven't changed for this many seconds (longer than any job may run) are
+ignored, as the runner must have died while running them.
+"""
+
+
+def _bucket(buckets: Tuple[float, ...], value: float) -> str:
+    for b in buckets:
+        if value <= b:
+            return str(b)
+    return 'inf'
+
+
+def count_request(redis: Redis, action: str, outcome: str):
+    """Count a ping / trace / batch submission to the API, with its ``outcome`` (e.g. ``queued``)"""
+    if not METRICS_ENABLED:
+        return
+    try:
+        redis.hincrby(METRICS_KEY, f'requests|{action}|{outcome}', 1)
+    except Exception:
+        log.exception('Failed to record request metrics')
+
+
+class RunnerMetrics:
+    """
+    Records the wait time, duration, outcome and in-flight count of the jobs ran by a single runner process.
+
+        >>> m = RunnerMetrics(redis)
+        >>> m.started('ping', act.get('queued_at'))
+        >>> m.finished('ping', 'finished', duration=4.2)
+
+    Errors while recording metrics are logged, and never affect the job itself.
+    """
+    def __init__(self, redis: Redis, name: str = None, enabled: bool = METRICS_ENABLED):
+        self.redis, self.enabled = redis, enabled
+        self.name = name or f'{socket.gethostname()}-{os.getpid()}'
+        self._inflight = defaultdict(int)   # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def _observe(self, p, hist: str, action: str, value: float):
+        p.hincrby(METRICS_KEY, f'{hist}_bucket|{action}|{_bucket(HISTOGRAMS[hist], value)}', 1)
+        p.hincrbyfloat(METRICS_KEY, f'{hist}_sum|{action}', value)
+
+    def _set_inflight(self, p, action: str, delta: int):
+        with self._lock:
+            self._inflight[action] += delta
+            count = self._inflight[action]
+        p.hset(INFLIGHT_KEY, f'{self.name}|{action}', f'{count}|{int(time.time())}')
+
+    def started(self, action: str, queued_at: Optional[float] = None):
+        """Call when a runner starts running a job, with the unix time it was queued at (if known)"""
+        if not self.enabled:
+            return
+        try:
+            p = self.redis.pipeline(transaction=False)
+            if queued_at is not None:
+                self._observe(p, 'wait', action, max(time.time() - float(queued_at), 0.0))
+            self._set_inflight(p, action, 1)
+            p.execute()
+        except Exception:
+            log.exception('Failed to record job start metrics')
+
+    def finished(self, action: str, status: str, duration: float):
+        """Call when a runner has finished a job (successfully or not), with its final status"""
+        if not self.enabled:
+            return
+        try:
+            p = self.redis.pipeline(transaction=False)
+            self._observe(p, 'duration', action, duration)
+            p.hincrby(METRICS_KEY, f'jobs|{action}|{status}', 1)
+            self._set_inflight(p, action, -1)
+            p.execute()
+        except Exception:
+            log.exception('Failed to record job finish metrics')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+def _family(name: str, mtype: str, helptext: str) -> List[str]:
+    return [f'# HELP {name} {helptext}', f'# TYPE {name} {mtype}']
+
+
+def render(redis: Redis, queue_depths: Dict[str, int] = None) -> str:
+    """Render all metrics stored in Redis (plus the given ``queue_depths``) in the Prometheus text format"""
+    p = redis.pipeline(transaction=False)
+    p.hgetall(METRICS_KEY)
+    p.hgetall(INFLIGHT_KEY)
+    raw, raw_inflight = p.execute()
+    counters = defaultdict(dict)   # type: Dict[str, Dict[tuple, float]]
+    for field, value in raw.items():
+        kind, *labels = field.decode().split('|')
+        counters[kind][tuple(labels)] = float(value)
+
+    def num(v: float) -> str:
+        return str(int(v)) if float(v).is_integer() else repr(v)
+
+    out = _family('lg_requests_total', 'counter', 'Ping / trace submissions to the API, by action and outcome')
+    for (action, outcome), v in sorted(counters['requests'].items()):
+        out.append(f'lg_requests_total{_labels(action=action, outcome=outcome)} {num(v)}')
+
+    out += _family('lg_jobs_total', 'counter', 'Jobs ran by the runners, by action and final status')
+    for (action, status), v in sorted(counters['jobs'].items()):
+        out.append(f'lg_jobs_total{_labels(action=action, status=status)} {num(v)}')
+
+    for hist, helptext in (('wait', 'Seconds between a job being queued, and a runner starting it'),
+                           ('duration', 'Seconds taken by the runners to run each job')):
+        name = f'lg_job_{hist}_seconds'
+        out += _family(name, 'histogram', helptext)
+        buckets = counters[f'{hist}_bucket']
+        for action in sorted({a for a, _ in buckets.keys()}):
+            total = 0.0
+            for b in [str(b) for b in HISTOGRAMS[hist]] + ['inf']:
+                total += buckets.get((action, b), 0)
+                le = '+Inf' if b == 'inf' else b
+                out.append(f'{name}_bucket{_labels(action=action, le=le)} {num(total)}')
+            out.append(f'{name}_sum{_labels(action=action)} {num(counters[f"{hist}_sum"].get((action,), 0.0))}')
+            out.append(f'{name}_count{_labels(action=action)} {num(total)}')
+
+    inflight, now = defaultdict(int), time.time()
+    for field, value in raw_inflight.items():
+        _, action = field.decode().rsplit('|', 1)
+        count, updated = value.decode().split('|')
+        if now - int(updated) < INFLIGHT_STALE:
+            inflight[action] += int(count)
+    out += _family('lg_jobs_in_flight', 'gauge', 'Jobs currently being ran by the runners, by action')
+    for action, v in sorted(inflight.items()):
+        out.append(f'lg_jobs_in_flight{_labels(action=action)} {v}')
+
+    if queue_depths:
+        out += _family('lg_queue_depth', 'gauge', 'Jobs waiting in each queue to be picked up by a runner')
+        for queue, v in sorted(queue_depths.items()):
+            out.append(f'lg_queue_depth{_labels(queue=queue)} {v}')
+    return '\n'.join(out) + '\n'
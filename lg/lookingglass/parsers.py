@@ -0,0 +1,171 @@
+"""
+
+Parsers which turn the output of ``mtr --raw`` and ``ping`` into compact, structured results, so that clients
+don't need to parse ASCII tables.
+
+Both parsers are fed one line of output at a time, as the command prints it, so that partial results are
+available while the command is running (and if it's killed due to a timeout / cancellation).
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import math
+import re
+import time
+from typing import Dict, List, Optional, Tuple, Union
+
+StreamEvent = Optional[Tuple[str, Union[str, dict]]]
+"""An event to publish to the request's stream - ``(event_type, data)`` - or ``None`` if there's nothing new"""
+
+
+def _stats(rtts: List[float]) -> dict:
+    """Calculate min/avg/max/stdev (in ms, rounded to 3 decimals) for a list of round trip times in ms"""
+    if len(rtts) == 0:
+        return dict(min=None, avg=None, max=None, stdev=None)
+    avg = sum(rtts) / len(rtts)
+    stdev = math.sqrt(sum((r - avg) ** 2 for r in rtts) / len(rtts))
+    return dict(min=round(min(rtts), 3), avg=round(avg, 3), max=round(max(rtts), 3), stdev=round(stdev, 3))
+
+
+class MtrRawParser:
+    """
+    Parses the output of ``mtr --raw``, which prints one line per event, e.g.::
+
+        x 0 33000          # probe sent to hop 0 (seq 33000)
+        h 0 185.130.44.1   # hop 0 is 185.130.44.1
+        d 0 router.example # hop 0 reverse DNS
+        p 0 1234 33000     # reply from hop 0 after 1234 microseconds (seq 33000)
+
+    Result format (one dict per hop, ``ip`` is ``None`` for hops which never replied)::
+
+        {
+            "hops": [
+                {"hop": 1, "ip": "185.130.44.1", "host": "router.example", "asn": null, "as_name": null,
+                 "prefix": null, "ixp": null, "sent": 10, "recv": 10, "loss": 0.0, "last": 1.2, "min": 1.1,
+                 "avg": 1.2, "max": 1.5, "stdev": 0.1},
+                ...
+            ],
+            "errors": []
+        }
+
+    The ``asn`` / ``as_name`` / ``prefix`` / ``ixp`` of each hop are filled in once the trace has finished, by
+    :class:`lg.lookingglass.enrich.HopEnricher`.
+
+    :param int cycles: The amount of pings sent to each hop (``mtr -c``) - only used if mtr doesn't print ``x`` lines
+    :param float update_interval: :meth:`.feed` returns an ``update`` event at most once per this many seconds
+    """
+    def __init__(self, cycles: int = 10, update_interval: float = 0.5):
+        self.cycles, self.update_interval = cycles, update_interval
+        self.hops = {}   # type: Dict[int, dict]
+        self.errors = []   # type: List[str]
+        self._sent_seen = False
+        self._last_update = 0.0
+
+    def _hop(self, pos: int) -> dict:
+        if pos not in self.hops:
+            self.hops[pos] = dict(ip=None, alt=[], host=None, sent=0, rtts=[], last=None)
+        return self.hops[pos]
+
+    def feed(self, line: Union[str, bytes]) -> StreamEvent:
+        line = line.decode(errors='replace') if isinstance(line, bytes) else line
+        parts = line.split()
+        if len(parts) < 3 or not parts[1].isdigit():
+            # Anything other than raw output is an error message from mtr (e.g. an unreachable / unknown host)
+            if line.strip() and len(self.errors) < 20:
+                self.errors.append(line.strip())
+            return None
+        kind, hop = parts[0], self._hop(int(parts[1]))
+        if kind == 'x':
+            self._sent_seen = True
+            hop['sent'] += 1
+        elif kind == 'h':
+            if hop['ip'] is not None and hop['ip'] != parts[2] and hop['ip'] not in hop['alt']:
+                hop['alt'].append(hop['ip'])
+            hop['ip'] = parts[2]
+        elif kind == 'd':
+            hop['host'] = parts[2]
+        elif kind == 'p' and parts[2].isdigit():
+            hop['last'] = int(parts[2]) / 1000
+            hop['rtts'].append(hop['last'])
+        else:
+            return None
+
+        if time.time() - self._last_update < self.update_interval:
+            return None
+        self._last_update = time.time()
+        return 'update', self.result()
+
+    def result(self) -> dict:
+        hops = []
+        for pos in range(max(self.hops.keys(), default=-1) + 1):
+            h = self._hop(pos)
+            sent = h['sent'] if self._sent_seen else max(self.cycles, len(h['rtts']))
+            recv = len(h['rtts'])
+            loss = round((sent - recv) / sent * 100, 1) if sent > 0 else 0.0
+            hop = dict(
+                hop=pos + 1, ip=h['ip'], host=h['host'], asn=None, as_name=None, prefix=None, ixp=None,
+                sent=sent, recv=recv, loss=max(loss, 0.0), last=h['last'], **_stats(h['rtts'])
+            )
+            if h['alt']:
+                hop['alt'] = h['alt']
+            hops.append(hop)
+        return dict(hops=hops, errors=self.errors)
+
+
+class PingParser:
+    """
+    Parses the output of ``ping -n``. Each line is passed through as a ``line`` event, while the replies and summary
+    are collected into a result like so::
+
+        {
+            "sent": 5, "recv": 5, "loss": 0.0, "min": 1.1, "avg": 1.2, "max": 1.5, "stdev": 0.1,
+            "replies": [{"seq": 1, "ttl": 117, "time": 1.2}, ...],
+            "errors": []
+        }
+
+    If ``ping`` was killed before printing its summary, the stats are calculated from the replies received so far.
+    """
+    REPLY = re.compile(r'icmp_seq=(\d+)\s+ttl=(\d+)\s+time=([\d.]+)\s*ms')
+    SENT = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?received')
+    RTT = re.compile(r'= ([\d.]+)/([\d.]+)/([\d.]+)/([\d.]+) ms')
+    ERROR = re.compile(r'(unreachable|time to live exceeded|unknown host|not known|failure)', re.IGNORECASE)
+
+    def __init__(self):
+        self.replies, self.errors = [], []   # type: List[dict], List[str]
+        self.summary = {}
+
+    def feed(self, line: Union[str, bytes]) -> StreamEvent:
+        line = (line.decode(errors='replace') if isinstance(line, bytes) else line).rstrip('\r\n')
+        m = self.REPLY.search(line)
+        if m:
+            self.replies.append(dict(seq=int(m.group(1)), ttl=int(m.group(2)), time=float(m.group(3))))
+        elif self.SENT.search(line):
+            m = self.SENT.search(line)
+            self.summary['sent'], self.summary['recv'] = int(m.group(1)), int(m.group(2))
+        elif self.RTT.search(line):
+            mn, avg, mx, sd = (float(v) for v in self.RTT.search(line).groups())
+            self.summary.update(min=mn, avg=avg, max=mx, stdev=sd)
+        elif self.ERROR.search(line):
+            self.errors.append(line.strip())
+        return 'line', line
+
+    def result(self) -> dict:
+        sent = self.summary.get('sent', max([r['seq'] for r in self.replies], default=0))
+        recv = self.summary.get('recv', len(self.replies))
+        res = dict(sent=sent, recv=recv, loss=round((sent - recv) / sent * 100, 1) if sent > 0 else 0.0)
+        res.update(_stats([r['time'] for r in self.replies]))
+        res.update({k: v for k, v in self.summary.items() if k in ('min', 'avg', 'max', 'stdev')})
+        res.update(replies=self.replies, errors=self.errors)
+        return res
@@ -0,0 +1,108 @@
+"""
+
+Per-client token bucket rate limiting for ping / trace / batch submissions, shared between all web workers.
+
+Each ``(action, client)`` has a bucket of up to ``burst`` tokens, stored in the Redis hash
+``lg_ratelimit:<action>:<client>``, which refills at the configured rate (see ``RATE_LIMITS``). Each request takes
+a token - if the bucket is empty, the request is refused, and the client is told how long until a token is
+available. The refill + take is done atomically by a Lua script, using the Redis server's clock, so
+concurrent requests from several web workers / servers can never take the same token.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import logging
+import math
+from typing import Dict, Tuple
+
+from redis import Redis
+
+from lg.lookingglass.settings import RATE_LIMITS
+
+log = logging.getLogger(__name__)
+
+RATE_LIMIT_KEY = 'lg_ratelimit:{}:{}'
+
+TOKEN_BUCKET = """
+-- Redis < 5 only allows writes after TIME once effects replication is enabled (it's always enabled on 5+)
+if redis.replicate_commands then redis.replicate_commands() end
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens, ts = tonumber(state[1]) or burst, tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed, wait = 0, (cost - tokens) / rate
+if tokens >= cost then
+    tokens, allowed, wait = tokens - cost, 1, 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+"""
+"""
+Refill the bucket ``KEYS[1]`` by ``rate`` tokens per second (up to ``burst``), then take ``cost`` tokens if there are
+enough. Returns ``{allowed, seconds until enough tokens are available}``. Buckets expire once they'd be full again.
+"""
+
+
+class RateLimiter:
+    """
+    Checks clients against the per-action token buckets in ``limits`` (``action -> (per minute, burst)``)::
+
+        >>> limiter = RateLimiter(get_redis())
+        >>> limiter.hit('trace', '203.0.113.5')
+        (True, 0)
+        >>> # ... once the client has used up its burst:
+        >>> limiter.hit('trace', '203.0.113.5')
+        (False, 8)      # Refused - a token will be available in 8 seconds
+
+    If Redis is unavailable, requests are allowed (and the error logged), rather than refusing every request.
+    """
+    def __init__(self, redis: Redis, limits: Dict[str, Tuple[float, int]] = None):
+        self.redis, self.limits = redis, RATE_LIMITS if limits is None else limits
+        self.script = redis.register_script(TOKEN_BUCKET)
+
+    def hit(self, action: str, client: str, cost: int = 1, multiplier: float = 1.0) -> Tuple[bool, int]:
+        """
+        Take ``cost`` tokens from the bucket of ``client`` for ``action``.
+
+        :param action: The action being submitted (``ping`` / ``trace`` / ``batch``)
+        :param client: Identifies the client, e.g. its IP address, or ``key:<api key>``
+        :param cost: Tokens to take (i.e. how many requests this counts as)
+        :param multiplier: Multiply the rate and burst of ``action`` by this (e.g. for clients with an API key)
+        :return tuple allowed: ``(allowed, retry_after)`` - if ``allowed`` is ``False``, ``retry_after`` is the
+                               amount of seconds until the client may try again
+        """
+        per_minute, burst = self.limits.get(action, (0, 0))
+        if per_minute <= 0:
+            return True, 0
+        rate, burst = per_minute * multiplier / 60, max(int(burst * multiplier), cost)
+        try:
+            allowed, wait = self.script(keys=[RATE_LIMIT_KEY.format(action, client)], args=[rate, burst, cost])
+        except Exception:
+            log.exception('Failed to check rate limit of %s for %s - allowing request', client, action)
+            return True, 0
+        return bool(allowed), int(math.ceil(float(wait)))
+
+
+__STORE = {}
+
+
+def get_limiter(redis: Redis) -> RateLimiter:
+    """Returns the shared :class:`.RateLimiter` for this process, creating it if it doesn't exist yet"""
+    if 'limiter' not in __STORE:
+        __STORE['limiter'] = RateLimiter(redis)
+    return __STORE['limiter']
@@ -0,0 +1,141 @@
+"""
+
+Cached DNS resolution for the looking glass.
+
+Answers are cached in memory (per process), and in Redis (shared between web workers and runners), for as long
+as the TTL of the DNS record - clamped between ``DNS_MIN_TTL`` and ``DNS_MAX_TTL``. Hostnames which don't exist,
+or have no record of the requested type, are cached for ``DNS_NEGATIVE_TTL`` seconds.
+
+Every query is bounded by ``DNS_TIMEOUT`` seconds, so a slow nameserver can't tie up a web worker.
+
+Basic usage::
+
+    >>> from lg.lookingglass.resolver import get_resolver
+    >>> get_resolver().resolve('www.privex.io', 'AAAA')
+    ['2a07:e00::333']
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import dns.exception
+import dns.resolver
+from redis import Redis, RedisError
+
+from lg.lookingglass.settings import DNS_TIMEOUT, DNS_MIN_TTL, DNS_MAX_TTL, DNS_NEGATIVE_TTL, DNS_CACHE_SIZE
+
+log = logging.getLogger(__name__)
+
+DNS_KEY = 'lg_dns:{}:{}'
+
+
+class CachedResolver:
+    """
+    A DNS resolver which caches answers in memory and in Redis, for the TTL of the answer.
+
+    :param Redis redis: A Redis connection used for the shared cache. If ``None``, only the in-memory cache is used.
+    :param float timeout: Maximum amount of seconds that a single uncached query may take
+    :param int max_entries: Maximum amount of answers to keep in memory (least recently used are evicted first)
+    """
+    def __init__(self, redis: Redis = None, timeout: float = DNS_TIMEOUT, max_entries: int = DNS_CACHE_SIZE):
+        self.redis, self.max_entries = redis, max_entries
+        self.resolver = dns.resolver.Resolver()
+        self.resolver.lifetime = timeout
+        self._mem = OrderedDict()   # type: OrderedDict[Tuple[str, str], Tuple[float, List[str]]]
+        self._lock = threading.Lock()
+
+    def _mem_get(self, key: Tuple[str, str]) -> Optional[List[str]]:
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is None:
+                return None
+            expires, addrs = entry
+            if expires < time.time():
+                del self._mem[key]
+                return None
+            self._mem.move_to_end(key)
+            return addrs
+
+    def _mem_set(self, key: Tuple[str, str], addrs: List[str], ttl: int):
+        with self._lock:
+            self._mem[key] = (time.time() + ttl, addrs)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.max_entries:
+                self._mem.popitem(last=False)
+
+    def _query(self, host: str, rtype: str) -> Tuple[List[str], int]:
+        """Query the nameservers for ``host`` - returns the addresses, and how long they may be cached for"""
+        try:
+            answer = self.resolver.query(host, rtype)
+            ttl = min(max(answer.rrset.ttl, DNS_MIN_TTL), DNS_MAX_TTL)
+            return [str(rr) for rr in answer], ttl
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+            return [], DNS_NEGATIVE_TTL
+
+    def resolve(self, host: str, rtype: str = 'A') -> List[str]:
+        """
+        Resolve ``host`` into a list of IP addresses, using the cache where possible.
+
+        :param str host: The hostname to resolve
+        :param str rtype: The record type to look up, i.e. ``A`` or ``AAAA``
+        :raises dns.exception.Timeout: When the nameservers didn't answer within the timeout
+        :raises dns.resolver.NoNameservers: When all nameservers failed to answer the query
+        :return List[str] addresses: The addresses ``host`` resolves to (empty if it doesn't exist / has no record)
+        """
+        host = host.strip().lower().rstrip('.')
+        key = (host, rtype)
+        addrs = self._mem_get(key)
+        if addrs is not None:
+            return addrs
+
+        rkey = DNS_KEY.format(rtype, host)
+        if self.redis is not None:
+            try:
+                p = self.redis.pipeline(transaction=False)
+                cached, ttl = p.get(rkey).ttl(rkey).execute()
+                if cached is not None and ttl > 0:
+                    addrs = json.loads(cached)
+                    self._mem_set(key, addrs, ttl)
+                    return addrs
+            except RedisError:
+                log.warning('Error reading DNS cache from Redis for %s %s', rtype, host, exc_info=True)
+
+        t = time.time()
+        addrs, ttl = self._query(host, rtype)
+        log.debug('Resolved %s %s to %s in %.3f sec (caching for %d sec)', rtype, host, addrs, time.time() - t, ttl)
+        self._mem_set(key, addrs, ttl)
+        if self.redis is not None:
+            try:
+                self.redis.set(rkey, json.dumps(addrs), ex=ttl)
+            except RedisError:
+                log.warning('Error saving DNS cache to Redis for %s %s', rtype, host, exc_info=True)
+        return addrs
+
+
+_resolver = {}
+
+
+def get_resolver() -> CachedResolver:
+    """Get the process-wide :class:`.CachedResolver` (backed by the Redis connection from :py:mod:`lg.base`)"""
+    if 'resolver' not in _resolver:
+        from lg.base import get_redis
+        _resolver['resolver'] = CachedResolver(redis=get_redis())
+    return _resolver['resolver']
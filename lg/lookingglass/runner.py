@@ -17,46 +17,75 @@ Copyright::
     +===================================================+
 
 """
+import asyncio
+import functools
 import json
 import logging
+import os
+import signal
+import socket
 import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from json import JSONDecodeError
+from typing import AsyncIterator, Dict, Optional, Tuple, List, Union
 
-from pika import spec
-from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
+from pika.adapters.blocking_connection import BlockingConnection
 from redis import Redis
 
 from lg.exceptions import InvalidHostException, MissingArgsException
-from lg.lookingglass.helpers import validate_host, v4_protos, v6_protos
+from lg.lookingglass.helpers import resolve_host, v4_protos, v6_protos
+from lg.lookingglass import jobs
+from lg.lookingglass.consumers import Delivery, RMQConsumer, RedisStreamConsumer, get_consumer
+from lg.lookingglass.enrich import get_enricher
+from lg.lookingglass.icmp import IcmpProber, icmp_available
+from lg.lookingglass.metrics import RunnerMetrics
+from lg.lookingglass.parsers import MtrRawParser, PingParser
+from lg.lookingglass.settings import ACTION_TIMEOUTS, CANCEL_POLL, TRACE_CYCLES, PING_COUNT, PING_ENGINE, \
+    BATCH_CONCURRENCY, BATCH_TIMEOUT
 
 log = logging.getLogger(__name__)
 
 
 class Runner:
+    """
+    Consumes ping / trace requests from one or more queues, and runs them one at a time.
 
-    def __init__(self, mq_conn: BlockingConnection, queue: str, redis: Redis):
+    The queues are consumed from RabbitMQ or Redis Streams, depending on ``QUEUE_BACKEND`` (see
+    :mod:`lg.lookingglass.consumers`) - ``mq_conn`` is only required for RabbitMQ.
+
+    When running the looking glass across several locations, each location's runners consume their own queues
+    (see :func:`lg.base.location_queue`), e.g. ``queue=['privexlg@se1', 'privexlg_trace@se1']``.
+
+        >>> queues = [base.RMQ_QUEUE_PING, base.RMQ_QUEUE_TRACE]
+        >>> r = Runner(mq_conn=base.get_rmq(), queue=queues, redis=base.get_redis())
+        >>> r.run()
+
+    """
+    def __init__(self, mq_conn: Optional[BlockingConnection], queue: Union[str, List[str]], redis: Redis,
+                 consumer: Union[RMQConsumer, RedisStreamConsumer] = None):
         log.debug('Runner initialising...')
-        self.mq_conn, self.queue, self.redis = mq_conn, queue, redis
+        self.mq_conn, self.redis = mq_conn, redis
+        self.queues = [queue] if isinstance(queue, str) else list(queue)
+        self.queue = self.queues[0]
 
         self.ACTIONS = {
             'trace': self.trace,
-            'ping': self.ping
+            'ping': self.ping,
+            'batch': self.batch,
         }
 
-        chan = self.chan = mq_conn.channel()   # type: BlockingChannel
-        chan.queue_declare(queue=queue)
+        self.consumer = consumer if consumer is not None else get_consumer(self.queues, redis, mq_conn)
+        self.metrics = RunnerMetrics(redis)
 
     def run(self, msg_count: int = 1):
-        log.debug('Preparing to consume from queue %s', self.queue)
+        log.debug('Preparing to consume from queues %s', self.queues)
+        # Limit the amount of unacknowledged messages across all of our queues, not per queue
+        self.consumer.consume(self.on_message, prefetch=msg_count)
 
-        chan = self.chan
-        chan.basic_qos(prefetch_count=msg_count)
-        chan.basic_consume(queue=self.queue, on_message_callback=self.callback, auto_ack=False)
-        log.debug('Starting consuming for queue %s', self.queue)
-        chan.start_consuming()
-
-    def callback(self, ch: BlockingChannel, method: spec.Basic.Deliver, properties: spec.BasicProperties, body: bytes):
-        log.debug(' -> Received ch: %s meth: %s props: %s body: %s', ch, method, properties, body)
+    def decode(self, body: bytes) -> Optional[dict]:
+        """Decode a message body into an action dict, returns ``None`` if the body / action is invalid"""
         b = body.decode()
         try:
             # General format: {req_id, action, host}
@@ -67,107 +96,481 @@ class Runner:
                 raise ValueError('"action" was not in decoded json object...')
             if act['action'] not in self.ACTIONS:
                 raise ValueError('Action "{}" is not a valid action...'.format(act['action']))
+            return act
         except (JSONDecodeError, TypeError, ValueError, AttributeError):
             log.exception('Error decoding json for %s', b)
-            return ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return None
 
-        try:
-            run_act = self.ACTIONS[act['action']](**act)
+    @staticmethod
+    def settle(delivery: Delivery, run_act: bool = False, exc: BaseException = None):
+        """Acknowledge (or reject) a message, based on the return value / exception of the action which handled it"""
+        if exc is None:
             if run_act:
                 log.debug('Acknowledging success to MQ')
-                return ch.basic_ack(delivery_tag=method.delivery_tag)
-            else:
-                log.debug('Acknowledging failure (try later) to MQ')
-                return ch.basic_nack(delivery_tag=method.delivery_tag)
-        except (InvalidHostException, AttributeError, ValueError) as e:
-            log.warning('Invalid host... Type: %s Msg: %s', type(e), str(e))
-            return ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-        except Exception:
-            log.exception('Unknown exception while handling action call...')
-            return ch.basic_nack(delivery_tag=method.delivery_tag)
-
-    def trace(self, **act):
+                return delivery.ack()
+            log.debug('Acknowledging failure (try later) to MQ')
+            return delivery.reject()
+        if isinstance(exc, (InvalidHostException, AttributeError, ValueError)):
+            log.warning('Invalid host... Type: %s Msg: %s', type(exc), str(exc))
+            return delivery.reject(requeue=False)
+        log.error('Unknown exception while handling action call...', exc_info=exc)
+        return delivery.reject()
+
+    @staticmethod
+    def job_status(run_act=None, exc: BaseException = None) -> str:
+        """The final status of a job (for :attr:`.metrics`), from the return value / exception of its action"""
+        if exc is not None:
+            return 'invalid' if isinstance(exc, InvalidHostException) else 'error'
+        return run_act if isinstance(run_act, str) else 'finished'
+
+    def on_message(self, delivery: Delivery):
+        act = self.decode(delivery.body)
+        if act is None:
+            return delivery.reject(requeue=False)
+
+        action, start = act['action'], time.time()
+        self.metrics.started(action, act.get('queued_at'))
         try:
-            # Extract the request ID, protocol, and host from the ``act`` dict
-            req_id, proto, host = act['req_id'], act.get('proto', 'any'), str(act['host'])
-            log.debug('Request ID: %s, Action: %s, IP/Host: %s', req_id, 'trace', host)
-        except (AttributeError, KeyError):
-            raise MissingArgsException('Data is missing `req_id` or `host` - cannot trace.')
-        # Default arguments for MTR (b = show IPs + hostnames, z = show ASNs, w = wide report)
-        args = ['mtr', '-bzw']
-        data = dict(action='trace', host=host, result=None, status='failed')
-
-        try:
-            if not validate_host(host, proto):
-                raise InvalidHostException
-        except (BaseException, ValueError, TypeError, AttributeError, InvalidHostException) as e:
-            if type(e) != InvalidHostException:
-                log.exception('Unknown exception while validating host "%s" ...', host)
-            self.redis.hset('lg_results', req_id, json.dumps(data))
-            raise InvalidHostException('Host {} is not valid, or is disallowed.'.format(host))
-
+            run_act = self.ACTIONS[action](**act)
+        except Exception as e:
+            self.metrics.finished(action, self.job_status(exc=e), time.time() - start)
+            return self.settle(delivery, exc=e)
+        self.metrics.finished(action, self.job_status(run_act), time.time() - start)
+        return self.settle(delivery, run_act)
+
+    @staticmethod
+    def trace_args(proto: str, host: str) -> List[str]:
+        # Default arguments for MTR (l = raw, machine readable output, c = pings per hop)
+        # ASNs are looked up afterwards from our own BGP table (see :meth:`.save_result`), instead of ``-z``
+        args = ['mtr', '-l', '-c', str(TRACE_CYCLES)]
         # If a protocol is specified, add the flag ``4`` or ``6`` to force a trace using IPv4/IPv6
         if proto in v4_protos + v6_protos:
             args[1] = args[1] + '6' if proto in v6_protos else args[1] + '4'
         # Now that we've set the protocol flag (if needed), we append the host to the arguments
-        args.append(host)
-        log.debug('Host "%s" is valid. Calling MTR......', host)
-        # Finally run mtr with the arguments, and wait for the report
-        mtr_handle = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        stdout, stderr = mtr_handle.communicate()
-
-        log.debug('stdout: %s', stdout)
-        log.debug('stderr: %s', stderr)
-
-        log.debug('Saving results for request ID %s', req_id)
-        # Store the results in the redis hash set under the request ID.
-        result = stdout.decode()
-        data['result'], data['status'] = result, 'finished'
-        self.redis.hset('lg_results', req_id, json.dumps(data))
+        return args + [host]
 
-        return True
-
-    def ping(self, **act):
+    @staticmethod
+    def ping_args(proto: str, host: str) -> List[str]:
+        # n = numeric output only (no reverse DNS for each reply)
+        args = ['ping', '-n', '-c', str(PING_COUNT)]
+        # If a protocol is specified, add the flag ``4`` or ``6`` to force a ping using IPv4/IPv6
+        if proto in v4_protos + v6_protos:
+            args = args + (['-6'] if proto in v6_protos else ['-4'])
+        return args + [host]
+
+    @staticmethod
+    def get_parser(action: str) -> Union[MtrRawParser, PingParser]:
+        """Returns a new parser for the output of ``action``"""
+        return MtrRawParser(cycles=TRACE_CYCLES) if action == 'trace' else PingParser()
+
+    def prepare(self, action: str, act: dict) -> Tuple[str, List[str], dict]:
+        """
+        Extract and validate the request ID, protocol and host from the ``act`` dict, and build the command
+        to run for ``action``.
+
+        :raises MissingArgsException: When ``req_id`` or ``host`` are missing from ``act``
+        :raises InvalidHostException: When the host is invalid or disallowed (the failure is saved to Redis)
+        :return tuple job: ``(req_id, args, data)`` - the command to run, and the result dict to be saved
+        """
         try:
             # Extract the request ID, protocol, and host from the ``act`` dict
             req_id, proto, host = act['req_id'], act.get('proto', 'any'), str(act['host'])
-            log.debug('Request ID: %s, Action: %s, IP/Host: %s', req_id, 'ping', host)
+            log.debug('Request ID: %s, Action: %s, IP/Host: %s', req_id, action, host)
         except (AttributeError, KeyError):
-            raise MissingArgsException('Data is missing `req_id` or `host` - cannot ping.')
-        # Default arguments for MTR (b = show IPs + hostnames, z = show ASNs, w = wide report)
-        args = ['ping', '-c', '5']
-        data = dict(action='ping', host=host, result=None, status='failed')
+            raise MissingArgsException(f'Data is missing `req_id` or `host` - cannot {action}.')
+        data = dict(action=action, host=host, result=None, status='failed')
+        # Parts of a multi-location request are collected into their parent once saved (see jobs.collect_location)
+        data.update({k: act[k] for k in ('location', 'parent') if act.get(k)})
 
         try:
-            if not validate_host(host, proto):
+            # The web app passes along the IP it resolved the host to - if so, we only need to re-check that IP,
+            # instead of resolving the host again.
+            ip = resolve_host(str(act['ip']) if act.get('ip') else host, proto)
+            if ip is None:
                 raise InvalidHostException
         except (BaseException, ValueError, TypeError, AttributeError, InvalidHostException) as e:
             if type(e) != InvalidHostException:
                 log.exception('Unknown exception while validating host "%s" ...', host)
-            self.redis.hset('lg_results', req_id, json.dumps(data))
+            jobs.save_result(self.redis, req_id, data, act.get('dedup_key'))
             raise InvalidHostException('Host {} is not valid, or is disallowed.'.format(host))
 
-        # If a protocol is specified, add the flag ``4`` or ``6`` to force a trace using IPv4/IPv6
-        if proto in v4_protos + v6_protos:
-            args = args + (['-6'] if proto in v6_protos else ['-4'])
-        # Now that we've set the protocol flag (if needed), we append the host to the arguments
-        args.append(host)
-        log.debug('Host "%s" is valid. Calling ping......', host)
-        # Finally run mtr with the arguments, and wait for the report
-        mtr_handle = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        stdout, stderr = mtr_handle.communicate()
-
-        log.debug('stdout: %s', stdout)
-        log.debug('stderr: %s', stderr)
-
-        log.debug('Saving results for request ID %s', req_id)
-        # Store the results in the redis hash set under the request ID.
-        result = stdout.decode()
-        data['result'], data['status'] = result, 'finished'
-        self.redis.hset('lg_results', req_id, json.dumps(data))
-
-        return True
-
-
+        args = self.trace_args(proto, ip) if action == 'trace' else self.ping_args(proto, ip)
+        log.debug('Host "%s" (%s) is valid. Calling %s......', host, ip, args[0])
+        return req_id, args, data
+
+    def save_result(self, req_id: str, data: dict, result: dict, dedup_key: str = None,
+                    status: str = 'finished') -> str:
+        log.debug('result: %s', result)
+        log.debug('Saving results for request ID %s (status: %s)', req_id, status)
+        self.enrich(data.get('action'), result)
+        # Store the results in Redis under the request ID, and notify any waiting clients.
+        data['result'], data['status'] = result, status
+        jobs.save_result(self.redis, req_id, data, dedup_key)
+        return status
+
+    @staticmethod
+    def enrich(action: str, result: dict):
+        """Annotate the hops of a trace ``result`` with their ASN / prefix / IXP (see :mod:`lg.lookingglass.enrich`)"""
+        enricher = get_enricher()
+        if enricher is not None and action == 'trace' and result.get('hops'):
+            enricher.enrich(result['hops'])
+
+    def prepare_batch(self, act: dict) -> Tuple[str, str, List[Tuple[dict, Optional[List[str]]]], dict]:
+        """
+        Extract the request ID, action and targets of a batch request from the ``act`` dict, and build the command
+        to run for each target. Targets which are invalid / disallowed are kept with a command of ``None``, so that
+        they're reported as ``invalid`` in the result, rather than failing the whole batch.
+
+        :raises MissingArgsException: When ``req_id``, ``batch_action`` or ``targets`` are missing from ``act``
+        :return tuple job: ``(req_id, action, [(target, args), ...], data)``
+        """
+        try:
+            req_id, action, proto = act['req_id'], act['batch_action'], act.get('proto', 'any')
+            targets = list(act['targets'])
+            if action not in ('ping', 'trace'):
+                raise ValueError
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise MissingArgsException('Batch data is missing `req_id`, `batch_action` or `targets`.')
+        log.debug('Request ID: %s, Action: batch %s, Targets: %d', req_id, action, len(targets))
+        data = dict(action='batch', batch_action=action, result=None, status='failed')
+        work = []
+        for t in targets:
+            try:
+                ip = resolve_host(str(t.get('ip') or t['host']), proto)
+            except Exception:
+                log.exception('Unknown exception while validating batch target %s', t)
+                ip = None
+            target = dict(host=t.get('host'), ip=ip)
+            if ip is None:
+                work.append((target, None))
+                continue
+            work.append((target, self.trace_args(proto, ip) if action == 'trace' else self.ping_args(proto, ip)))
+        return req_id, action, work, data
+
+    @staticmethod
+    def reachable(action: str, ip: str, result: dict) -> bool:
+        """Returns ``True`` if the ping / trace ``result`` shows that ``ip`` replied"""
+        if action == 'ping':
+            return result.get('recv', 0) > 0
+        hops = result.get('hops') or []
+        return len(hops) > 0 and hops[-1]['ip'] == ip and hops[-1]['recv'] > 0
+
+    def target_result(self, req_id: str, action: str, target: dict, status: str, result: Optional[dict]) -> dict:
+        """Build the result entry of a single batch target, and publish it to the request's stream"""
+        if result is not None:
+            self.enrich(action, result)
+        entry = dict(
+            **target, status=status, reachable=result is not None and self.reachable(action, target['ip'], result),
+            result=result
+        )
+        jobs.publish_event(self.redis, req_id, 'target', entry)
+        return entry
+
+    @staticmethod
+    def batch_result(targets: List[dict]) -> dict:
+        """
+        Aggregate the per-target results of a batch request::
+
+            {
+                "summary": {"total": 3, "reachable": 1, "unreachable": 1, "invalid": 1, "timeout": 0, "cancelled": 0},
+                "targets": [
+                    {"host": "8.8.4.4", "ip": "8.8.4.4", "status": "finished", "reachable": true, "result": {...}},
+                    ...
+                ]
+            }
+
+        """
+        summary = dict(total=len(targets), reachable=0, unreachable=0, invalid=0, timeout=0, cancelled=0)
+        for t in targets:
+            if t['status'] == 'finished':
+                summary['reachable' if t['reachable'] else 'unreachable'] += 1
+            else:
+                summary[t['status']] = summary.get(t['status'], 0) + 1
+        return dict(summary=summary, targets=targets)
+
+    @staticmethod
+    def batch_status(targets: List[dict]) -> str:
+        """The overall status of a batch request - ``cancelled`` / ``timeout`` if any target was stopped early"""
+        statuses = {t['status'] for t in targets}
+        for status in ('cancelled', 'timeout'):
+            if status in statuses:
+                return status
+        return 'finished'
+
+    def handle_line(self, req_id: str, parser: Union[MtrRawParser, PingParser], line: bytes):
+        """Feed a line of output to ``parser``, and publish any resulting event to the request's stream"""
+        ev = parser.feed(line)
+        if ev is not None:
+            jobs.publish_event(self.redis, req_id, *ev)
+
+    @staticmethod
+    def kill(pid: int):
+        """Kill the process group of ``pid`` - i.e. the ping / mtr process, and any processes it has spawned"""
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def check_stop(self, req_id: str, deadline: float) -> Optional[str]:
+        """Returns ``timeout`` / ``cancelled`` if the request ``req_id`` should be stopped, otherwise ``None``"""
+        if time.time() >= deadline:
+            return 'timeout'
+        if jobs.is_cancelled(self.redis, req_id):
+            return 'cancelled'
+        return None
+
+    def _watch(self, handle: subprocess.Popen, req_id: str, deadline: float, state: dict):
+        while True:
+            try:
+                return handle.wait(timeout=max(min(CANCEL_POLL, deadline - time.time()), 0))
+            except subprocess.TimeoutExpired:
+                pass
+            status = self.check_stop(req_id, deadline)
+            if status is not None:
+                log.warning('Killing request %s (pid %d) - status: %s', req_id, handle.pid, status)
+                state['status'] = status
+                return self.kill(handle.pid)
+
+    def run_command(self, req_id: str, args: List[str], parser, deadline: float, stream: bool = True) -> str:
+        """
+        Run the command ``args``, feeding each line of output to ``parser`` as it arrives (and publishing the
+        resulting events to the request's stream, if ``stream`` is True).
+
+        :return str status: ``finished``, or ``timeout`` / ``cancelled`` if the command had to be killed
+        """
+        # The command runs in its own session (process group), so that it can be killed along with any children.
+        handle = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        state = dict(status='finished')
+        watcher = threading.Thread(target=self._watch, args=(handle, req_id, deadline, state), daemon=True)
+        watcher.start()
+        for line in handle.stdout:
+            if stream:
+                self.handle_line(req_id, parser, line)
+            else:
+                parser.feed(line)
+        handle.wait()
+        watcher.join()
+        return state['status']
+
+    def execute(self, action: str, act: dict) -> str:
+        req_id, args, data = self.prepare(action, act)
+        deadline = time.time() + ACTION_TIMEOUTS[action]
+        parser = self.get_parser(action)
+        if jobs.is_cancelled(self.redis, req_id):
+            return self.save_result(req_id, data, parser.result(), act.get('dedup_key'), status='cancelled')
+        # Finally run the command with the arguments, parsing + publishing each line of output as it arrives.
+        status = self.run_command(req_id, args, parser, deadline)
+        return self.save_result(req_id, data, parser.result(), act.get('dedup_key'), status=status)
+
+    def run_target(self, req_id: str, action: str, target: dict, args: Optional[List[str]], deadline: float) -> dict:
+        """Ping / trace a single target of a batch request, returning its result entry"""
+        if args is None:
+            return self.target_result(req_id, action, target, 'invalid', None)
+        stop = self.check_stop(req_id, deadline)
+        if stop is not None:
+            return self.target_result(req_id, action, target, stop, None)
+        parser = self.get_parser(action)
+        status = self.run_command(
+            req_id, args, parser, min(deadline, time.time() + ACTION_TIMEOUTS[action]), stream=False
+        )
+        return self.target_result(req_id, action, target, status, parser.result())
 
+    def trace(self, **act):
+        return self.execute('trace', act)
 
+    def ping(self, **act):
+        return self.execute('ping', act)
+
+    def batch(self, **act):
+        """
+        Ping / trace each target of a batch request, up to ``BATCH_CONCURRENCY[action]`` targets at a time, then save
+        one aggregated result (see :meth:`.batch_result`). Each target's result is also published to the
+        request's stream as a ``target`` event as soon as it's finished.
+        """
+        req_id, action, targets, data = self.prepare_batch(act)
+        deadline = time.time() + BATCH_TIMEOUT
+        with ThreadPoolExecutor(max_workers=max(min(BATCH_CONCURRENCY[action], len(targets)), 1)) as pool:
+            results = list(pool.map(lambda t: self.run_target(req_id, action, t[0], t[1], deadline), targets))
+        return self.save_result(req_id, data, self.batch_result(results), status=self.batch_status(results))
+
+
+class AsyncRunner(Runner):
+    """
+    A :class:`.Runner` which runs several pings / traces at the same time.
+
+    Each queue has its own amount of slots (``concurrency``), so that e.g. a burst of slow traces can only ever
+    occupy the trace slots, while pings from the ping queue keep running in their own slots. Each queue is
+    consumed with a prefetch of ``prefetch`` messages (defaults to the queue's concurrency).
+
+    Messages are still consumed on the main thread, while the actions are ran as coroutines on an asyncio
+    event loop in a background thread, using :func:`asyncio.create_subprocess_exec`. Each message is acknowledged
+    as soon as its own action finishes.
+
+    Unless ``PING_ENGINE`` is set to ``binary``, pings are sent from the runner itself by an :class:`.IcmpProber`,
+    instead of spawning a ``ping`` process for each request.
+
+        >>> r = AsyncRunner(
+        ...     mq_conn=base.get_rmq(), queue=[base.RMQ_QUEUE_PING, base.RMQ_QUEUE_TRACE], redis=base.get_redis(),
+        ...     concurrency={base.RMQ_QUEUE_PING: 8, base.RMQ_QUEUE_TRACE: 4}
+        ... )
+        >>> r.run()
+
+    """
+    def __init__(self, mq_conn: Optional[BlockingConnection], queue: Union[str, List[str]], redis: Redis,
+                 concurrency: Union[int, Dict[str, int]] = 4, prefetch: Union[int, Dict[str, int]] = None,
+                 consumer: Union[RMQConsumer, RedisStreamConsumer] = None):
+        super().__init__(mq_conn=mq_conn, queue=queue, redis=redis, consumer=consumer)
+        if not isinstance(concurrency, dict):
+            concurrency = {q: concurrency for q in self.queues}
+        if prefetch is None:
+            prefetch = concurrency
+        elif not isinstance(prefetch, dict):
+            prefetch = {q: prefetch for q in self.queues}
+        self.concurrency, self.prefetch = concurrency, prefetch
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='lg-runner-loop', daemon=True)
+        self._slots = {}   # type: Dict[str, asyncio.Semaphore]
+        self.prober = IcmpProber() if PING_ENGINE != 'binary' else None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._slots = {q: asyncio.Semaphore(self.concurrency[q]) for q in self.queues}
+        self.loop.run_forever()
+
+    def run(self, msg_count: int = None):
+        self._thread.start()
+        prefetch = {q: self.prefetch[q] if msg_count is None else msg_count for q in self.queues}
+        for q in self.queues:
+            log.info('Consuming queue %s (concurrency: %d, prefetch: %d)', q, self.concurrency[q], prefetch[q])
+        self.consumer.consume(self.on_message, prefetch=prefetch)
+
+    def on_message(self, delivery: Delivery):
+        act = self.decode(delivery.body)
+        if act is None:
+            return delivery.reject(requeue=False)
+
+        fut = asyncio.run_coroutine_threadsafe(self._run_action(delivery.queue, act), self.loop)
+        fut.add_done_callback(functools.partial(self._finished, delivery))
+
+    async def _run_action(self, queue: str, act: dict):
+        async with self._slots.get(queue, self._slots[self.queue]):
+            action, start, status = act['action'], time.time(), 'error'
+            await self.loop.run_in_executor(None, self.metrics.started, action, act.get('queued_at'))
+            try:
+                res = await self.ACTIONS[action](**act)
+                status = self.job_status(res)
+                return res
+            except Exception as e:
+                status = self.job_status(exc=e)
+                raise
+            finally:
+                await self.loop.run_in_executor(None, self.metrics.finished, action, status, time.time() - start)
+
+    def _finished(self, delivery: Delivery, fut: Future):
+        # Called from the asyncio thread - pika connections aren't thread safe, so the ack/nack must be
+        # scheduled on the consumer's own thread.
+        exc = fut.exception()
+        settle = functools.partial(self.settle, delivery, run_act=None if exc else fut.result(), exc=exc)
+        self.consumer.threadsafe(settle)
+
+    async def _read_lines(self, lines: AsyncIterator, req_id: str, parser, stream: bool = True):
+        async for line in lines:
+            if stream:
+                await self.loop.run_in_executor(None, self.handle_line, req_id, parser, line)
+            else:
+                parser.feed(line)
+
+    def use_prober(self, action: str, ip: str) -> bool:
+        """Returns ``True`` if ``action`` on ``ip`` should be ran by the in-process :class:`.IcmpProber`"""
+        if action != 'ping' or self.prober is None:
+            return False
+        return icmp_available(socket.AF_INET6 if ':' in ip else socket.AF_INET)
+
+    async def execute(self, action: str, act: dict) -> str:
+        # Host validation may involve blocking DNS lookups, so it's ran in the default thread pool
+        req_id, args, data = await self.loop.run_in_executor(None, self.prepare, action, act)
+        deadline, dedup_key = time.time() + ACTION_TIMEOUTS[action], act.get('dedup_key')
+        parser = self.get_parser(action)
+        if await self.loop.run_in_executor(None, jobs.is_cancelled, self.redis, req_id):
+            return await self.loop.run_in_executor(
+                None, self.save_result, req_id, data, parser.result(), dedup_key, 'cancelled'
+            )
+
+        status = await self.run_command(req_id, action, args, parser, deadline)
+        return await self.loop.run_in_executor(
+            None, self.save_result, req_id, data, parser.result(), dedup_key, status
+        )
+
+    async def run_command(self, req_id: str, action: str, args: List[str], parser, deadline: float,
+                          stream: bool = True) -> str:
+        """
+        Run the command ``args`` (or ping the host using the :class:`.IcmpProber`), feeding each line of output to
+        ``parser`` as it arrives (and publishing the resulting events to the request's stream, if ``stream`` is True).
+
+        :return str status: ``finished``, or ``timeout`` / ``cancelled`` if the command had to be stopped
+        """
+        proc = None
+        if self.use_prober(action, args[-1]):
+            reader = asyncio.ensure_future(self._read_lines(self.prober.ping(args[-1]), req_id, parser, stream))
+        else:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True
+            )
+            reader = asyncio.ensure_future(self._read_lines(proc.stdout, req_id, parser, stream))
+        status = 'finished'
+        while True:
+            done, _ = await asyncio.wait({reader}, timeout=max(min(CANCEL_POLL, deadline - time.time()), 0))
+            if done:
+                break
+            stop = await self.loop.run_in_executor(None, self.check_stop, req_id, deadline)
+            if stop is not None:
+                log.warning('Stopping request %s - status: %s', req_id, stop)
+                status = stop
+                if proc is None:
+                    reader.cancel()
+                else:
+                    self.kill(proc.pid)
+                break
+        # Once the process has been killed, its stdout is closed, so the reader finishes with the partial output
+        try:
+            await reader
+        except asyncio.CancelledError:
+            pass
+        if proc is not None:
+            await proc.wait()
+        return status
+
+    async def run_target(self, req_id: str, action: str, target: dict, args: Optional[List[str]],
+                         deadline: float) -> dict:
+        if args is None:
+            return await self.loop.run_in_executor(None, self.target_result, req_id, action, target, 'invalid', None)
+        stop = await self.loop.run_in_executor(None, self.check_stop, req_id, deadline)
+        if stop is not None:
+            return await self.loop.run_in_executor(None, self.target_result, req_id, action, target, stop, None)
+        parser = self.get_parser(action)
+        status = await self.run_command(
+            req_id, action, args, parser, min(deadline, time.time() + ACTION_TIMEOUTS[action]), stream=False
+        )
+        return await self.loop.run_in_executor(
+            None, self.target_result, req_id, action, target, status, parser.result()
+        )
+
+    async def trace(self, **act):
+        return await self.execute('trace', act)
+
+    async def ping(self, **act):
+        return await self.execute('ping', act)
+
+    async def batch(self, **act):
+        req_id, action, targets, data = await self.loop.run_in_executor(None, self.prepare_batch, act)
+        deadline, slots = time.time() + BATCH_TIMEOUT, asyncio.Semaphore(BATCH_CONCURRENCY[action])
+
+        async def run_target(target: dict, args: Optional[List[str]]) -> dict:
+            async with slots:
+                return await self.run_target(req_id, action, target, args, deadline)
+
+        results = await asyncio.gather(*[run_target(t, a) for t, a in targets])
+        return await self.loop.run_in_executor(
+            None, self.save_result, req_id, data, self.batch_result(list(results)), None, self.batch_status(results)
+        )
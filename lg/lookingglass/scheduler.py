@@ -0,0 +1,235 @@
+"""
+
+Scheduled recurring measurements - ``./manage.py scheduler`` pings / traces the targets listed in ``SCHEDULE_FILE``
+every ``interval`` seconds, and stores the results as time series (see :mod:`lg.lookingglass.series`).
+
+Scheduled measurements are ran by the normal runners: the scheduler queues them just like the API does, then
+collects their results from Redis once they're done, and writes them to Postgres in batches - so the runners
+never need a database connection.
+
+Several schedulers may run at once (e.g. for redundancy) - each measurement slot of a target is claimed in Redis
+(``lg_schedule:<target id>:<slot>``) before it's queued, so it's only measured once.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import json
+import logging
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+from uuid import uuid4
+
+from redis import Redis
+
+from lg.base import RMQ_QUEUES, location_queue, get_publisher
+from lg.exceptions import QueueError
+from lg.lookingglass.jobs import save_request, result_key
+from lg.lookingglass.metrics import count_request
+from lg.lookingglass.series import upsert_target, sample_from_result, insert_samples, rollup
+from lg.lookingglass.settings import SCHEDULE_DEFAULT_INTERVAL, SERIES_RAW_DAYS, SERIES_ROLLUP_INTERVAL, \
+    ACTION_TIMEOUTS
+
+log = logging.getLogger(__name__)
+
+SLOT_KEY = 'lg_schedule:{}:{}'
+PENDING_KEY = 'lg_schedule_pending'
+"""Redis hash mapping the request IDs of queued scheduled measurements to their target / time"""
+
+
+@dataclass
+class ScheduledTarget:
+    action: str
+    host: str
+    interval: int = SCHEDULE_DEFAULT_INTERVAL
+    proto: str = 'any'
+    location: str = ''
+    id: Optional[int] = None
+
+    @property
+    def offset(self) -> int:
+        """Spreads targets with the same interval across it, rather than measuring all of them at once"""
+        return zlib.crc32(f'{self.action}|{self.host}|{self.proto}|{self.location}'.encode()) % self.interval
+
+    def slot(self, now: float) -> int:
+        """The number of the measurement slot which ``now`` (unix time) falls into"""
+        return int((now + self.offset) // self.interval)
+
+
+def parse_schedule(lines: Iterable[str]) -> List[ScheduledTarget]:
+    """
+    Parse the lines of a schedule file (see ``SCHEDULE_FILE``) into :class:`.ScheduledTarget`'s::
+
+        >>> parse_schedule(['ping 8.8.8.8 interval=60', 'trace example.com proto=ipv6 location=se1'])
+        [ScheduledTarget(action='ping', host='8.8.8.8', interval=60, proto='any', location='', id=None),
+         ScheduledTarget(action='trace', host='example.com', interval=300, proto='ipv6', location='se1', id=None)]
+
+    :raises ValueError: When a line is invalid (the message includes the line number)
+    """
+    targets = []
+    for num, line in enumerate(lines, start=1):
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        action, host, *opts = line.split()
+        if action not in RMQ_QUEUES:
+            raise ValueError(f'Line {num}: unknown action "{action}" (expected one of {", ".join(RMQ_QUEUES)})')
+        t = ScheduledTarget(action=action, host=host)
+        for opt in opts:
+            key, _, value = opt.partition('=')
+            if key == 'interval' and value.isdigit() and int(value) >= 10:
+                t.interval = int(value)
+            elif key == 'proto' and value in ['any', 'ipv4', 'ipv6']:
+                t.proto = value
+            elif key == 'location' and value == 'all':
+                raise ValueError(f'Line {num}: location=all is not supported - list the target once per location')
+            elif key == 'location' and value:
+                t.location = value
+            else:
+                raise ValueError(f'Line {num}: invalid option "{opt}"')
+        targets.append(t)
+    return targets
+
+
+def load_schedule_file(path: str) -> List[ScheduledTarget]:
+    with open(path) as fh:
+        return parse_schedule(fh)
+
+
+class Scheduler:
+    """
+    Queues the measurements of ``targets`` as they become due, and stores their results::
+
+        >>> _, db, _ = get_app()
+        >>> s = Scheduler(get_redis(), db.engine, load_schedule_file(SCHEDULE_FILE))
+        >>> s.run()
+
+    """
+    def __init__(self, redis: Redis, engine, targets: List[ScheduledTarget], publisher=None):
+        self.redis, self.engine, self.targets = redis, engine, targets
+        self.publisher = publisher
+        self._last_slot = {}         # type: Dict[int, int]
+        self._rolled_up = None       # type: Optional[datetime]
+        self._next_rollup = 0.0
+        self._stop_ev = threading.Event()
+
+    def sync_targets(self):
+        """Create the targets in the database (if they don't exist yet), so their IDs are known"""
+        with self.engine.begin() as conn:
+            for t in self.targets:
+                t.id = upsert_target(conn, t.action, t.host, t.proto, t.location, t.interval)
+        log.info('Loaded %d scheduled targets', len(self.targets))
+
+    def enqueue_due(self, now: float) -> int:
+        """Queue a measurement of each target which has entered a new slot since it was last measured"""
+        queued, publisher = 0, self.publisher or get_publisher()
+        for t in self.targets:
+            slot = t.slot(now)
+            if self._last_slot.get(t.id) == slot:
+                continue
+            self._last_slot[t.id] = slot
+            req_id = str(uuid4())
+            # Another scheduler may have already queued this slot
+            if not self.redis.set(SLOT_KEY.format(t.id, slot), req_id, nx=True, ex=t.interval * 2):
+                continue
+            _data = dict(req_id=req_id, action=t.action, host=t.host, proto=t.proto, status='waiting', scheduled=True)
+            if t.location:
+                _data['location'] = t.location
+            save_request(self.redis, req_id, _data)
+            try:
+                publisher.publish(location_queue(RMQ_QUEUES[t.action], t.location), json.dumps({
+                    **_data, 'queued_at': now
+                }))
+            except QueueError as e:
+                log.warning('Failed to queue scheduled %s of %s - %s', t.action, t.host, str(e))
+                count_request(self.redis, t.action, 'queue_error')
+                continue
+            count_request(self.redis, t.action, 'scheduled')
+            deadline = now + ACTION_TIMEOUTS.get(t.action, 60) + t.interval
+            self.redis.hset(PENDING_KEY, req_id, json.dumps(dict(
+                target_id=t.id, action=t.action, ts=now, deadline=deadline
+            )))
+            queued += 1
+        return queued
+
+    def collect(self, now: float) -> int:
+        """Store the results of any scheduled measurements which have finished, returning how many were stored"""
+        pending = {k.decode(): json.loads(v) for k, v in self.redis.hgetall(PENDING_KEY).items()}
+        if len(pending) == 0:
+            return 0
+        p = self.redis.pipeline(transaction=False)
+        for req_id in pending.keys():
+            p.get(result_key(req_id))
+        rows, done = [], []
+        for (req_id, info), res in zip(pending.items(), p.execute()):
+            if res is None:
+                if now > info['deadline'] and self.redis.hdel(PENDING_KEY, req_id):
+                    log.warning('Scheduled %s %s was never ran - is a runner online?', info['action'], req_id)
+                continue
+            done.append(req_id)
+            res = json.loads(res)
+            sample = sample_from_result(info['action'], res.get('result'))
+            if sample is None:
+                log.debug('Scheduled %s %s returned no measurement (status: %s)', info['action'], req_id, res['status'])
+                continue
+            rows.append(dict(target_id=info['target_id'], ts=datetime.utcfromtimestamp(info['ts']), **sample))
+        if len(rows) > 0:
+            # Samples are keyed by (target, time queued), so if several schedulers store the same result at once,
+            # the duplicates are ignored
+            with self.engine.begin() as conn:
+                insert_samples(conn, rows)
+        # Only forget the measurements once they're stored - if the insert failed, they're retried on the next tick
+        if len(done) > 0:
+            self.redis.hdel(PENDING_KEY, *done)
+        return len(rows)
+
+    def maybe_rollup(self, now: float):
+        """
+        Update the rollups every ``SERIES_ROLLUP_INTERVAL`` seconds - on start, everything still stored is rolled up
+        """
+        if now < self._next_rollup:
+            return
+        self._next_rollup = now + SERIES_ROLLUP_INTERVAL
+        started = datetime.utcfromtimestamp(now)
+        if self._rolled_up is None:
+            since = started - timedelta(days=SERIES_RAW_DAYS)
+        else:
+            # Results are stored up to one interval + timeout after they were queued, so re-check those hours too
+            lag = max([t.interval for t in self.targets] + [0]) + max(ACTION_TIMEOUTS.values())
+            since = self._rolled_up - timedelta(seconds=lag)
+        with self.engine.begin() as conn:
+            rollup(conn, since, now=started)
+        self._rolled_up = started
+
+    def tick(self, now: float = None):
+        now = time.time() if now is None else now
+        self.enqueue_due(now)
+        self.collect(now)
+        self.maybe_rollup(now)
+
+    def run(self, interval: float = 1.0):
+        self.sync_targets()
+        while not self._stop_ev.is_set():
+            try:
+                self.tick()
+            except Exception:
+                log.exception('Error while running scheduled measurements')
+            self._stop_ev.wait(interval)
+
+    def stop(self):
+        self._stop_ev.set()
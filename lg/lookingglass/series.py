@@ -0,0 +1,199 @@
+"""
+
+Compact time-series storage for scheduled measurements (see :mod:`lg.lookingglass.scheduler`).
+
+Each measurement of a scheduled target is stored as one fixed-width row in ``measurement_sample`` (sent / received
+packets plus min / avg / max / stdev RTT - for traces, those of the final hop). These are downsampled into hourly
+and daily rows in ``measurement_rollup``, after which the individual measurements can be removed:
+
+ - individual measurements are kept for ``SERIES_RAW_DAYS``
+ - hourly rollups for ``SERIES_HOURLY_DAYS``
+ - daily rollups forever
+
+All functions take an SQLAlchemy connection (e.g. ``db.engine.connect()``), so they can be used by both the
+scheduler and the web app.
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from lg.lookingglass.settings import SERIES_RAW_DAYS, SERIES_HOURLY_DAYS, SERIES_MAX_POINTS
+
+log = logging.getLogger(__name__)
+
+HOUR, DAY = 3600, 86400
+RESOLUTIONS = {'raw': 0, 'hour': HOUR, 'day': DAY}
+
+UPSERT_TARGET = text("""
+INSERT INTO measurement_target (action, host, proto, location, "interval", created_at, updated_at)
+VALUES (:action, :host, :proto, :location, :interval, :now, :now)
+ON CONFLICT (action, host, proto, location) DO UPDATE SET
+    "interval" = EXCLUDED."interval", updated_at = EXCLUDED.updated_at
+RETURNING id
+""")
+
+INSERT_SAMPLE = text("""
+INSERT INTO measurement_sample (target_id, ts, sent, recv, rtt_min, rtt_avg, rtt_max, rtt_stdev, hops)
+VALUES (:target_id, :ts, :sent, :recv, :rtt_min, :rtt_avg, :rtt_max, :rtt_stdev, :hops)
+ON CONFLICT DO NOTHING
+""")
+
+ROLLUP_HOURLY = text("""
+INSERT INTO measurement_rollup (target_id, resolution, bucket, samples, sent, recv, rtt_min, rtt_avg, rtt_max)
+SELECT target_id, 3600, date_trunc('hour', ts), count(*), sum(sent), sum(recv), min(rtt_min), avg(rtt_avg),
+       max(rtt_max)
+FROM measurement_sample WHERE ts >= :since
+GROUP BY target_id, date_trunc('hour', ts)
+ON CONFLICT (target_id, resolution, bucket) DO UPDATE SET
+    samples = EXCLUDED.samples, sent = EXCLUDED.sent, recv = EXCLUDED.recv,
+    rtt_min = EXCLUDED.rtt_min, rtt_avg = EXCLUDED.rtt_avg, rtt_max = EXCLUDED.rtt_max
+""")
+"""(Re-)calculate the hourly rollups of every hour from ``since`` onwards"""
+
+ROLLUP_DAILY = text("""
+INSERT INTO measurement_rollup (target_id, resolution, bucket, samples, sent, recv, rtt_min, rtt_avg, rtt_max)
+SELECT target_id, 86400, date_trunc('day', bucket), sum(samples), sum(sent), sum(recv), min(rtt_min),
+       sum(rtt_avg * samples) / nullif(sum(samples) FILTER (WHERE rtt_avg IS NOT NULL), 0), max(rtt_max)
+FROM measurement_rollup WHERE resolution = 3600 AND bucket >= :since
+GROUP BY target_id, date_trunc('day', bucket)
+ON CONFLICT (target_id, resolution, bucket) DO UPDATE SET
+    samples = EXCLUDED.samples, sent = EXCLUDED.sent, recv = EXCLUDED.recv,
+    rtt_min = EXCLUDED.rtt_min, rtt_avg = EXCLUDED.rtt_avg, rtt_max = EXCLUDED.rtt_max
+""")
+"""(Re-)calculate the daily rollups of every day from ``since`` onwards, from the hourly rollups"""
+
+PRUNE_SAMPLES = text("DELETE FROM measurement_sample WHERE ts < :before")
+PRUNE_HOURLY = text("DELETE FROM measurement_rollup WHERE resolution = 3600 AND bucket < :before")
+
+SELECT_RAW = text("""
+SELECT ts, sent, recv, rtt_min, rtt_avg, rtt_max FROM measurement_sample
+WHERE target_id = :target_id AND ts >= :start AND ts < :end ORDER BY ts LIMIT :limit
+""")
+
+SELECT_ROLLUP = text("""
+SELECT bucket, sent, recv, rtt_min, rtt_avg, rtt_max, samples FROM measurement_rollup
+WHERE target_id = :target_id AND resolution = :resolution AND bucket >= :start AND bucket < :end
+ORDER BY bucket LIMIT :limit
+""")
+
+SELECT_TARGETS = text('SELECT id, action, host, proto, location, "interval" FROM measurement_target ORDER BY id')
+
+
+def _smallint(v: int) -> int:
+    return max(min(int(v), 32767), 0)
+
+
+def sample_from_result(action: str, result: Optional[dict]) -> Optional[dict]:
+    """
+    Convert the parsed result of a ping / trace (see :mod:`lg.lookingglass.parsers`) into a sample row.
+    For traces, the stats of the final hop are used. Returns ``None`` if nothing was measured.
+    """
+    if not result:
+        return None
+    hops = None
+    if action == 'trace':
+        if not result.get('hops'):
+            return None
+        hops, result = len(result['hops']), result['hops'][-1]
+    if not result.get('sent'):
+        return None
+    return dict(
+        sent=_smallint(result['sent']), recv=_smallint(result.get('recv', 0)), rtt_min=result.get('min'),
+        rtt_avg=result.get('avg'), rtt_max=result.get('max'), rtt_stdev=result.get('stdev'),
+        hops=None if hops is None else _smallint(hops)
+    )
+
+
+def upsert_target(conn, action: str, host: str, proto: str, location: str, interval: int) -> int:
+    """Create (or update the interval of) a scheduled target, returning its ID"""
+    row = conn.execute(UPSERT_TARGET, dict(
+        action=action, host=host, proto=proto, location=location or '', interval=interval, now=datetime.utcnow()
+    )).fetchone()
+    return row[0]
+
+
+def list_targets(conn) -> List[dict]:
+    return [dict(row.items()) for row in conn.execute(SELECT_TARGETS)]
+
+
+def insert_samples(conn, rows: List[dict]):
+    """Insert sample rows (``target_id``, ``ts`` + the fields from :func:`.sample_from_result`) in one round trip"""
+    if len(rows) > 0:
+        conn.execute(INSERT_SAMPLE, rows)
+
+
+def _floor(dt: datetime, resolution: int) -> datetime:
+    if resolution == DAY:
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def rollup(conn, since: datetime, now: datetime = None):
+    """
+    Update the hourly and daily rollups of all measurements taken since ``since``, then remove the measurements
+    and hourly rollups which have expired. Safe to run repeatedly, and from several processes at once.
+    """
+    now = now or datetime.utcnow()
+    conn.execute(ROLLUP_HOURLY, dict(since=_floor(since, HOUR)))
+    conn.execute(ROLLUP_DAILY, dict(since=_floor(since, DAY)))
+    conn.execute(PRUNE_SAMPLES, dict(before=_floor(now - timedelta(days=SERIES_RAW_DAYS), HOUR)))
+    conn.execute(PRUNE_HOURLY, dict(before=_floor(now - timedelta(days=SERIES_HOURLY_DAYS), DAY)))
+
+
+def pick_resolution(start: datetime, end: datetime, now: datetime = None) -> int:
+    """
+    Pick the finest resolution which still holds data for ``start`` and returns a sensible amount of points:
+    individual measurements for up to 2 days, hourly rollups for up to 60 days, otherwise daily rollups.
+    """
+    now, span = now or datetime.utcnow(), end - start
+    if span <= timedelta(days=2) and start >= now - timedelta(days=SERIES_RAW_DAYS):
+        return 0
+    if span <= timedelta(days=60) and start >= now - timedelta(days=SERIES_HOURLY_DAYS):
+        return HOUR
+    return DAY
+
+
+def get_series(conn, target_id: int, start: datetime, end: datetime, resolution: int = None,
+               limit: int = SERIES_MAX_POINTS) -> dict:
+    """
+    Load the measurements of the scheduled target ``target_id`` between ``start`` and ``end``::
+
+        {
+            "resolution": 3600,
+            "columns": ["ts", "sent", "recv", "loss", "min", "avg", "max", "samples"],
+            "points": [["2019-10-01T10:00:00", 60, 60, 0.0, 1.1, 1.2, 1.9, 12], ...]
+        }
+
+    :param resolution: ``0`` for individual measurements, ``3600`` / ``86400`` for hourly / daily rollups, or
+                       ``None`` to pick one based on the time range (see :func:`.pick_resolution`)
+    """
+    if resolution is None:
+        resolution = pick_resolution(start, end)
+    params = dict(target_id=target_id, end=end, limit=limit)
+    if resolution == 0:
+        rows = conn.execute(SELECT_RAW, dict(params, start=start))
+    else:
+        rows = conn.execute(SELECT_ROLLUP, dict(params, start=_floor(start, resolution), resolution=resolution))
+    points = []
+    for ts, sent, recv, rtt_min, rtt_avg, rtt_max, *samples in rows:
+        loss = round((sent - recv) / sent * 100, 1) if sent > 0 else None
+        points.append([ts.isoformat(), sent, recv, loss, rtt_min, rtt_avg, rtt_max] + samples)
+    columns = ['ts', 'sent', 'recv', 'loss', 'min', 'avg', 'max'] + ([] if resolution == 0 else ['samples'])
+    return dict(resolution=resolution, columns=columns, points=points)
@@ -1,6 +1,8 @@
 import ipaddress
 from os import getenv as env
 
+from lg.lookingglass.subnets import SubnetMatcher, load_subnets_file
+
 DISALLOW_SUBNETS = [
     ipaddress.ip_network('10.0.0.0/8'),
     ipaddress.ip_network('172.16.0.0/12'),
@@ -33,3 +35,231 @@ if __dis_subs is not None:
     __dis_subs = str(__dis_subs).split(',')
     _dis_nets = [ipaddress.ip_network(net, strict=False) for net in __dis_subs]
     DISALLOW_SUBNETS = DISALLOW_SUBNETS + _dis_nets
+
+DISALLOW_SUBNETS_FILE = env('DISALLOW_SUBNETS_FILE', None)
+"""
+Optionally, the path to a text file containing additional subnets to disallow - one CIDR network per line.
+Blank lines and comments (starting with ``#``) are ignored, so full bogon / customer lists can be used as-is.
+
+Example file::
+
+    # Bogons
+    100.64.0.0/10
+    198.18.0.0/15
+    2001:db8::/32
+
+"""
+
+if DISALLOW_SUBNETS_FILE:
+    DISALLOW_SUBNETS = DISALLOW_SUBNETS + load_subnets_file(DISALLOW_SUBNETS_FILE)
+
+DISALLOW_MATCHER = SubnetMatcher(DISALLOW_SUBNETS)
+"""
+:py:attr:`.DISALLOW_SUBNETS` compiled into a :class:`.SubnetMatcher` at startup, for fast lookups, e.g.
+``if ip in DISALLOW_MATCHER``
+"""
+
+STREAM_MAXLEN = int(env('STREAM_MAXLEN', 1000))
+"""Maximum amount of output lines / events kept in the Redis stream of a single ping / trace request"""
+
+STREAM_EXPIRE = int(env('STREAM_EXPIRE', 600))
+"""Amount of seconds that the Redis stream of a ping / trace request is kept, after its last output line"""
+
+STREAM_KEEPALIVE = int(env('STREAM_KEEPALIVE', 15))
+"""While no output has arrived, send an SSE keep-alive comment to streaming clients every this many seconds"""
+
+STREAM_MAX_TIME = int(env('STREAM_MAX_TIME', 300))
+"""
+Maximum amount of seconds that a single ``/api/v1/stream/<req_id>`` connection is kept open. Browsers will
+automatically re-connect (and resume from the last event received) if the request is still running.
+"""
+
+STATUS_MAX_WAIT = int(env('STATUS_MAX_WAIT', 30))
+"""
+Maximum amount of seconds that ``/api/v1/status/<req_id>?wait=N`` may wait for a request to finish.
+Each waiting client occupies a Gunicorn worker thread (see ``GU_THREADS`` in ``run.sh``) while it waits.
+"""
+
+DEDUP_WINDOW = int(env('DEDUP_WINDOW', 10))
+"""
+Identical ping / trace requests (same action, host and protocol) made within this many seconds of a previous one
+finishing are attached to the previous measurement, and share its result, instead of running a new ping / trace.
+Requests made while an identical measurement is still running always share it.
+
+Set to ``0`` to disable de-duplication. Default: ``10`` seconds
+"""
+
+DEDUP_MAX_RUNTIME = int(env('DEDUP_MAX_RUNTIME', 300))
+"""
+If a queued / running measurement hasn't finished after this many seconds (e.g. the runner crashed), new identical
+requests stop being attached to it.
+"""
+
+RESULT_TTL = int(env('RESULT_TTL', 86400))
+"""
+Ping / trace requests and their results are stored in Redis (``lg_request:<req_id>`` / ``lg_result:<req_id>``)
+for this many seconds, after which ``/api/v1/status/<req_id>`` will return ``NOT_FOUND``.
+
+Default: ``86400`` seconds = 24 hours
+"""
+
+DNS_TIMEOUT = float(env('DNS_TIMEOUT', 3))
+"""Maximum amount of seconds to spend resolving a hostname (across all nameservers / retries)"""
+
+DNS_MIN_TTL = int(env('DNS_MIN_TTL', 30))
+"""Resolved addresses are cached for at least this many seconds, even if the record's TTL is lower"""
+
+DNS_MAX_TTL = int(env('DNS_MAX_TTL', 3600))
+"""Resolved addresses are cached for at most this many seconds, even if the record's TTL is higher"""
+
+DNS_NEGATIVE_TTL = int(env('DNS_NEGATIVE_TTL', 60))
+"""Hostnames which don't exist / have no A or AAAA record are cached as such for this many seconds"""
+
+DNS_CACHE_SIZE = int(env('DNS_CACHE_SIZE', 10000))
+"""Maximum amount of DNS answers that each web worker / runner keeps in memory (in front of the Redis cache)"""
+
+PING_TIMEOUT = int(env('PING_TIMEOUT', 30))
+"""Pings which are still running after this many seconds are killed, and saved with the status ``timeout``"""
+
+TRACE_TIMEOUT = int(env('TRACE_TIMEOUT', 120))
+"""Traces which are still running after this many seconds are killed, and saved with the status ``timeout``"""
+
+ACTION_TIMEOUTS = {'ping': PING_TIMEOUT, 'trace': TRACE_TIMEOUT}
+
+CANCEL_POLL = float(env('CANCEL_POLL', 1))
+"""While a ping / trace is running, the runner checks whether it has been cancelled every this many seconds"""
+
+BATCH_MAX_TARGETS = int(env('BATCH_MAX_TARGETS', 500))
+"""Maximum amount of hosts which may be pinged / traced in a single ``/api/v1/batch`` request"""
+
+BATCH_CONCURRENCY = {
+    'ping': int(env('BATCH_CONCURRENCY_PING', 50)),
+    'trace': int(env('BATCH_CONCURRENCY_TRACE', 8)),
+}
+"""
+Maximum amount of hosts of a single batch request which are pinged (``BATCH_CONCURRENCY_PING``) / traced
+(``BATCH_CONCURRENCY_TRACE``) at the same time. A batch request only occupies one runner slot, regardless of this.
+"""
+
+BATCH_TIMEOUT = int(env('BATCH_TIMEOUT', 1800))
+"""
+Hosts of a batch request which haven't been pinged / traced after this many seconds are skipped, and saved with
+the status ``timeout``. Each individual host is still limited to ``PING_TIMEOUT`` / ``TRACE_TIMEOUT``.
+"""
+
+RATE_LIMITS = {
+    'ping': (float(env('RATE_LIMIT_PING', 30)), int(env('RATE_LIMIT_PING_BURST', 10))),
+    'trace': (float(env('RATE_LIMIT_TRACE', 6)), int(env('RATE_LIMIT_TRACE_BURST', 3))),
+    'batch': (float(env('RATE_LIMIT_BATCH', 1)), int(env('RATE_LIMIT_BATCH_BURST', 2))),
+}
+"""
+Per-client rate limits for submitting pings / traces / batches, as ``(requests per minute, burst)`` - e.g. by default,
+a client may send 3 traces at once, then one more every 10 seconds. Clients which go over the limit get HTTP 429 with a
+``Retry-After`` header, before their request is validated / resolved. Set ``RATE_LIMIT_<ACTION>=0`` to disable
+the limit for an action. Clients are identified by their IP (see ``RATE_LIMIT_PROXIES``), or their API key
+(see ``RATE_LIMIT_API_KEYS``).
+"""
+
+RATE_LIMIT_PROXIES = int(env('RATE_LIMIT_PROXIES', 0))
+"""
+Amount of reverse proxies (e.g. nginx) in front of the app, which append the client's IP to ``X-Forwarded-For``.
+If ``0``, clients are identified by the IP they connect from - if the app is behind nginx, set this to ``1``,
+otherwise all clients share the proxy's limit.
+"""
+
+RATE_LIMIT_API_KEYS = [k.strip() for k in env('RATE_LIMIT_API_KEYS', '').split(',') if k.strip()]
+"""
+Comma separated API keys. Clients which send one of these in the ``X-API-Key`` header are limited per key (with the
+limits multiplied by ``RATE_LIMIT_API_KEY_MULTIPLIER``), instead of per IP.
+"""
+
+RATE_LIMIT_API_KEY_MULTIPLIER = float(env('RATE_LIMIT_API_KEY_MULTIPLIER', 10))
+
+LOCATION_HEARTBEAT = int(env('LOCATION_HEARTBEAT', 15))
+"""Runners with a location (``LG_LOCATION``) re-register themselves in Redis every this many seconds"""
+
+LOCATION_TIMEOUT = int(env('LOCATION_TIMEOUT', 60))
+"""
+Locations whose runners haven't registered for this many seconds are considered offline - requests can no longer
+be sent to them, and they're no longer included in ``location=all``
+"""
+
+SCHEDULE_FILE = env('SCHEDULE_FILE', None)
+"""
+Path to a text file listing the targets which ``./manage.py scheduler`` should ping / trace on a schedule,
+storing the results as time series (see :mod:`lg.lookingglass.series`). One target per line, as
+``<action> <host>`` followed by any of ``interval=<seconds>``, ``proto=<any|ipv4|ipv6>`` and ``location=<id>``
+(``location=all`` isn't supported - list the target once for each location instead). Blank lines and comments
+(starting with ``#``) are ignored.
+
+Example file::
+
+    # Upstreams
+    ping 185.130.44.1 interval=60
+    trace 8.8.8.8 interval=600 proto=ipv4
+    ping 2a07:e00::1 location=se1
+
+"""
+
+SCHEDULE_DEFAULT_INTERVAL = int(env('SCHEDULE_DEFAULT_INTERVAL', 300))
+"""Seconds between each measurement of a scheduled target which doesn't specify an ``interval``"""
+
+SERIES_RAW_DAYS = int(env('SERIES_RAW_DAYS', 14))
+"""Individual measurements of scheduled targets are kept for this many days - only their rollups are kept after that"""
+
+SERIES_HOURLY_DAYS = int(env('SERIES_HOURLY_DAYS', 180))
+"""Hourly rollups of scheduled targets are kept for this many days. Daily rollups are kept forever."""
+
+SERIES_ROLLUP_INTERVAL = int(env('SERIES_ROLLUP_INTERVAL', 300))
+"""The scheduler updates the hourly / daily rollups (and removes expired measurements) every this many seconds"""
+
+SERIES_MAX_POINTS = int(env('SERIES_MAX_POINTS', 5000))
+"""Maximum amount of data points returned by a single ``/api/v1/series`` request"""
+
+METRICS_ENABLED = env('METRICS_ENABLED', '1').lower() in ['1', 'true', 'yes', 'y']
+"""
+Record queue wait times, job durations / outcomes and in-flight jobs in Redis, and serve them in the Prometheus
+text format at ``/metrics`` (see :mod:`lg.lookingglass.metrics`). Set to ``0`` to disable.
+"""
+
+METRICS_TOKEN = env('METRICS_TOKEN', None)
+"""
+If set, ``/metrics`` requires the header ``Authorization: Bearer <METRICS_TOKEN>``. Otherwise, anyone can view
+the metrics - so you may want to restrict ``/metrics`` in your reverse proxy instead.
+"""
+
+TRACE_ENRICH = env('TRACE_ENRICH', '1').lower() in ['1', 'true', 'yes', 'y']
+"""
+Annotate each hop of a trace with its origin ASN, AS name and matched prefix from the ``prefix`` table (which
+requires the BGP prefix import of the peer app, ``./manage.py prefixes``), and the IXP from ``IX_RANGES``.
+Set to ``0`` to disable - hops will then only contain their IP and reverse DNS.
+"""
+
+ENRICH_CACHE_SIZE = int(env('ENRICH_CACHE_SIZE', 10000))
+"""Maximum amount of hop IPs whose ASN / prefix each runner keeps in memory"""
+
+ENRICH_CACHE_TTL = int(env('ENRICH_CACHE_TTL', 300))
+"""Amount of seconds that each runner caches the ASN / prefix of a hop IP for"""
+
+TRACE_CYCLES = int(env('TRACE_CYCLES', 10))
+"""Amount of pings that ``mtr`` sends to each hop of a trace (``mtr -c``)"""
+
+PING_COUNT = int(env('PING_COUNT', 5))
+"""Amount of pings sent for a ping request (``ping -c``)"""
+
+PING_ENGINE = env('PING_ENGINE', 'auto').lower()
+"""
+How the async runner (``./manage.py queue --async``) sends pings:
+
+ - ``auto`` (default) - send pings from within the runner using unprivileged ICMP sockets
+   (see :mod:`lg.lookingglass.icmp`), falling back to the ``ping`` binary if the kernel doesn't allow them
+ - ``binary`` - always spawn a ``ping`` process per request
+
+The synchronous runner always uses the ``ping`` binary.
+"""
+
+PING_INTERVAL = float(env('PING_INTERVAL', 1))
+"""Amount of seconds between each echo request sent by the in-process ping engine"""
+
+PING_WAIT = float(env('PING_WAIT', 2))
+"""Amount of seconds that the in-process ping engine waits for the reply to each echo request"""
@@ -0,0 +1,97 @@
+"""
+
+A compiled subnet matcher, used to check IP addresses against large lists of networks (e.g. ``DISALLOW_SUBNETS``)
+in ``O(log n)`` time.
+
+Basic usage::
+
+    >>> from lg.lookingglass.subnets import SubnetMatcher
+    >>> m = SubnetMatcher(['10.0.0.0/8', '192.168.0.0/16', 'fc00::/7'])
+    >>> '10.1.2.3' in m
+    True
+    >>> '8.8.8.8' in m
+    False
+
+Copyright::
+    +===================================================+
+    |                 © 2019 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import ipaddress
+from bisect import bisect_right
+from ipaddress import IPv4Address, IPv6Address, IPv4Network, IPv6Network
+from typing import Dict, Iterable, List, Tuple, Union
+
+IPNetwork = Union[str, IPv4Network, IPv6Network]
+IPAddress = Union[str, IPv4Address, IPv6Address]
+
+
+class SubnetMatcher:
+    """
+    Compiles a list of IPv4 / IPv6 networks into sorted, non-overlapping integer intervals (one list per IP version),
+    so that checking whether an IP address is within any of the networks is a single binary search.
+
+    IPv4-mapped IPv6 addresses (e.g. ``::ffff:10.0.0.1``) are also checked against the IPv4 networks.
+
+    :param Iterable[IPNetwork] networks: The networks to match against, as strings or ``ip_network`` objects
+    """
+    def __init__(self, networks: Iterable[IPNetwork] = ()):
+        ranges = {4: [], 6: []}   # type: Dict[int, List[Tuple[int, int]]]
+        for net in networks:
+            net = ipaddress.ip_network(net, strict=False)
+            ranges[net.version].append((int(net.network_address), int(net.broadcast_address)))
+
+        self._starts, self._ends = {}, {}   # type: Dict[int, List[int]], Dict[int, List[int]]
+        for ver, rngs in ranges.items():
+            starts, ends = [], []
+            # Merge overlapping / adjacent ranges, so each address falls in at most one interval
+            for start, end in sorted(rngs):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                    continue
+                starts.append(start)
+                ends.append(end)
+            self._starts[ver], self._ends[ver] = starts, ends
+
+    def __len__(self):
+        """The amount of (merged) intervals in this matcher"""
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def __contains__(self, ip: IPAddress) -> bool:
+        ip = ipaddress.ip_address(ip)
+        if isinstance(ip, IPv6Address) and ip.ipv4_mapped is not None and self._match(ip.ipv4_mapped):
+            return True
+        return self._match(ip)
+
+    def _match(self, ip: Union[IPv4Address, IPv6Address]) -> bool:
+        n, starts = int(ip), self._starts[ip.version]
+        i = bisect_right(starts, n) - 1
+        return i >= 0 and n <= self._ends[ip.version][i]
+
+
+def load_subnets_file(path: str) -> List[Union[IPv4Network, IPv6Network]]:
+    """
+    Load a list of networks from a text file, containing one CIDR network per line. Blank lines, and anything
+    after a ``#`` are ignored.
+
+    :param str path: Path to the file to load
+    :raises ValueError: When a line in the file isn't a valid IPv4/IPv6 network
+    :return list networks: A list of ``ip_network`` objects
+    """
+    nets = []
+    with open(path) as fh:
+        for line in fh:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                nets.append(ipaddress.ip_network(line, strict=False))
+    return nets
@@ -1,14 +1,28 @@
 import json
 import logging
+import re
+import time
 import traceback
-from typing import Tuple
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
 from uuid import uuid4
 
-from flask import Response, request, render_template, Blueprint
+from flask import Response, request, render_template, Blueprint, stream_with_context
 from flask.json import jsonify
 
-from lg.base import RMQ_QUEUE, get_rmq_chan, get_redis
-from lg.lookingglass.helpers import validate_host
+from lg.base import RMQ_QUEUES, QUEUE_RETRY_AFTER, DEFAULT_LOCATION, get_publisher, get_redis, location_queue, \
+    get_app
+from lg.exceptions import QueueError, QueueFull
+from lg.lookingglass.helpers import resolve_host
+from lg.lookingglass.jobs import cancel, read_stream, stream_key, wait_done, claim_job, inflight_key, job_id, \
+    save_request, get_request, get_result, request_key, child_id, share_job, shared_key
+from lg.lookingglass.locations import active_locations
+from lg.lookingglass.metrics import count_request, render
+from lg.lookingglass.ratelimit import get_limiter
+from lg.lookingglass.series import RESOLUTIONS, get_series, list_targets
+from lg.lookingglass.settings import STREAM_KEEPALIVE, STREAM_MAX_TIME, STATUS_MAX_WAIT, BATCH_MAX_TARGETS, \
+    METRICS_ENABLED, METRICS_TOKEN, RATE_LIMIT_PROXIES, RATE_LIMIT_API_KEYS, RATE_LIMIT_API_KEY_MULTIPLIER
 
 log = logging.getLogger(__name__)
 
@@ -21,11 +35,21 @@ API_ERRORS = (
     ('INV_PROTO', ("Invalid IP protocol, choose one of 'any', 'ipv4', 'ipv6'", 400)),
     ('NOT_FOUND', ("No records could be found for that object", 404)),
     ('NO_HOST', ('No IP Address / Hostname specified', 400)),
+    ('QUEUE_ERROR', ("Could not queue your request right now. Please try again shortly.", 503)),
+    ('QUEUE_FULL', ("There are too many requests waiting to be processed. Please try again shortly.", 503)),
+    ('NO_TARGETS', ('No IP Addresses / Hostnames specified in targets', 400)),
+    ('TOO_MANY_TARGETS', (f'Too many targets - a batch may contain up to {BATCH_MAX_TARGETS} hosts', 400)),
+    ('INV_TARGETS', ("One or more IP addresses / hostnames are invalid (see 'invalid')", 400)),
+    ('INV_LOCATION', ("Unknown location, or it has no runners online right now (see /api/v1/locations)", 400)),
+    ('NO_LOCATIONS', ("No locations have runners online right now. Please try again shortly.", 503)),
+    ('RATE_LIMITED', ("You're sending requests too quickly. Please wait a moment before trying again.", 429)),
+    ('INV_TIME', ("Invalid 'from' / 'to' time - use a unix timestamp or ISO 8601 date/time, with from < to", 400)),
+    ('INV_RESOLUTION', ("Invalid resolution, choose one of 'auto', 'raw', 'hour', 'day'", 400)),
     ('UNKNOWN', ("Something went wrong and we don't know why...", 500)),
 )
 
 
-def json_err(err_code: str) -> Tuple[Response, int]:
+def json_err(err_code: str, **extra) -> Tuple[Response, int]:
     """
     Helper function, looks up err_code in `API_ERRORS`, generates json error and returns error code
     Can be used in flask views like this:
@@ -34,6 +58,7 @@ def json_err(err_code: str) -> Tuple[Response, int]:
         >>> return json_err('NO_HOST')
 
     :param err_code: The string error code as defined in `API_ERRORS` that you want to return
+    :param extra: Any additional keys to include in the JSON error
     :return: (jsonify(), status_code)
     """
     err_dict = dict(API_ERRORS)
@@ -43,7 +68,58 @@ def json_err(err_code: str) -> Tuple[Response, int]:
         err_code = 'UNKNOWN'
     err = err_dict[err_code]
 
-    return jsonify(error=True, message=err[0], err_code=err_code), err[1]
+    return jsonify(error=True, message=err[0], err_code=err_code, **extra), err[1]
+
+
+def invalid_err(action: str, err_code: str, **extra) -> Tuple[Response, int]:
+    """Counts a request to ``action`` which failed validation (see :mod:`.metrics`), and returns ``err_code``"""
+    count_request(get_redis(), action, 'invalid')
+    return json_err(err_code, **extra)
+
+
+def queue_err(e: QueueError, action: str) -> Tuple[Response, int]:
+    """Returns ``QUEUE_FULL`` (with a ``Retry-After`` header) or ``QUEUE_ERROR`` for a failed publish"""
+    if not isinstance(e, QueueFull):
+        count_request(get_redis(), action, 'queue_error')
+        return json_err('QUEUE_ERROR')
+    count_request(get_redis(), action, 'queue_full')
+    res, status = json_err('QUEUE_FULL')
+    res.headers['Retry-After'] = str(QUEUE_RETRY_AFTER)
+    return res, status
+
+
+def client_id() -> Tuple[str, float]:
+    """
+    Identify the client of the current request for rate limiting - by its API key (``X-API-Key``), if it's one of
+    ``RATE_LIMIT_API_KEYS``, otherwise by its IP address.
+
+    :return tuple client: ``(client, multiplier)`` - the ID of the client, and the multiplier for its rate limits
+    """
+    key = request.headers.get('X-API-Key', '').strip()
+    if key and key in RATE_LIMIT_API_KEYS:
+        return f'key:{key}', RATE_LIMIT_API_KEY_MULTIPLIER
+    # Each trusted proxy appends the address it received the request from to X-Forwarded-For
+    route = request.access_route
+    if 0 < RATE_LIMIT_PROXIES <= len(route):
+        return route[-RATE_LIMIT_PROXIES], 1.0
+    return request.remote_addr or 'unknown', 1.0
+
+
+def rate_limit(action: str) -> Optional[Tuple[Response, int]]:
+    """
+    Take a token from the current client's bucket for ``action`` (see :mod:`.ratelimit`). Returns a
+    ``RATE_LIMITED`` error (with ``Retry-After``) if the client is over its limit, otherwise ``None``.
+    """
+    client, multiplier = client_id()
+    r = get_redis()
+    allowed, retry_after = get_limiter(r).hit(action, client, multiplier=multiplier)
+    if allowed:
+        return None
+    log.info('Rate limited %s request from %s (retry after %ds)', action, client, retry_after)
+    count_request(r, action, 'rate_limited')
+    res, status = json_err('RATE_LIMITED', retry_after=retry_after)
+    res.headers['Retry-After'] = str(max(retry_after, 1))
+    return res, status
 
 
 @flask.route('/')
@@ -51,6 +127,107 @@ def index():
     return render_template('index.html')
 
 
+def _get_location() -> str:
+    """The ``location`` requested by the client - ``DEFAULT_LOCATION`` if none was given (``''`` = global queues)"""
+    return (request.values.get('location') or '').strip() or DEFAULT_LOCATION
+
+
+def _fan_out(action: str, proto: str, host: str, ip: str, req_id: str, locations: List[str]):
+    """
+    Queue a ping / trace in each of ``locations``, as one child request per location (``<req_id>@<location>``).
+    The runners collect each location's result into the parent request ``req_id`` (see :func:`.collect_location`).
+    """
+    _data = dict(req_id=req_id, action=action, host=host, proto=proto, locations=locations, status='waiting')
+    log.debug('/api/v1/%s - host: %s req_id: %s locations: %s', action, host, req_id, locations)
+    r, publisher = get_redis(), get_publisher()
+    save_request(r, req_id, _data)
+    queued = []
+    try:
+        for loc in locations:
+            child = dict(
+                req_id=child_id(req_id, loc), action=action, host=host, proto=proto, location=loc, parent=req_id,
+                status='waiting'
+            )
+            save_request(r, child['req_id'], child)
+            publisher.publish(
+                location_queue(RMQ_QUEUES[action], loc), json.dumps({**child, 'ip': ip, 'queued_at': time.time()})
+            )
+            queued.append(loc)
+    except QueueError as e:
+        log.warning('Failed to queue %s request %s for host %s - %s', action, req_id, host, str(e))
+        # Skip the locations which were already queued, as the request can never finish
+        cancel(r, {**_data, 'locations': queued})
+        r.delete(request_key(req_id), *[request_key(child_id(req_id, loc)) for loc in locations])
+        return queue_err(e, action)
+    count_request(r, action, 'queued')
+    return jsonify(error=False, result=_data)
+
+
+def _submit(action: str, proto: str):
+    """
+    Validate a ping / trace request, then either queue it for the background runners, or - if an identical
+    request is already running / finished within the last ``DEDUP_WINDOW`` seconds - attach it to that one.
+    """
+    # Refuse clients which are sending too many requests, before doing any work for them (e.g. DNS lookups)
+    limited = rate_limit(action)
+    if limited is not None: return limited
+
+    host = request.values.get('host', None)
+    host = host.strip() if host is not None else None
+
+    # Validate the passed data before sending it to redis + rabbitmq
+    if not host: return invalid_err(action, 'NO_HOST')
+    if proto not in ['any', 'ipv4', 'ipv6']: return invalid_err(action, 'INV_PROTO')
+    location = _get_location()
+    if location == 'all':
+        locations = sorted(active_locations(get_redis(), action).keys())
+        if len(locations) == 0: return invalid_err(action, 'NO_LOCATIONS')
+    elif location and location not in active_locations(get_redis(), action):
+        return invalid_err(action, 'INV_LOCATION')
+    # Resolve the host (if it's a hostname) - the IP is passed to the runner, so it doesn't need to resolve it again
+    ip = resolve_host(host, proto)
+    if ip is None: return invalid_err(action, 'INV_HOST')
+
+    # Generate a unique request ID, and an action object to send via rabbitmq + store in redis
+    req_id = str(uuid4())
+    if location == 'all':
+        return _fan_out(action, proto, host, ip, req_id, locations)
+    _data = dict(req_id=req_id, action=action, host=host, proto=proto, status='waiting')
+    if location:
+        _data['location'] = location
+    log.debug('/api/v1/%s - host: %s req_id: %s', action, host, req_id)
+
+    r = get_redis()
+    leader = claim_job(r, action, proto, host, req_id, location)
+    if leader is not None:
+        # An identical measurement is already running / just finished - share its results instead
+        log.debug('Attaching req_id %s to identical request %s', req_id, leader)
+        _data['alias_of'] = leader
+        save_request(r, req_id, _data)
+        share_job(r, req_id, leader)
+        count_request(r, action, 'deduplicated')
+        return jsonify(error=False, result=_data)
+
+    # Store the JSON action details in Redis under the request ID
+    save_request(r, req_id, _data)
+    share_job(r, req_id, req_id)
+
+    # Send the action details via RabbitMQ for processing by background workers
+    dedup_key = inflight_key(action, proto, host, location)
+    data = json.dumps({**_data, 'ip': ip, 'dedup_key': dedup_key, 'queued_at': time.time()})
+    try:
+        get_publisher().publish(location_queue(RMQ_QUEUES[action], location), data)
+    except QueueError as e:
+        log.warning('Failed to queue %s request %s for host %s - %s', action, req_id, host, str(e))
+        # Don't let identical requests attach themselves to a request which will never run
+        r.delete(dedup_key, request_key(req_id), shared_key(req_id))
+        return queue_err(e, action)
+    count_request(r, action, 'queued')
+
+    # Return the action details to the client for status querying
+    return jsonify(error=False, result=_data)
+
+
 @flask.route('/api/v1/trace', defaults=dict(proto='any'), methods=['POST'])
 @flask.route('/api/v1/trace/<proto>', methods=['POST'])
 def api_trace(proto):
@@ -80,39 +257,19 @@ def api_trace(proto):
                 action: str = The action you requested on the given host,
                 host: str = The IP / hostname you requested to trace,
                 proto: str = The protocol that will be used for the trace
+                alias_of: str = (Only if an identical request was made recently) The req_id of the
+                                identical request, which this request shares results with
+                location: str = (Only if sent to a specific location) The location it will run from
+                locations: list = (Only for ``location=all``) The locations it will run from
             }
         }
 
+    Pass ``location`` (one of the IDs listed by :func:`.api_locations`) to run the request from that location, or
+    ``location=all`` to run it from every location at once - the ``result`` of the request is then keyed by location.
 
-    """
-    host = request.values.get('host', None)
-    host = host.strip() if host is not None else None
-
-    # Validate the passed data before sending it to redis + rabbitmq
-    validators = (
-        ('NO_HOST', not host), ('INV_HOST', not validate_host(host, proto)),
-        ('INV_PROTO', proto not in ['any', 'ipv4', 'ipv6'])
-    )
-    for err, check in validators:
-        if check: return json_err(err)
-
-    # Generate a unique request ID, and an action object to send via rabbitmq + store in redis
-    req_id = str(uuid4())
-    _data = dict(req_id=req_id, action='trace', host=host, proto=proto, status='waiting')
-    data = json.dumps(_data)
-    log.debug('/api/v1/trace - host: %s req_id: %s', host, req_id)
-
-    # Store the JSON action details in Redis under the request ID
-    r = get_redis()
-    r.hset('lg_requests', req_id, data)
-
-    # Send the action details via RabbitMQ for processing by background workers
-    chan = get_rmq_chan()
-    chan.queue_declare(RMQ_QUEUE)
-    chan.basic_publish(exchange='', routing_key=RMQ_QUEUE, body=data)
 
-    # Return the action details to the client for status querying
-    return jsonify(error=False, result=_data)
+    """
+    return _submit('trace', proto)
 
 
 @flask.route('/api/v1/ping', defaults=dict(proto='any'), methods=['POST'])
@@ -144,48 +301,226 @@ def api_ping(proto):
                 action: str = The action you requested on the given host,
                 host: str = The IP / hostname you requested to trace,
                 proto: str = The protocol that will be used for the trace
+                alias_of: str = (Only if an identical request was made recently) The req_id of the
+                                identical request, which this request shares results with
+                location: str = (Only if sent to a specific location) The location it will run from
+                locations: list = (Only for ``location=all``) The locations it will run from
             }
         }
 
+    Pass ``location`` (one of the IDs listed by :func:`.api_locations`) to run the request from that location, or
+    ``location=all`` to run it from every location at once - the ``result`` of the request is then keyed by location.
+
 
     """
-    host = request.values.get('host', None)
-    host = host.strip() if host is not None else None
+    return _submit('ping', proto)
 
-    # Validate the passed data before sending it to redis + rabbitmq
-    validators = (
-        ('NO_HOST', not host), ('INV_HOST', not validate_host(host, proto)),
-        ('INV_PROTO', proto not in ['any', 'ipv4', 'ipv6'])
-    )
-    for err, check in validators:
-        if check: return json_err(err)
 
-    # Generate a unique request ID, and an action object to send via rabbitmq + store in redis
+def _get_targets() -> Optional[List[str]]:
+    """
+    Extract the target hosts of a batch request - either a JSON body ``{"targets": [...]}``, or the form / query
+    value(s) ``targets``, separated by commas / whitespace. Duplicates are removed, keeping the original order.
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and 'targets' in body:
+        targets = body['targets'] if isinstance(body['targets'], list) else [body['targets']]
+    else:
+        targets = request.values.getlist('targets')
+    hosts = [h for t in targets for h in re.split(r'[\s,]+', str(t)) if h]
+    return list(dict.fromkeys(hosts))
+
+
+@flask.route('/api/v1/batch/<any(ping, trace):action>', defaults=dict(proto='any'), methods=['POST'])
+@flask.route('/api/v1/batch/<any(ping, trace):action>/<proto>', methods=['POST'])
+def api_batch(action, proto):
+    """
+    Ping / trace a list of hosts as one request. The hosts are pinged / traced by a single runner (from ``location``,
+    if given - ``location=all`` isn't supported for batches), up to
+    ``BATCH_CONCURRENCY_PING`` / ``BATCH_CONCURRENCY_TRACE`` at a time, and their results are stored together
+    under one ``req_id`` - fetch them all with a single call to :func:`.api_status`.
+
+    Example::
+
+        POST /api/v1/batch/ping
+        Content-Type: application/json
+
+        {"targets": ["8.8.4.4", "1.1.1.1", "example.com"]}
+
+        HTTP/1.1 200 OK
+
+        {
+            "error": false,
+            "result": {
+                "req_id": "abcd123-defa", "action": "batch", "batch_action": "ping", "proto": "any",
+                "targets": [{"host": "8.8.4.4", "ip": "8.8.4.4"}, ...], "status": "waiting"
+            }
+        }
+
+    Targets may also be sent as the form / query value ``targets``, separated by commas or whitespace.
+
+    All targets are validated up-front - if any of them are invalid / disallowed, nothing is queued, and the error
+    ``INV_TARGETS`` lists every invalid target in ``invalid``.
+
+    Once finished, ``result`` in :func:`.api_status` contains a ``summary`` (amount of ``reachable`` /
+    ``unreachable`` / ``invalid`` / ``timeout`` / ``cancelled`` targets), and ``targets`` - the ``status``,
+    ``reachable`` flag and parsed ``result`` of each target. While it's running, :func:`.api_stream` sends a
+    ``target`` event as each target finishes.
+    """
+    limited = rate_limit('batch')
+    if limited is not None: return limited
+
+    hosts = _get_targets()
+    if len(hosts) == 0: return invalid_err('batch', 'NO_TARGETS')
+    if len(hosts) > BATCH_MAX_TARGETS: return invalid_err('batch', 'TOO_MANY_TARGETS')
+    if proto not in ['any', 'ipv4', 'ipv6']: return invalid_err('batch', 'INV_PROTO')
+    location = _get_location()
+    if location and (location == 'all' or location not in active_locations(get_redis(), action)):
+        return invalid_err('batch', 'INV_LOCATION')
+
+    # Resolve the targets in parallel, as some of them may be hostnames which aren't cached yet
+    with ThreadPoolExecutor(max_workers=min(len(hosts), 16)) as pool:
+        ips = list(pool.map(lambda h: resolve_host(h, proto), hosts))
+    invalid = [h for h, ip in zip(hosts, ips) if ip is None]
+    if len(invalid) > 0: return invalid_err('batch', 'INV_TARGETS', invalid=invalid)
+
     req_id = str(uuid4())
-    _data = dict(req_id=req_id, action='ping', host=host, proto=proto, status='waiting')
-    data = json.dumps(_data)
-    log.debug('/api/v1/ping - host: %s req_id: %s', host, req_id)
+    targets = [dict(host=h, ip=ip) for h, ip in zip(hosts, ips)]
+    _data = dict(req_id=req_id, action='batch', batch_action=action, proto=proto, targets=targets, status='waiting')
+    if location:
+        _data['location'] = location
+    log.debug('/api/v1/batch/%s - %d targets, req_id: %s', action, len(targets), req_id)
 
-    # Store the JSON action details in Redis under the request ID
     r = get_redis()
-    r.hset('lg_requests', req_id, data)
+    save_request(r, req_id, _data)
+    try:
+        queue = location_queue(RMQ_QUEUES[action], location)
+        get_publisher().publish(queue, json.dumps({**_data, 'queued_at': time.time()}))
+    except QueueError as e:
+        log.warning('Failed to queue batch %s request %s - %s', action, req_id, str(e))
+        r.delete(request_key(req_id))
+        return queue_err(e, 'batch')
+    count_request(r, 'batch', 'queued')
 
-    # Send the action details via RabbitMQ for processing by background workers
-    chan = get_rmq_chan()
-    chan.queue_declare(RMQ_QUEUE)
-    chan.basic_publish(exchange='', routing_key=RMQ_QUEUE, body=data)
-
-    # Return the action details to the client for status querying
     return jsonify(error=False, result=_data)
 
 
+@flask.route('/api/v1/locations')
+def api_locations():
+    """
+    List the locations which currently have runners online, and the location used when none is requested.
+
+    Example::
+
+        GET /api/v1/locations
+
+        HTTP/1.1 200 OK
+
+        {
+            "error": false,
+            "result": {
+                "se1": {"name": "Stockholm, SE", "actions": ["ping", "trace"], "runners": 2},
+                "nl1": {"name": "Amsterdam, NL", "actions": ["ping"], "runners": 1}
+            },
+            "default": "se1"
+        }
+
+    """
+    return jsonify(error=False, result=active_locations(get_redis()), default=DEFAULT_LOCATION or None)
+
+
+def _get_time(name: str, default: datetime) -> Optional[datetime]:
+    """
+    Parse the request value ``name`` (unix timestamp, or ISO 8601 - in UTC unless it has an offset) as a naive UTC
+    datetime. Returns ``None`` if it's invalid.
+    """
+    value = request.values.get(name, '').strip()
+    if not value:
+        return default
+    try:
+        return datetime.utcfromtimestamp(float(value))
+    except (ValueError, OverflowError, OSError):
+        pass
+    try:
+        dt = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+        # Times with an offset are converted to (naive) UTC, so they're comparable with utcnow() / the other bound
+        return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo is not None else dt
+    except (ValueError, OverflowError):
+        return None
+
+
+@flask.route('/api/v1/series/targets')
+def api_series_targets():
+    """
+    List the targets which are measured on a schedule (see ``SCHEDULE_FILE``).
+
+    Example::
+
+        GET /api/v1/series/targets
+
+        {
+            "error": false,
+            "result": [
+                {"id": 1, "action": "ping", "host": "8.8.8.8", "proto": "any", "location": "", "interval": 60}
+            ]
+        }
+
+    """
+    _, db, _ = get_app()
+    with db.engine.connect() as conn:
+        return jsonify(error=False, result=list_targets(conn))
+
+
+@flask.route('/api/v1/series/<int:target_id>')
+def api_series(target_id):
+    """
+    Time series of a scheduled target's measurements (see :func:`lg.lookingglass.series.get_series`).
+
+    Query parameters (all optional):
+
+     - ``from`` / ``to`` - unix timestamp or ISO 8601 date/time in UTC (default: the last 24 hours)
+     - ``resolution`` - ``raw`` (individual measurements), ``hour``, ``day``, or ``auto`` (default) to pick
+       one based on the time range
+
+    Example::
+
+        GET /api/v1/series/1?from=2019-10-01T00:00:00&to=2019-10-08T00:00:00
+
+        {
+            "error": false,
+            "result": {
+                "target": {"id": 1, "action": "ping", "host": "8.8.8.8", "proto": "any", "location": "", ...},
+                "resolution": 3600,
+                "columns": ["ts", "sent", "recv", "loss", "min", "avg", "max", "samples"],
+                "points": [["2019-10-01T00:00:00", 60, 60, 0.0, 1.1, 1.2, 1.9, 12], ...]
+            }
+        }
+
+    """
+    now = datetime.utcnow()
+    end = _get_time('to', now)
+    start = _get_time('from', None if end is None else end - timedelta(days=1))
+    if start is None or end is None or start >= end:
+        return json_err('INV_TIME')
+    resolution = request.values.get('resolution', 'auto')
+    if resolution != 'auto' and resolution not in RESOLUTIONS:
+        return json_err('INV_RESOLUTION')
+
+    _, db, _ = get_app()
+    with db.engine.connect() as conn:
+        target = [t for t in list_targets(conn) if t['id'] == target_id]
+        if len(target) == 0:
+            return json_err('NOT_FOUND')
+        series = get_series(conn, target_id, start, end, RESOLUTIONS.get(resolution))
+    return jsonify(error=False, result=dict(target=target[0], **series))
+
+
 @flask.route('/api/v1/status/<req_id>')
 def api_status(req_id):
     """
 
     Example::
 
-        GET /api/v1/status/3aff7567-8766-44d4-8c1a-d6c33c1e1ca2
+        GET /api/v1/status/3aff7567-8766-44d4-8c1a-d6c33c1e1ca2?wait=30
 
         HTTP/1.1 200 OK
 
@@ -196,11 +531,17 @@ def api_status(req_id):
             "host": "2a07:e00::666",
             "proto": "any",
             "req_id": "3aff7567-8766-44d4-8c1a-d6c33c1e1ca2",
-            "result": "Very Long String Containing Results of trace/ping etc.",
+            "result": {"hops": [{"hop": 1, "ip": "185.130.44.1", "host": "router.example", "asn": null, "sent": 10,
+                                 "recv": 10, "loss": 0.0, "last": 1.2, "min": 1.1, "avg": 1.2, "max": 1.5,
+                                 "stdev": 0.1}, ...], "errors": []},
             "status": "finished"
           }
         }
 
+    If ``wait`` is passed (in seconds, up to ``STATUS_MAX_WAIT``), and the request hasn't finished yet, the response
+    is held until the request finishes, or ``wait`` seconds have passed - whichever happens first. This allows
+    clients to receive the result as soon as it's ready, without repeatedly polling this endpoint.
+
     :param req_id:
     :return:
 
@@ -213,28 +554,173 @@ def api_status(req_id):
                 action: str = The action you requested on the given host,
                 host: str = The IP / hostname you requested to trace,
                 proto: str = The protocol that was used for the trace,
-                status: str = Either ``waiting`` or ``finished`` ,
-                result: str = A long multi-line string containing the results of the trace/ping etc.
+                status: str = One of ``waiting``, ``finished``, ``timeout`` or ``cancelled`` - for ``timeout``
+                              / ``cancelled``, ``result`` contains any output up to when the ping/trace was killed
+
+                result: dict = The parsed results of the trace / ping. For traces, ``hops`` is a list of per-hop
+                               stats (see :class:`lg.lookingglass.parsers.MtrRawParser`). For pings, the sent /
+                               received / loss / min / avg / max / stdev stats, plus each reply
+                               (see :class:`lg.lookingglass.parsers.PingParser`).
+                               For ``location=all`` requests, a dict mapping each location to its own
+                               ``{location, status, result}`` - the ``status`` of the whole request is ``finished``
+                               once every location has finished.
             }
         }
 
 
     """
-    # Look up the original request details in the lg_requests hash set
+    try:
+        wait = min(max(int(request.values.get('wait', 0)), 0), STATUS_MAX_WAIT)
+    except (TypeError, ValueError):
+        wait = 0
+
+    # Look up the original request details, plus any results (from the original request, if this is an alias)
     r = get_redis()
-    req_attempt = r.hget('lg_requests', req_id)
+    req_attempt, results = get_request(r, req_id)
     if not req_attempt:
         return json_err('NOT_FOUND')
 
-    req_attempt = json.loads(req_attempt)
+    # If the client asked us to wait for the result, block until the runner says it's done (or we time out)
+    jid = job_id(req_attempt)
+    if results is None and wait > 0 and wait_done(r, jid, wait):
+        results = get_result(r, jid)
+
     # If there are no results for this request, just return the request details
     data = req_attempt
 
     # If there are results, merge them with the original request information
-    results = r.hget('lg_results', req_id)
     if results is not None:
-        results = json.loads(results)
         data = {**req_attempt, 'status': 'finished', **results}
 
     return jsonify(error=False, result=data)
 
+
+@flask.route('/api/v1/cancel/<req_id>', methods=['POST'])
+def api_cancel(req_id):
+    """
+    Cancel a queued / running ping or trace. If it's running, it's killed, and any output so far is saved
+    with the status ``cancelled``.
+
+    Example::
+
+        POST /api/v1/cancel/3aff7567-8766-44d4-8c1a-d6c33c1e1ca2
+
+        HTTP/1.1 200 OK
+
+        { "error": false, "result": { "req_id": "3aff7567-8766-44d4-8c1a-d6c33c1e1ca2", "cancelled": true } }
+
+    ``cancelled`` is ``false`` if the request had already finished. If other requests share the same measurement
+    (see ``alias_of``), it keeps running for them, and only this request is cancelled.
+    """
+    r = get_redis()
+    req_attempt, _ = get_request(r, req_id)
+    if not req_attempt:
+        return json_err('NOT_FOUND')
+    return jsonify(error=False, result=dict(req_id=req_id, cancelled=cancel(r, req_attempt)))
+
+
+def _sse(event: str, data, ev_id: str = None) -> str:
+    """Format a single Server-Sent Event, with ``data`` encoded as JSON"""
+    msg = f'id: {ev_id}\n' if ev_id else ''
+    return msg + f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+@flask.route('/api/v1/stream/<req_id>')
+def api_stream(req_id):
+    """
+    Stream the output of a ping / trace request as `Server-Sent Events`_, as each line is printed by the runner.
+
+    Example::
+
+        GET /api/v1/stream/3aff7567-8766-44d4-8c1a-d6c33c1e1ca2
+
+        HTTP/1.1 200 OK
+        Content-Type: text/event-stream
+
+        id: 1571234567890-0
+        event: line
+        data: "PING 8.8.4.4 (8.8.4.4) 56(84) bytes of data."
+
+        id: 1571234567990-0
+        event: line
+        data: "64 bytes from 8.8.4.4: icmp_seq=1 ttl=120 time=1.23 ms"
+
+        ...
+
+        id: 1571234572000-0
+        event: done
+        data: {"action": "ping", "host": "8.8.4.4", "req_id": "3aff7567-...", "status": "finished", "result": "..."}
+
+    For pings, each ``line`` event contains one line of output as a JSON string. For traces, ``update`` events
+    contain the partial parsed result so far (in the same format as ``result`` in :func:`.api_status`). For batch
+    requests, each ``target`` event contains the result of one target, as soon as it's finished. For
+    ``location=all`` requests, each ``location`` event contains the result of one location (the live output of
+    each location can be streamed from ``/api/v1/stream/<req_id>@<location>``). The final
+    ``done`` event contains the same result object as :func:`.api_status`, after which the stream is closed.
+
+    If the connection is dropped, browsers will re-connect with the ``Last-Event-ID`` header, and the stream
+    resumes after that event.
+
+    .. _Server-Sent Events: https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events
+
+    """
+    r = get_redis()
+    req_attempt, results = get_request(r, req_id)
+    if not req_attempt:
+        return json_err('NOT_FOUND')
+    jid, last_id = job_id(req_attempt), request.headers.get('Last-Event-ID', '0')
+
+    def done_event(results: dict, ev_id: str = None) -> str:
+        return _sse('done', {**req_attempt, 'status': 'finished', **results}, ev_id)
+
+    def generate():
+        yield 'retry: 3000\n\n'
+        # If the request finished before it had a stream (or the stream expired), or it was detached from the
+        # measurement it shared (see :func:`.cancel`), just send the final result
+        if results is not None and (req_attempt.get('detached') or not r.exists(stream_key(jid))):
+            yield done_event(results)
+            return
+
+        ev_id, deadline = last_id, time.time() + STREAM_MAX_TIME
+        while time.time() < deadline:
+            events = read_stream(r, jid, ev_id, block=STREAM_KEEPALIVE * 1000)
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            for ev_id, kind, data in events:
+                if kind == 'done':
+                    yield done_event(data, ev_id)
+                    return
+                yield _sse(kind, data, ev_id)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',     # Prevent nginx from buffering the stream
+    })
+
+
+@flask.route('/metrics')
+def metrics():
+    """
+    Runner / queue metrics in the Prometheus text format (see :mod:`lg.lookingglass.metrics`), e.g.::
+
+        lg_job_wait_seconds_bucket{action="ping",le="0.5"} 1432
+        lg_jobs_in_flight{action="trace"} 3
+        lg_queue_depth{queue="lg_trace"} 12
+
+    If ``METRICS_TOKEN`` is set, the header ``Authorization: Bearer <METRICS_TOKEN>`` is required.
+    """
+    if not METRICS_ENABLED:
+        return json_err('NOT_FOUND')
+    if METRICS_TOKEN and request.headers.get('Authorization', '') != f'Bearer {METRICS_TOKEN}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+
+    depths, publisher, r = {}, get_publisher(), get_redis()
+    queues = set(RMQ_QUEUES.values())
+    queues |= {location_queue(q, loc) for loc in active_locations(r) for q in RMQ_QUEUES.values()}
+    for queue in sorted(queues):
+        try:
+            depths[queue] = publisher.queue_depth(queue)
+        except QueueError as e:
+            log.warning('Could not get the depth of queue %s - %s', queue, str(e))
+    return Response(render(r, depths), mimetype='text/plain; version=0.0.4')
@@ -181,3 +181,53 @@ class Community(db.Model):
     updated_at = db.Column(db.DateTime(), default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
 
 
+class MeasurementTarget(db.Model):
+    """A ping / trace target which is measured on a schedule (see :mod:`lg.lookingglass.scheduler`)"""
+    __tablename__ = 'measurement_target'
+    __table_args__ = (db.UniqueConstraint('action', 'host', 'proto', 'location'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    action = db.Column(db.String(10), nullable=False)
+    host = db.Column(db.String(255), nullable=False)
+    proto = db.Column(db.String(10), nullable=False, default='any', server_default='any')
+    location = db.Column(db.String(64), nullable=False, default='', server_default='')
+    interval = db.Column(db.Integer, nullable=False)
+
+    created_at = db.Column(db.DateTime(), default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime(), default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return f'<MeasurementTarget id={self.id} {self.action} {self.host} proto={self.proto} location={self.location}>'
+
+
+class MeasurementSample(db.Model):
+    """
+    A single scheduled measurement. Only fixed-width columns are used, so each row takes the same (small) amount
+    of space. For traces, the stats are those of the final hop, and ``hops`` is the amount of hops.
+    """
+    __tablename__ = 'measurement_sample'
+
+    target_id = db.Column(db.Integer, db.ForeignKey('measurement_target.id', ondelete='CASCADE'), primary_key=True)
+    ts = db.Column(db.DateTime, primary_key=True, index=True)
+    sent = db.Column(db.SmallInteger, nullable=False)
+    recv = db.Column(db.SmallInteger, nullable=False)
+    rtt_min = db.Column(db.Float(precision=24), nullable=True)
+    rtt_avg = db.Column(db.Float(precision=24), nullable=True)
+    rtt_max = db.Column(db.Float(precision=24), nullable=True)
+    rtt_stdev = db.Column(db.Float(precision=24), nullable=True)
+    hops = db.Column(db.SmallInteger, nullable=True)
+
+
+class MeasurementRollup(db.Model):
+    """Scheduled measurements aggregated per hour / day (``resolution`` is ``3600`` or ``86400``)"""
+    __tablename__ = 'measurement_rollup'
+
+    target_id = db.Column(db.Integer, db.ForeignKey('measurement_target.id', ondelete='CASCADE'), primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    samples = db.Column(db.Integer, nullable=False)
+    sent = db.Column(db.Integer, nullable=False)
+    recv = db.Column(db.Integer, nullable=False)
+    rtt_min = db.Column(db.Float(precision=24), nullable=True)
+    rtt_avg = db.Column(db.Float(precision=24), nullable=True)
+    rtt_max = db.Column(db.Float(precision=24), nullable=True)
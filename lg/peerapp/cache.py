@@ -0,0 +1,662 @@
+"""
+lg.peerapp.cache - Import-aware caching helpers for the peerapp API
+
+All of the data served by peerapp only changes when ``./manage.py prefixes`` finishes an import, so instead of
+guessing freshness from timestamps, the importer bumps an **import generation** counter in Redis. The generation
+is used to build ``ETag`` / ``Last-Modified`` headers, allowing browsers and CDNs to revalidate for free.
+
+Cached API responses (see :func:`.peer_cache`) are stored in Redis along with the generation they were generated
+for, so they're never served once a newer import has finished. The importer also publishes an "import finished"
+event on :attr:`.IMPORT_EVENT_CHANNEL` - ``./manage.py cache_listen`` subscribes to it, purges the old responses,
+and pre-warms the most requested API URLs before users request them.
+
+Each web worker also keeps a small in-process LRU cache (:class:`.LocalCache`) in front of Redis, so that hot
+responses such as ``/api/v1/info`` are served straight from worker memory. The local cache is cleared as soon as
+the worker notices a new import generation.
+
+Responses are cached as their final JSON bytes, compressed with gzip (or brotli if installed) according to
+``CACHE_COMPRESSION``. Clients which accept that encoding are sent the compressed bytes straight from the cache.
+
+Copyright::
+    +===================================================+
+    |                 © 2020 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        Flask Network Looking Glass                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+"""
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple, OrderedDict, Counter
+from datetime import datetime
+from typing import Callable, Optional, Dict, Tuple
+from urllib.parse import urlencode
+from uuid import uuid4
+
+from flask import Response, request, make_response, g
+from privex.helpers import empty
+from redis import RedisError
+from werkzeug.http import is_resource_modified
+
+from lg import base
+from lg.peerapp.settings import HTTP_CACHE_MAX_AGE, CACHE_WARM_TOP, CACHE_STALE_TIME, CACHE_LOCK_TIMEOUT, \
+    CACHE_LOCK_WAIT, LOCAL_CACHE_MAX_BYTES, LOCAL_CACHE_MAX_ITEM_BYTES, LOCAL_CACHE_TTL, GENERATION_CHECK_INTERVAL, \
+    CACHE_COMPRESSION, CACHE_COMPRESS_MIN_BYTES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+ENCODINGS = {
+    'gzip': (lambda body: gzip.compress(body, compresslevel=6), gzip.decompress),
+}
+"""Map of ``Content-Encoding`` names to a tuple of ``(compress_func, decompress_func)``"""
+
+if brotli is not None:
+    ENCODINGS['br'] = (lambda body: brotli.compress(body, quality=5), brotli.decompress)
+elif CACHE_COMPRESSION == 'br':
+    log.warning("CACHE_COMPRESSION is set to 'br' but the 'brotli' package is not installed. Falling back to gzip.")
+    CACHE_COMPRESSION = 'gzip'
+
+IMPORT_GEN_KEY = 'lg_import_gen'
+"""Redis key holding an integer which is incremented every time a prefix import finishes"""
+
+IMPORT_TIME_KEY = 'lg_import_time'
+"""Redis key holding the UNIX timestamp of when the last prefix import finished"""
+
+IMPORT_EVENT_CHANNEL = 'lg_import_events'
+"""Redis pub/sub channel which :meth:`lg.peerapp.import_prefixes.PathLoader.finish_import` publishes events to"""
+
+CACHE_PREFIX = 'lg_cache'
+"""Prefix for the Redis keys of cached API responses, keys are formatted ``lg_cache:{namespace}:{key}``"""
+
+CACHE_NAMESPACES = ('lg_api_info', 'lg_asn_aggr', 'lg_prefix', 'lg_prefixes')
+"""The namespaces used by the peerapp views with :func:`.peer_cache` - purged after each import"""
+
+POPULAR_KEY = 'lg_cache_popular'
+"""Redis sorted set counting requests per API URL, used to decide which URLs to pre-warm after an import"""
+
+POPULAR_MAX = 1000
+"""Maximum amount of URLs to keep in :attr:`.POPULAR_KEY`"""
+
+WARM_ENVIRON_KEY = 'lg.cache_warm'
+"""WSGI environ key set on the internal requests made by :func:`.warm_cache`"""
+
+STATS_KEY = 'lg_cache_stats'
+"""Redis hash containing the :attr:`.CACHE_METRICS` counters for each namespace, as ``{namespace}:{metric}``"""
+
+CACHE_METRICS = ('local_hit', 'hit', 'miss', 'refresh', 'stale', 'coalesced', 'wait_timeout')
+"""
+Counters recorded by :func:`.peer_cache`:
+
+ - ``local_hit`` - served a fresh response from the worker's in-process :class:`.LocalCache`
+ - ``hit`` - served a fresh response from the Redis cache
+ - ``miss`` - no cached response, so we generated it (while holding the lock for the key)
+ - ``refresh`` - the cached response had expired, so we re-generated it (while holding the lock for the key)
+ - ``stale`` - served an expired response, as another caller was already refreshing it
+ - ``coalesced`` - waited for another caller to generate the response, instead of generating it ourselves
+ - ``wait_timeout`` - gave up waiting for another caller, and generated the response ourselves
+"""
+
+STATS_FLUSH_INTERVAL = 5
+"""Counters + request counts are buffered in each worker, and flushed to Redis at most once every this many seconds"""
+
+_RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+ImportGeneration = namedtuple('ImportGeneration', 'generation finished_at')
+
+
+def bump_generation() -> ImportGeneration:
+    """
+    Increment the import generation in Redis, and record the current time as the time the import finished.
+    Should be called once an import has fully completed (both v4 and v6).
+
+        >>> gen = bump_generation()
+        >>> gen.generation
+        12
+
+    """
+    finished_at = datetime.utcnow().replace(microsecond=0)
+    pipe = base.get_redis().pipeline()
+    pipe.incr(IMPORT_GEN_KEY)
+    pipe.set(IMPORT_TIME_KEY, int((finished_at - datetime(1970, 1, 1)).total_seconds()))
+    generation, _ = pipe.execute()
+    log.info('Bumped import generation to %s (finished at %s)', generation, finished_at)
+    return ImportGeneration(int(generation), finished_at)
+
+
+def _load_generation() -> ImportGeneration:
+    gen, ts = base.get_redis().mget(IMPORT_GEN_KEY, IMPORT_TIME_KEY)
+    if not empty(gen) and not empty(ts):
+        return ImportGeneration(int(gen), datetime.utcfromtimestamp(int(ts)))
+    from lg.models import Prefix
+    last_prefix = Prefix.latest_seen_prefixes()
+    last_seen = datetime(1970, 1, 1) if last_prefix is None else last_prefix.last_seen.replace(microsecond=0)
+    return ImportGeneration(int((last_seen - datetime(1970, 1, 1)).total_seconds()), last_seen)
+
+
+_generation = dict(gen=None, checked_at=0.0)
+
+
+def get_generation() -> ImportGeneration:
+    """
+    Get the current :class:`.ImportGeneration` - the generation is cached on :attr:`flask.g` so that
+    it's only looked up once per request, and in worker memory for ``GENERATION_CHECK_INTERVAL`` seconds.
+
+    If no import has bumped the generation yet (e.g. an instance which was just upgraded), we fall back
+    to the ``last_seen`` time of the newest prefix, which also changes each time an import runs.
+    """
+    if 'lg_import_gen' in g:
+        return g.lg_import_gen
+    now = time.time()
+    # Internal warm requests are made right after an import, so they must always see the newest generation
+    if _generation['gen'] is None or request.environ.get(WARM_ENVIRON_KEY, False) or \
+            now - _generation['checked_at'] > GENERATION_CHECK_INTERVAL:
+        gen = _load_generation()
+        if _generation['gen'] is not None and gen.generation != _generation['gen'].generation:
+            log.debug('Import generation changed from %s to %s - clearing local cache',
+                      _generation['gen'].generation, gen.generation)
+            LOCAL_CACHE.clear()
+        _generation['gen'], _generation['checked_at'] = gen, now
+    g.lg_import_gen = _generation['gen']
+    return g.lg_import_gen
+
+
+def make_etag(gen: ImportGeneration) -> str:
+    """Generate an (unquoted) ETag from an import generation, plus the running git commit"""
+    return hashlib.sha1(f'{gen.generation}:{base.GIT_COMMIT}'.encode()).hexdigest()[:20]
+
+
+def set_cache_headers(res: Response, gen: ImportGeneration) -> Response:
+    """Add ``ETag``, ``Last-Modified`` and ``Cache-Control`` headers for ``gen`` to the response ``res``"""
+    res.set_etag(make_etag(gen), weak=True)
+    res.last_modified = gen.finished_at
+    res.cache_control.public = True
+    res.cache_control.max_age = HTTP_CACHE_MAX_AGE
+    res.cache_control.must_revalidate = True
+    res.vary.add('Accept-Encoding')
+    return res
+
+
+def conditional(f):
+    """
+    View decorator which tags responses with an ETag + Last-Modified derived from the import generation, and
+    answers conditional requests (``If-None-Match`` / ``If-Modified-Since``) with ``304 Not Modified``.
+
+    Must be placed **above** any caching decorators, so that a 304 can be returned without touching
+    the cache or the database::
+
+        >>> @flask.route('/api/v1/info')
+        ... @conditional
+        ... @peer_cache('lg_api_info', cache_time=30)
+        ... def lg_info():
+        ...     return jsonify(hello='world')
+
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        gen = get_generation()
+        if not is_resource_modified(request.environ, etag=make_etag(gen), last_modified=gen.finished_at):
+            return set_cache_headers(Response(status=304), gen)
+
+        res = make_response(f(*args, **kwargs))
+        if res.status_code == 200:
+            set_cache_headers(res, gen)
+        return res
+    return wrapper
+
+
+class LocalCache:
+    """
+    A bounded, thread-safe, in-process LRU cache for :func:`.peer_cache` entries.
+
+    The cache is limited by the total size of the cached response bodies (``max_bytes``), evicting the least
+    recently used entries when it's full. Entries are only kept for ``ttl`` seconds (or until the entry expires,
+    whichever is sooner), and are ignored if they're from a different import generation.
+
+        >>> c = LocalCache(max_bytes=1024 * 1024)
+        >>> c.set('lg_cache:lg_api_info:', dict(gen=3, expires=time.time() + 30, body=b'{}'))
+        >>> c.get('lg_cache:lg_api_info:', generation=3)
+        {'gen': 3, 'expires': 1587770000.0, 'body': b'{}'}
+        >>> c.get('lg_cache:lg_api_info:', generation=4) is None
+        True
+
+    """
+    def __init__(self, max_bytes: int, max_item_bytes: int = None, ttl: int = 10):
+        self.max_bytes, self.ttl = max_bytes, ttl
+        self.max_item_bytes = max_bytes if max_item_bytes is None else min(max_item_bytes, max_bytes)
+        self.size = 0
+        self._data = OrderedDict()   # type: Dict[str, Tuple[float, dict]]
+        self._lock = threading.Lock()
+
+    def get(self, key: str, generation: int) -> Optional[dict]:
+        with self._lock:
+            if key not in self._data:
+                return None
+            expires, entry = self._data[key]
+            if entry['gen'] != generation or expires < time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: dict):
+        size = len(entry['body'])
+        if size > self.max_item_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (min(entry['expires'], time.time() + self.ttl), entry)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._data)))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _remove(self, key: str):
+        if key in self._data:
+            _, entry = self._data.pop(key)
+            self.size -= len(entry['body'])
+
+    def __len__(self):
+        return len(self._data)
+
+
+LOCAL_CACHE = LocalCache(LOCAL_CACHE_MAX_BYTES, LOCAL_CACHE_MAX_ITEM_BYTES, LOCAL_CACHE_TTL)
+"""The in-process cache used by :func:`.peer_cache` for this worker"""
+
+
+class _StatsBuffer:
+    """
+    Buffers the :attr:`.CACHE_METRICS` counters and the :attr:`.POPULAR_KEY` request counts in worker memory,
+    flushing them to Redis with a single pipeline at most once every :attr:`.STATS_FLUSH_INTERVAL` seconds.
+    This prevents local cache hits from needing a Redis round trip just to update counters.
+    """
+    def __init__(self):
+        self.stats, self.popular = Counter(), Counter()
+        self.flushed_at = time.time()
+        self._lock = threading.Lock()
+
+    def count(self, namespace: str, metric: str):
+        with self._lock:
+            self.stats[f'{namespace}:{metric}'] += 1
+        self.maybe_flush()
+
+    def track(self, path: str):
+        with self._lock:
+            self.popular[path] += 1
+
+    def maybe_flush(self):
+        if time.time() - self.flushed_at >= STATS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            stats, popular = self.stats, self.popular
+            self.stats, self.popular, self.flushed_at = Counter(), Counter(), time.time()
+        if len(stats) == 0 and len(popular) == 0:
+            return
+        pipe = base.get_redis().pipeline(transaction=False)
+        for k, v in stats.items():
+            pipe.hincrby(STATS_KEY, k, v)
+        for k, v in popular.items():
+            pipe.zincrby(POPULAR_KEY, v, k)
+        if len(popular) > 0:
+            pipe.zremrangebyrank(POPULAR_KEY, 0, -(POPULAR_MAX + 1))
+        pipe.execute()
+
+
+_stats = _StatsBuffer()
+
+
+def cache_key(namespace: str, key: str = '') -> str:
+    """Generate the Redis key for a cached response, e.g. ``cache_key('lg_asn_aggr', 'None')``"""
+    return f'{CACHE_PREFIX}:{namespace}:{key}'
+
+
+def _popular_path() -> str:
+    """The path + query of this request, with the query args sorted and empty args removed"""
+    args = sorted((k, v) for k, v in request.args.items(multi=True) if v)
+    return request.path + (f'?{urlencode(args)}' if len(args) > 0 else '')
+
+
+def _track_popular(res: Response):
+    """
+    Count this request's URL in :attr:`.POPULAR_KEY` - only once per request, only if ``res`` was successful
+    (so clients can't fill it with error URLs), and never for warm requests
+    """
+    if res.status_code != 200 or request.environ.get(WARM_ENVIRON_KEY, False) or g.get('lg_cache_tracked', False):
+        return
+    g.lg_cache_tracked = True
+    _stats.track(_popular_path())
+
+
+def compress(body: bytes, encoding: str = CACHE_COMPRESSION) -> Tuple[bytes, str]:
+    """
+    Compress ``body`` with ``encoding`` (``gzip`` / ``br``), returning the compressed bytes, and the encoding
+    which was actually used. Bodies smaller than ``CACHE_COMPRESS_MIN_BYTES`` are returned as-is (``identity``).
+    """
+    if encoding not in ENCODINGS or len(body) < CACHE_COMPRESS_MIN_BYTES:
+        return body, 'identity'
+    return ENCODINGS[encoding][0](body), encoding
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    """Decompress ``body`` which was compressed with :func:`.compress` using ``encoding``"""
+    return body if encoding == 'identity' else ENCODINGS[encoding][1](body)
+
+
+def _dump_entry(entry: dict) -> bytes:
+    """
+    Serialize a cache entry for storing in Redis - a single line of JSON metadata, followed by the (compressed)
+    response body, which is stored as-is.
+    """
+    meta = {k: v for k, v in entry.items() if k != 'body'}
+    return json.dumps(meta).encode() + b'\n' + entry['body']
+
+
+def _parse_entry(data: bytes) -> dict:
+    split = data.index(b'\n')
+    return dict(json.loads(data[:split]), body=data[split + 1:])
+
+
+def _load_entry(r, rk: str, gen: ImportGeneration) -> Optional[dict]:
+    """Load the cache entry ``rk`` from Redis, returning ``None`` if it doesn't exist or is from an older import"""
+    data = r.get(rk)
+    entry = None if empty(data) else _parse_entry(data)
+    return entry if entry is not None and entry['gen'] == gen.generation else None
+
+
+def _entry_response(entry: dict, negotiate: bool = True) -> Response:
+    """
+    Build a response from a cache entry. If the entry is compressed, and ``negotiate`` is True, then the compressed
+    bytes are sent as-is with a ``Content-Encoding`` header when the client accepts that encoding - otherwise the
+    body is decompressed before it's sent.
+    """
+    body, encoding = entry['body'], entry['encoding']
+    res = Response(mimetype=entry['mimetype'], status=entry['status'])
+    if encoding != 'identity':
+        res.vary.add('Accept-Encoding')
+        if negotiate and request.accept_encodings[encoding] > 0:
+            res.content_encoding = encoding
+        else:
+            body = decompress(body, encoding)
+    res.set_data(body)
+    return res
+
+
+def _store_entry(r, rk: str, gen: ImportGeneration, res: Response, cache_time: int) -> dict:
+    body, encoding = compress(res.get_data())
+    entry = dict(
+        gen=gen.generation, expires=time.time() + cache_time,
+        status=res.status_code, mimetype=res.mimetype, encoding=encoding, body=body
+    )
+    # The key is kept for an additional CACHE_STALE_TIME seconds, so it can be served while it's being refreshed
+    r.set(rk, _dump_entry(entry), ex=cache_time + CACHE_STALE_TIME)
+    LOCAL_CACHE.set(rk, entry)
+    return entry
+
+
+def _acquire_lock(r, rk: str) -> Optional[str]:
+    """Try to obtain the single-flight lock for the cache key ``rk``. Returns the lock token if we obtained it."""
+    token = uuid4().hex
+    return token if r.set(f'{rk}:lock', token, nx=True, ex=CACHE_LOCK_TIMEOUT) else None
+
+
+def _release_lock(r, rk: str, token: str):
+    """Release the lock for ``rk`` - only if it's still held by ``token`` (it may have timed out and been re-taken)"""
+    r.eval(_RELEASE_LOCK_LUA, 1, f'{rk}:lock', token)
+
+
+def _count(namespace: str, metric: str):
+    _stats.count(namespace, metric)
+
+
+def cache_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Returns the counters recorded by :func:`.peer_cache` for each namespace::
+
+        >>> cache_stats()
+        {'lg_asn_aggr': {
+            'local_hit': 8120, 'hit': 1534, 'miss': 12, 'refresh': 3, 'stale': 30, 'coalesced': 41, 'wait_timeout': 0
+        }}
+
+    """
+    _stats.flush()
+    res = {}
+    for k, v in base.get_redis().hgetall(STATS_KEY).items():
+        namespace, metric = k.decode().rsplit(':', 1)
+        res.setdefault(namespace, {m: 0 for m in CACHE_METRICS})[metric] = int(v)
+    return res
+
+
+def peer_cache(namespace: str, key: Optional[Callable[..., str]] = None, cache_time: int = 300):
+    """
+    View decorator which caches the response of a peerapp view in Redis under ``lg_cache:{namespace}:{key}``
+
+    Only ``200`` responses are cached. Cached responses are tagged with the import generation, and are treated as
+    a cache miss once a newer import has finished, so stale data is never served after an import - even if
+    nobody is running ``./manage.py cache_listen`` to purge the old responses.
+
+    To prevent a stampede of identical heavy queries when a popular key expires, misses are **single-flight**:
+
+     - Only the caller holding a short Redis lock for the key runs the view. Other callers wait up to
+       ``CACHE_LOCK_WAIT`` seconds for the lock holder to store the response, instead of running the view themselves.
+     - Once ``cache_time`` has passed, the response is still kept for ``CACHE_STALE_TIME`` seconds
+       (stale-while-revalidate). The lock holder refreshes it, while every other caller is served the stale copy.
+
+    Fresh responses are also kept in the worker's in-process :attr:`.LOCAL_CACHE`, so hot keys don't need a Redis
+    round trip at all. Hits, misses, stale responses and coalesced waits are counted per namespace -
+    see :func:`.cache_stats`
+
+        >>> @flask.route('/api/v1/asn_prefixes')
+        ... @conditional
+        ... @peer_cache('lg_asn_aggr', lambda: request.values.get("asn"))
+        ... def asn_prefixes():
+        ...     return jsonify(hello='world')
+
+    :param str namespace: The namespace of the cache key, should be listed in :attr:`.CACHE_NAMESPACES`
+    :param callable key:  A callable which takes the same arguments as the view, and returns the rest of the key
+    :param int cache_time: The amount of time in seconds to cache the response for (default: 300 seconds)
+    """
+    def _decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            # Views called from within another cached view (e.g. list_prefixes calling asn_prefixes) always
+            # get an uncompressed response back, so that they can read it.
+            if g.get('lg_cache_active', False):
+                return _cached(*args, negotiate=False, **kwargs)
+            g.lg_cache_active = True
+            try:
+                res = _cached(*args, **kwargs)
+            finally:
+                g.lg_cache_active = False
+            _track_popular(res)
+            return res
+
+        def _cached(*args, negotiate=True, **kwargs):
+            rk = cache_key(namespace, '' if key is None else key(*args, **kwargs))
+            r, gen = base.get_redis(), get_generation()
+
+            def generate() -> Response:
+                res = make_response(f(*args, **kwargs))
+                if res.status_code == 200:
+                    return _entry_response(_store_entry(r, rk, gen, res, cache_time), negotiate)
+                return res
+
+            # Internal warm requests always re-generate the response, to overwrite anything left from an old import
+            if request.environ.get(WARM_ENVIRON_KEY, False):
+                return generate()
+
+            entry = LOCAL_CACHE.get(rk, gen.generation)
+            if entry is not None:
+                _count(namespace, 'local_hit')
+                return _entry_response(entry, negotiate)
+
+            entry = _load_entry(r, rk, gen)
+            if entry is not None and entry['expires'] > time.time():
+                _count(namespace, 'hit')
+                LOCAL_CACHE.set(rk, entry)
+                return _entry_response(entry, negotiate)
+
+            token = _acquire_lock(r, rk)
+            if token is None:
+                # Somebody else is already generating this response. Serve the stale copy if we have one,
+                # otherwise wait for them to finish.
+                if entry is not None:
+                    _count(namespace, 'stale')
+                    return _entry_response(entry, negotiate)
+                deadline = time.time() + CACHE_LOCK_WAIT
+                while time.time() < deadline:
+                    time.sleep(0.05)
+                    entry = _load_entry(r, rk, gen)
+                    if entry is not None:
+                        _count(namespace, 'coalesced')
+                        return _entry_response(entry, negotiate)
+                    # The lock was released without storing a response (e.g. the view returned a 404)
+                    if not r.exists(f'{rk}:lock'):
+                        _count(namespace, 'miss')
+                        return generate()
+                log.warning('Timed out after %ss waiting for cache key %s - generating it ourselves',
+                            CACHE_LOCK_WAIT, rk)
+                _count(namespace, 'wait_timeout')
+                return generate()
+
+            try:
+                # Another worker may have stored the response between us checking the cache, and obtaining the lock
+                if entry is None:
+                    entry = _load_entry(r, rk, gen)
+                    if entry is not None:
+                        _count(namespace, 'coalesced')
+                        return _entry_response(entry, negotiate)
+                _count(namespace, 'miss' if entry is None else 'refresh')
+                return generate()
+            finally:
+                _release_lock(r, rk, token)
+        return wrapper
+    return _decorator
+
+
+def publish_import_event(gen: ImportGeneration, **extra) -> int:
+    """
+    Publish an ``import_finished`` event for the generation ``gen`` on :attr:`.IMPORT_EVENT_CHANNEL`
+
+    :return int listeners: The number of clients which received the event
+    """
+    event = dict(
+        event='import_finished', generation=gen.generation, finished_at=str(gen.finished_at),
+        namespaces=list(CACHE_NAMESPACES), **extra
+    )
+    listeners = base.get_redis().publish(IMPORT_EVENT_CHANNEL, json.dumps(event))
+    log.debug('Published import event %s to %d listeners', event, listeners)
+    return listeners
+
+
+def purge_namespaces(*namespaces: str) -> int:
+    """
+    Delete every cached response within the given namespaces (or all :attr:`.CACHE_NAMESPACES` if none are passed)
+
+    :return int purged: The amount of keys which were deleted
+    """
+    r, total = base.get_redis(), 0
+    for ns in (namespaces or CACHE_NAMESPACES):
+        keys = list(r.scan_iter(match=cache_key(ns, '*'), count=1000))
+        for i in range(0, len(keys), 500):
+            total += r.delete(*keys[i:i + 500])
+    return total
+
+
+def warm_cache(limit: int = CACHE_WARM_TOP) -> int:
+    """
+    Pre-warm the front page API URLs, plus the ``limit`` most requested URLs from :attr:`.POPULAR_KEY`, by
+    making internal requests against the Flask app.
+
+    Afterwards, the request counts in :attr:`.POPULAR_KEY` are halved, so that URLs which are no longer
+    popular eventually stop being warmed.
+
+    :return int warmed: The amount of URLs which were successfully warmed
+    """
+    from lg.app import flask as app
+    r = base.get_redis()
+    paths = ['/api/v1/info/', '/api/v1/asn_prefixes/']
+    paths += [p.decode() for p in r.zrevrange(POPULAR_KEY, 0, limit - 1)]
+
+    client, warmed = app.test_client(), 0
+    for p in dict.fromkeys(paths):
+        res = client.get(p, environ_base={WARM_ENVIRON_KEY: True})
+        log.debug('Warmed URL %s - status: %s', p, res.status_code)
+        warmed += 1 if res.status_code == 200 else 0
+
+    r.zunionstore(POPULAR_KEY, {POPULAR_KEY: 0.5})
+    r.zremrangebyrank(POPULAR_KEY, 0, -(POPULAR_MAX + 1))
+    return warmed
+
+
+def handle_import_event(event: dict):
+    """Purge the namespaces listed in an ``import_finished`` event, then pre-warm the most requested URLs"""
+    purged = purge_namespaces(*event.get('namespaces', CACHE_NAMESPACES))
+    log.info('Import generation %s finished. Purged %d cached responses.', event.get('generation'), purged)
+    warmed = warm_cache()
+    log.info('Pre-warmed %d API URLs for import generation %s', warmed, event.get('generation'))
+
+
+def listen_import_events(max_backoff: float = 60.0):
+    """
+    Subscribe to :attr:`.IMPORT_EVENT_CHANNEL` and call :func:`.handle_import_event` for every event (blocking).
+
+    If the Redis connection is lost, it's re-established with exponential backoff (up to ``max_backoff`` seconds).
+    Any events published while disconnected are missed, so the caches are purged + re-warmed after reconnecting.
+    """
+    backoff, reconnecting = 1.0, False
+    while True:
+        p = base.get_redis().pubsub(ignore_subscribe_messages=True)
+        try:
+            p.subscribe(IMPORT_EVENT_CHANNEL)
+            log.info('Listening for import events on Redis channel %s', IMPORT_EVENT_CHANNEL)
+            if reconnecting:
+                try:
+                    handle_import_event(dict(generation='(reconnected)'))
+                except Exception:
+                    log.exception('Error while refreshing the caches after reconnecting')
+            backoff = 1.0
+            for msg in p.listen():
+                try:
+                    event = json.loads(msg['data'])
+                    if event.get('event') == 'import_finished':
+                        handle_import_event(event)
+                except Exception:
+                    log.exception('Error while handling import event %s', msg)
+        except RedisError as e:
+            log.warning('Lost Redis connection while listening for import events (%s %s) - reconnecting in %.0f sec',
+                        type(e), str(e), backoff)
+        finally:
+            try:
+                p.close()
+            except Exception:
+                pass
+        reconnecting = True
+        time.sleep(backoff)
+        backoff = min(backoff * 2, max_backoff)
@@ -20,6 +20,7 @@ from gobgp.gobgp_pb2 import ListPathRequest, ListPathResponse, Family
 from datetime import datetime
 from lg import base
 from lg.models import ASN, Prefix, Community
+from lg.peerapp.cache import bump_generation, publish_import_event
 from lg.peerapp.settings import OUR_ASN, OUR_ASN_NAME, LOCAL_IPS, BLACKLIST_ROUTES, CHUNK_SIZE
 from lg.base import get_redis, get_pg_pool
 from lg.exceptions import GoBGPException
@@ -365,6 +366,18 @@ class PathLoader:
                 # pfx.communities.append(comm)
         return pfx
 
+    def finish_import(self):
+        """
+        Mark the import as finished by bumping the import generation (see :mod:`lg.peerapp.cache`), which
+        changes the ETag / Last-Modified headers returned by the peerapp API, then publish an ``import_finished``
+        event so that ``./manage.py cache_listen`` can purge + pre-warm the API cache.
+
+        Should be called once, after :meth:`.store_paths` has been ran for every address family.
+        """
+        gen = bump_generation()
+        publish_import_event(gen, families=['v4', 'v6'])
+        return gen
+
     def summary(self):
         if self.quiet:
             return
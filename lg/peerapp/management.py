@@ -1,9 +1,5 @@
 import argparse
 import pstats
-
-from lg import base
-from lg.peerapp import settings
-from lg.peerapp.import_prefixes import PathLoader
 import logging
 import textwrap
 import asyncio
@@ -14,11 +10,18 @@ PEERS_HELP = textwrap.dedent('''\
     
     Peer Application Commands (peerapp):
         prefixes          - Load prefixes from gobgp
+        cache_listen      - Purge + pre-warm the API cache whenever a prefix import finishes
+        cache_warm        - Purge + pre-warm the API cache right now
     
 ''')
 
 
+# The peerapp modules (and gRPC / GoBGP's protobuf modules) are only imported by the commands which use them, so that
+# adding these commands to manage.py doesn't slow down every other command (e.g. the queue runners)
+
 def load_prefixes(opt):
+    from lg.peerapp import settings
+    from lg.peerapp.import_prefixes import PathLoader
     loop = asyncio.get_event_loop()
     
     pl = PathLoader(settings.GBGP_HOST)
@@ -28,6 +31,17 @@ def load_prefixes(opt):
         pl.summary()
     loop.run_until_complete(pl.store_paths('v4'))
     loop.run_until_complete(pl.store_paths('v6'))
+    pl.finish_import()
+
+
+def cache_listen(opt):
+    from lg.peerapp import cache
+    cache.listen_import_events()
+
+
+def cache_warm(opt):
+    from lg.peerapp import cache
+    cache.handle_import_event(dict(generation='(manual)'))
 
 
 def dump_profile_stats(opt):
@@ -60,4 +74,12 @@ def add_parsers(subparser: argparse._SubParsersAction):
                              help="Sort stats by this key (default: 'cumtime' - total time used by function)")
     p_dump_prof.set_defaults(func=dump_profile_stats)
 
-    return dict(p_qr=p_qr, p_dump_prof=p_dump_prof)
+    p_cache_listen = subparser.add_parser(
+        'cache_listen', description='Purge + pre-warm the API cache whenever a prefix import finishes'
+    )
+    p_cache_listen.set_defaults(func=cache_listen)
+
+    p_cache_warm = subparser.add_parser('cache_warm', description='Purge + pre-warm the API cache right now')
+    p_cache_warm.set_defaults(func=cache_warm)
+
+    return dict(p_qr=p_qr, p_dump_prof=p_dump_prof, p_cache_listen=p_cache_listen, p_cache_warm=p_cache_warm)
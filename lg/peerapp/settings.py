@@ -101,6 +101,68 @@ will be marked in yellow, to signify that they're potentially stale / no longer
 Default: ``1800`` seconds = 30 minutes
 """
 
+HTTP_CACHE_MAX_AGE = env_int('HTTP_CACHE_MAX_AGE', 0)
+"""
+The ``Cache-Control: max-age`` (in seconds) sent with peerapp API responses. Responses are also tagged with an
+``ETag`` / ``Last-Modified`` derived from the last prefix import, so browsers and CDNs can cheaply revalidate
+once max-age has passed.
+
+Default: ``0`` seconds = always revalidate (a revalidation returns an empty ``304 Not Modified`` if nothing changed)
+"""
+
+CACHE_WARM_TOP = env_int('CACHE_WARM_TOP', 50)
+"""
+After each prefix import, ``./manage.py cache_listen`` pre-warms the info + ASN list API responses, as well as
+this many of the most requested peerapp API URLs.
+"""
+
+CACHE_STALE_TIME = env_int('CACHE_STALE_TIME', 120)
+"""
+Cached API responses are kept for this many seconds after they expire. While an expired response is being
+re-generated by one web worker, any other requests for it are served the stale copy instead of waiting.
+"""
+
+CACHE_LOCK_TIMEOUT = env_int('CACHE_LOCK_TIMEOUT', 60)
+"""
+Only one web worker at a time may generate a given cached API response - this is the maximum amount of seconds
+that a worker may hold the lock for, in-case it crashes while generating the response.
+"""
+
+CACHE_LOCK_WAIT = env_int('CACHE_LOCK_WAIT', 15)
+"""
+Maximum amount of seconds to wait for another web worker to finish generating an uncached API response, before
+giving up and generating it ourselves.
+"""
+
+LOCAL_CACHE_MAX_BYTES = env_int('LOCAL_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+"""
+Each web worker keeps cached API responses in memory (in front of Redis), up to this many bytes of response bodies.
+The least recently used responses are evicted once it's full. Set to ``0`` to disable the in-process cache.
+
+Default: ``33554432`` bytes = 32MB per worker
+"""
+
+LOCAL_CACHE_MAX_ITEM_BYTES = env_int('LOCAL_CACHE_MAX_ITEM_BYTES', 2 * 1024 * 1024)
+"""Responses larger than this many bytes are only cached in Redis, not in worker memory. Default: 2MB"""
+
+LOCAL_CACHE_TTL = env_int('LOCAL_CACHE_TTL', 10)
+"""Maximum amount of seconds that a response is served from worker memory, before re-checking Redis"""
+
+GENERATION_CHECK_INTERVAL = env_int('GENERATION_CHECK_INTERVAL', 2)
+"""
+Web workers check Redis for a new import generation at most once every this many seconds. Once a new import
+has finished, the in-process cache of the worker is cleared.
+"""
+
+CACHE_COMPRESSION = env('CACHE_COMPRESSION', 'gzip').lower()
+"""
+Compression used for cached API responses: ``gzip``, ``br`` (requires the ``brotli`` package) or ``none``.
+Clients which accept the encoding are sent the compressed response as-is, otherwise it's decompressed per request.
+"""
+
+CACHE_COMPRESS_MIN_BYTES = env_int('CACHE_COMPRESS_MIN_BYTES', 1024)
+"""Cached API responses smaller than this many bytes are stored uncompressed"""
+
 BLACKLIST_ROUTES = [ip_network(ip) for ip in BLACKLIST_ROUTES]
 
 IX_NET_MAP = {
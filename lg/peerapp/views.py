@@ -6,11 +6,12 @@ from typing import Tuple, Union, List
 from flask import Response, request, Blueprint
 from flask.json import jsonify
 from flask_sqlalchemy import BaseQuery
-from privex.helpers import empty, r_cache, is_true, Git, empty_if, ip_is_v4, ip_is_v6
+from privex.helpers import empty, is_true, Git, empty_if, ip_is_v4, ip_is_v6
 from sqlalchemy.orm import Query
 from lg import base
 from lg.exceptions import InvalidIP
 from lg.models import Prefix, IPFilter
+from lg.peerapp.cache import conditional, peer_cache, cache_stats
 from getenv import env
 
 from lg.peerapp.settings import PREFIX_TIMEOUT, PREFIX_TIMEOUT_WARN
@@ -55,7 +56,8 @@ def json_err(err_code: str) -> Tuple[Response, int]:
 
 @flask.route('/api/v1/info')
 @flask.route('/api/v1/info/')
-@r_cache('lg_api_info', 30)
+@conditional
+@peer_cache('lg_api_info', cache_time=30)
 def lg_info():
     last_prefix = Prefix.latest_seen_prefixes()
     
@@ -77,7 +79,8 @@ def lg_info():
 
 @flask.route('/api/v1/asn_prefixes')
 @flask.route('/api/v1/asn_prefixes/')
-@r_cache(lambda: f'lg_asn_aggr:{request.values.get("asn")}')
+@conditional
+@peer_cache('lg_asn_aggr', lambda: f'{request.values.get("asn")}')
 def asn_prefixes():
     """
     Endpoint /api/v1/asn_prefixes/ - count the number of prefixes advertised by each ASN,
@@ -154,8 +157,10 @@ def asn_prefixes():
 @flask.route('/api/v1/prefix/<prefix>/')
 @flask.route('/api/v1/prefix/<prefix>/<cidr>')
 @flask.route('/api/v1/prefix/<prefix>/<cidr>/')
-@r_cache(
-    lambda prefix, cidr=None: f'lg_prefix:{prefix}:{cidr}:{request.values.get("asn")}:{request.values.get("exact")}'
+@conditional
+@peer_cache(
+    'lg_prefix',
+    lambda prefix, cidr=None: f'{prefix}:{cidr}:{request.values.get("asn")}:{request.values.get("exact")}'
                               f':{request.values.get("limit")}:{request.values.get("skip")}'
 )
 def get_prefix(prefix: str, cidr: int = None):
@@ -205,7 +210,12 @@ def get_prefix(prefix: str, cidr: int = None):
 
 @flask.route('/api/v1/prefixes')
 @flask.route('/api/v1/prefixes/')
-@r_cache(lambda: f'lg_prefixes:{request.values.get("asn")}:{request.values.get("family")}:{request.values.get("limit")}:{request.values.get("skip")}')
+@conditional
+@peer_cache(
+    'lg_prefixes',
+    lambda: f'{request.values.get("asn")}:{request.values.get("family")}:{request.values.get("limit")}'
+            f':{request.values.get("skip")}'
+)
 def list_prefixes():
     """
     Endpoint /api/v1/prefixes/ - list all known prefixes, or filter by ASN / Family
@@ -321,6 +331,16 @@ def list_prefixes():
     return jsonify(response)
 
 
+@flask.route('/api/v1/cache_stats')
+@flask.route('/api/v1/cache_stats/')
+def api_cache_stats():
+    """
+    Endpoint /api/v1/cache_stats/ - returns the API cache counters (hits, misses, stale responses served, and
+    requests which waited for another worker to generate the response) for each cache namespace.
+    """
+    return jsonify(error=False, result=cache_stats())
+
+
 def validate_limits(limit, skip) -> Tuple[int, int]:
     limit, skip = int(empty_if(limit, base.DEFAULT_API_LIMIT)), int(empty_if(skip, 0))
     limit = base.MAX_API_LIMIT if limit > base.MAX_API_LIMIT else limit
@@ -337,6 +357,13 @@ def setup_api_routes():
             description="Returns basic status/version information about the running Privex Looking Glass instance"
         )
     )
+    base.add_api_route(
+        'cache_stats',
+        base.APIRoute(
+            endpoint='/api/v1/cache_stats/',
+            description="Returns the API cache hit / miss / stale / coalesced wait counters for each cache namespace"
+        )
+    )
     base.add_api_route(
         'asn_prefixes',
         base.APIRoute(
@@ -18,10 +18,11 @@ Copyright::
 """
 import json
 import logging
+import re
 import textwrap
 import argparse
 from lg import base
-from lg.lookingglass.runner import Runner
+from lg.lookingglass.settings import SCHEDULE_FILE
 from privex.helpers import ErrHelpParser
 
 log = logging.getLogger('lookingglass.managedotpy')
@@ -43,6 +44,9 @@ help_text = textwrap.dedent('''\
 
         runserver         - Run the flask dev server (DO NOT USE IN PRODUCTION. USE GUNICORN)
         queue             - Start the message queue runner, for running pings/traces in background
+        migrate_results   - Move pings/traces from the legacy lg_requests/lg_results Redis hashes into expiring keys
+        scheduler         - Ping/trace the targets in SCHEDULE_FILE on a schedule, storing the results as time series
+        import_times      - Measure the import time + memory usage of each entry point (runner, web app, etc.)
 
 ''') + PEERAPP_HELP
 
@@ -67,8 +71,64 @@ def runserver(opt):
 
 
 def queue_handler(opt):
-    r = Runner(mq_conn=base.get_rmq(), queue=base.RMQ_QUEUE, redis=base.get_redis())
-    r.run()
+    from lg.lookingglass.consumers import get_consumer
+    from lg.lookingglass.locations import LocationHeartbeat
+    from lg.lookingglass.runner import Runner, AsyncRunner
+    actions = [a.strip() for a in opt.actions.split(',')]
+    location = opt.location.strip()
+    if location and not re.match(r'^[a-zA-Z0-9][a-zA-Z0-9_-]*$', location):
+        parser.error(f'Invalid location "{location}" - may only contain letters, numbers, "-" and "_"')
+    queues = {a: base.location_queue(base.RMQ_QUEUES[a], location) for a in actions}
+    # RabbitMQ is only connected to when it's actually used as the queue backend
+    mq_conn = base.get_rmq() if opt.backend == 'rabbitmq' else None
+    consumer = get_consumer(list(queues.values()), redis=base.get_redis(), mq_conn=mq_conn, backend=opt.backend)
+    if not opt.use_async:
+        r = Runner(mq_conn=mq_conn, queue=list(queues.values()), redis=base.get_redis(), consumer=consumer)
+    else:
+        concurrency = dict(ping=opt.ping_concurrency, trace=opt.trace_concurrency)
+        if opt.concurrency:
+            concurrency = dict(ping=opt.concurrency, trace=opt.concurrency)
+        r = AsyncRunner(
+            mq_conn=mq_conn, queue=list(queues.values()), redis=base.get_redis(), consumer=consumer,
+            concurrency={queues[a]: concurrency[a] for a in actions},
+            prefetch=opt.prefetch if opt.prefetch > 0 else None
+        )
+    if not location:
+        return r.run()
+    # Let the web app know that this location can accept requests, for as long as we're running
+    heartbeat = LocationHeartbeat(base.get_redis(), location, opt.location_name or location, actions)
+    heartbeat.start()
+    try:
+        r.run()
+    finally:
+        heartbeat.stop()
+
+
+def migrate_results(opt):
+    from lg.lookingglass.jobs import migrate_legacy
+    reqs, results = migrate_legacy(base.get_redis())
+    print(f'Moved {reqs} requests and {results} results into expiring keys.')
+
+
+def scheduler(opt):
+    from lg.lookingglass.scheduler import Scheduler, load_schedule_file
+    if not opt.file:
+        parser.error('No schedule file - pass --file or set SCHEDULE_FILE in .env')
+    try:
+        targets = load_schedule_file(opt.file)
+    except (OSError, ValueError) as e:
+        parser.error(f'Failed to load schedule file "{opt.file}" - {e}')
+    _, db, _ = base.get_app()
+    Scheduler(base.get_redis(), db.engine, targets).run()
+
+
+def import_times(opt):
+    from lg.importtime import ENTRY_POINTS, measure, format_report
+    entries = opt.entries or list(ENTRY_POINTS.keys())
+    unknown = [e for e in entries if e not in ENTRY_POINTS]
+    if len(unknown) > 0:
+        parser.error(f'Unknown entry point(s): {", ".join(unknown)} - choose from: {", ".join(ENTRY_POINTS)}')
+    print(format_report([measure(e) for e in entries], top=opt.top))
 
 
 def queue_test(opt):
@@ -81,8 +141,48 @@ def queue_test(opt):
 
 
 p_qr = subparser.add_parser('queue', description='Start message queue runner')
+p_qr.add_argument('--async', help='Run multiple pings/traces at once using asyncio', action='store_true',
+                  dest='use_async', default=base.RUNNER_ASYNC)
+p_qr.add_argument('-c', '--concurrency', help='Maximum pings AND maximum traces to run at once (async only)',
+                  default=0, type=int)
+p_qr.add_argument('--ping-concurrency', help='Maximum pings to run at once (async only)',
+                  default=base.RUNNER_CONCURRENCY_PING, type=int)
+p_qr.add_argument('--trace-concurrency', help='Maximum traces to run at once (async only)',
+                  default=base.RUNNER_CONCURRENCY_TRACE, type=int)
+p_qr.add_argument('--prefetch', help='Messages to prefetch from each queue (async only, 0 = concurrency)',
+                  default=base.RUNNER_PREFETCH, type=int)
+p_qr.add_argument('--actions', help='Comma separated actions to process, e.g. "ping" to only process pings',
+                  default=','.join(base.RMQ_QUEUES.keys()))
+p_qr.add_argument('--backend', help='Queue backend to consume jobs from (default: QUEUE_BACKEND)',
+                  choices=['rabbitmq', 'redis'], default=base.QUEUE_BACKEND)
+p_qr.add_argument('--location', help='Location ID of this runner, e.g. "se1" (default: LG_LOCATION) - only requests '
+                                       'sent to this location are processed', default=base.LG_LOCATION)
+p_qr.add_argument('--location-name', help='Human readable name of the location (default: LG_LOCATION_NAME)',
+                  default=base.LG_LOCATION_NAME)
 p_qr.set_defaults(func=queue_handler)
 
+p_qr_mig = subparser.add_parser(
+    'migrate_results', description='Move ping/trace requests + results from the legacy lg_requests / lg_results '
+                                   'Redis hashes into per-request keys which expire after RESULT_TTL seconds'
+)
+p_qr_mig.set_defaults(func=migrate_results)
+
+p_sched = subparser.add_parser(
+    'scheduler', description='Ping/trace the targets listed in a schedule file every <interval> seconds (using the '
+                             'queue runners), and store the results as time series'
+)
+p_sched.add_argument('-f', '--file', help='Schedule file to load (default: SCHEDULE_FILE)', default=SCHEDULE_FILE)
+p_sched.set_defaults(func=scheduler)
+
+p_imp = subparser.add_parser(
+    'import_times', description='Measure the import time + peak memory usage of each entry point, each in a fresh '
+                                'Python interpreter (using python -X importtime)'
+)
+p_imp.add_argument('entries', help='Entry points to measure: runner, manage, scheduler, web, peerapp (default: all)',
+                   nargs='*')
+p_imp.add_argument('--top', help='Show this many of the slowest packages to import', default=10, type=int)
+p_imp.set_defaults(func=import_times)
+
 p_qr_test = subparser.add_parser('qtest', description='queue testing')
 p_qr_test.set_defaults(func=queue_test)
 
@@ -0,0 +1,66 @@
+"""add measurement target / sample / rollup tables for scheduled measurements
+
+Revision ID: a3c9d51e7b24
+Revises: e2fb90cb7142
+Create Date: 2026-10-19 10:12:41.501873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c9d51e7b24'
+down_revision = 'e2fb90cb7142'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('measurement_target',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('action', sa.String(length=10), nullable=False),
+    sa.Column('host', sa.String(length=255), nullable=False),
+    sa.Column('proto', sa.String(length=10), server_default='any', nullable=False),
+    sa.Column('location', sa.String(length=64), server_default='', nullable=False),
+    sa.Column('interval', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('action', 'host', 'proto', 'location')
+    )
+    op.create_table('measurement_sample',
+    sa.Column('target_id', sa.Integer(), nullable=False),
+    sa.Column('ts', sa.DateTime(), nullable=False),
+    sa.Column('sent', sa.SmallInteger(), nullable=False),
+    sa.Column('recv', sa.SmallInteger(), nullable=False),
+    sa.Column('rtt_min', sa.Float(precision=24), nullable=True),
+    sa.Column('rtt_avg', sa.Float(precision=24), nullable=True),
+    sa.Column('rtt_max', sa.Float(precision=24), nullable=True),
+    sa.Column('rtt_stdev', sa.Float(precision=24), nullable=True),
+    sa.Column('hops', sa.SmallInteger(), nullable=True),
+    sa.ForeignKeyConstraint(['target_id'], ['measurement_target.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('target_id', 'ts')
+    )
+    op.create_table('measurement_rollup',
+    sa.Column('target_id', sa.Integer(), nullable=False),
+    sa.Column('resolution', sa.Integer(), nullable=False),
+    sa.Column('bucket', sa.DateTime(), nullable=False),
+    sa.Column('samples', sa.Integer(), nullable=False),
+    sa.Column('sent', sa.Integer(), nullable=False),
+    sa.Column('recv', sa.Integer(), nullable=False),
+    sa.Column('rtt_min', sa.Float(precision=24), nullable=True),
+    sa.Column('rtt_avg', sa.Float(precision=24), nullable=True),
+    sa.Column('rtt_max', sa.Float(precision=24), nullable=True),
+    sa.ForeignKeyConstraint(['target_id'], ['measurement_target.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('target_id', 'resolution', 'bucket')
+    )
+    # Expired samples are removed by time across all targets
+    op.create_index(op.f('ix_measurement_sample_ts'), 'measurement_sample', ['ts'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_measurement_sample_ts'), table_name='measurement_sample')
+    op.drop_table('measurement_rollup')
+    op.drop_table('measurement_sample')
+    op.drop_table('measurement_target')
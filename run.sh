@@ -68,7 +68,15 @@ function msg() {
 case "$1" in
     queue)
         msg ts bold green "Starting Looking Glass RabbitMQ Worker"
-        pipenv run ./manage.py queue
+        pipenv run ./manage.py queue "${@:2}"
+        ;;
+    sched*)
+        msg ts bold green "Starting Looking Glass measurement scheduler"
+        pipenv run ./manage.py scheduler "${@:2}"
+        ;;
+    cache)
+        msg ts bold green "Starting Looking Glass API cache warmer"
+        pipenv run ./manage.py cache_listen
         ;;
     prefix* | cron)
         msg ts bold green "Starting BGP Prefix Loader"
@@ -85,6 +93,8 @@ case "$1" in
         yarn build
         msg ts bold green " >> Migrating the Postgres database"
         pipenv run flask db upgrade
+        msg ts bold green " >> Moving legacy ping/trace results into expiring Redis keys"
+        pipenv run ./manage.py migrate_results
         msg ts bold green " +++ Finished"
         echo
         msg bold yellow "Post-update info:"
@@ -95,7 +105,9 @@ case "$1" in
         msg blue "\t systemctl daemon-reload"
 
         msg yellow " - Please remember to restart all Privex Looking Glass services AS ROOT like so:"
-        msg blue "\t systemctl restart looking-glass lg-queue gobgp"
+        msg blue "\t systemctl restart looking-glass lg-queue lg-cache gobgp"
+        msg yellow " - If you use scheduled measurements (SCHEDULE_FILE), also restart the scheduler:"
+        msg blue "\t systemctl restart lg-scheduler"
         ;;
     serve* | runserv*)
         # Override these defaults inside of `.env`
@@ -103,8 +115,10 @@ case "$1" in
         : ${PORT='8282'}
         : ${GU_WORKERS='4'} # Number of Gunicorn worker processes
         : ${GU_TIMEOUT='600'} # Gunicorn request timeout
+        : ${GU_THREADS='16'} # Threads per worker - long-polling / streaming requests each hold a thread while waiting
 
-        pipenv run gunicorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" --timeout "$GU_TIMEOUT" wsgi
+        pipenv run gunicorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" -k gthread --threads "$GU_THREADS" \
+            --timeout "$GU_TIMEOUT" wsgi
         ;;
     *)
         msg bold red "Unknown command.\n"
@@ -112,7 +126,9 @@ case "$1" in
         msg bold green "    Website: https://www.privex.io/ \n    Source: https://github.com/Privex/looking-glass\n"
         msg green "Available run.sh commands:\n"
         msg yellow "\t queue - Start the Looking Glass queue runner - processes incoming trace/ping requests"
+        msg yellow "\t scheduler - Start the measurement scheduler - pings/traces the targets in SCHEDULE_FILE on a schedule"
         msg yellow "\t prefix - Quietly update BGP prefixes from GoBGP"
+        msg yellow "\t cache - Start the API cache warmer - purges + pre-warms the API cache after each prefix import"
         msg yellow "\t update - Upgrade your Privex Looking Glass installation"
         msg yellow "\t server - Start the production Gunicorn server"
         msg green "\nAdditional aliases for the above commands:\n"
@@ -0,0 +1,62 @@
+"""
+Tests for :class:`lg.lookingglass.icmp.IcmpProber`, pinging the loopback addresses.
+
+Skipped on hosts where this user may not create unprivileged ICMP sockets (see ``net.ipv4.ping_group_range``).
+"""
+import asyncio
+import socket
+
+import pytest
+
+from lg.lookingglass.icmp import IcmpProber, icmp_available
+from lg.lookingglass.parsers import PingParser
+
+
+def _has_ipv6_loopback() -> bool:
+    try:
+        with socket.socket(socket.AF_INET6, socket.SOCK_DGRAM) as s:
+            s.bind(('::1', 0))
+        return True
+    except OSError:
+        return False
+
+
+async def _ping(ip: str, count: int) -> dict:
+    prober, parser = IcmpProber(), PingParser()
+    try:
+        async for line in prober.ping(ip, count=count, interval=0.05, timeout=2):
+            parser.feed(line)
+    finally:
+        prober.close()
+    return parser.result()
+
+
+@pytest.mark.parametrize('ip, family', [
+    pytest.param('127.0.0.1', socket.AF_INET, marks=pytest.mark.skipif(
+        not icmp_available(socket.AF_INET), reason='unprivileged ICMP sockets are not available')),
+    pytest.param('::1', socket.AF_INET6, marks=pytest.mark.skipif(
+        not _has_ipv6_loopback() or not icmp_available(socket.AF_INET6),
+        reason='IPv6 loopback / unprivileged ICMPv6 sockets are not available')),
+])
+def test_ping_loopback(ip, family):
+    result = asyncio.run(_ping(ip, count=3))
+    assert result['sent'] == 3
+    assert result['recv'] == 3
+    assert 0 <= result['min'] <= result['avg'] <= result['max']
+    assert result['max'] < 1000
+
+
+def test_probe_loopback_reply():
+    if not icmp_available(socket.AF_INET):
+        pytest.skip('unprivileged ICMP sockets are not available')
+
+    async def probe():
+        prober = IcmpProber()
+        try:
+            return await prober.probe('127.0.0.1', timeout=2)
+        finally:
+            prober.close()
+
+    size, ttl, rtt = asyncio.run(probe())
+    assert size == 64
+    assert rtt >= 0